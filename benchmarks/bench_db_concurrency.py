@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Concurrent read/write stress of the shared sqlite store: the telegram node drains the message pipe while the vk
+# node writes observations and new messages. Compares rollback journal against WAL.
+# Usage: python benchmarks/bench_db_concurrency.py [seconds]
+
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import db_ops
+from synchrobot.chat_user import User
+
+WATCHED_USERS = 2000
+VK_CHAT_ID = 2000000001
+
+
+class Counters(object):
+	def __init__(self):
+		self.ops = 0
+		self.locked = 0
+		self.max_latency = 0.
+
+	def track(self, func):
+		start = time.time()
+		try:
+			func()
+			self.ops += 1
+		except sqlite3.OperationalError as e:
+			if "locked" not in e.message:
+				raise
+			self.locked += 1
+		self.max_latency = max(self.max_latency, time.time() - start)
+
+
+def run(journal_mode, seconds):
+	work_dir = tempfile.mkdtemp()
+	db_ops.DBClient.DB_NAME = os.path.join(work_dir, "bench.db")
+	db_ops.DBClient.JOURNAL_MODE = journal_mode
+	try:
+		vk_client = db_ops.DBClient("vk")
+		tg_client = db_ops.DBClient("tg")
+		tg_client.set_pending_chat(-1, VK_CHAT_ID, "/code")
+		for row_dict in vk_client.check_pending_chats("/code"):
+			row_dict["confirmed"] = True
+		users = dict((User(i, "name", 0, False, False), (i % 3 == 0, i % 7 == 0)) for i in range(WATCHED_USERS))
+		stop = threading.Event()
+		writes = Counters()
+		reads = Counters()
+
+		def writer():
+			msg_id = 0
+			while not stop.is_set():
+				writes.track(lambda: vk_client.append_users_observations(users))
+				for _ in range(10):
+					msg_id += 1
+					writes.track(lambda: vk_client.add_msg(msg_id, VK_CHAT_ID, 1, u"name", u"username", "text",
+							u"hello", msg_id))
+
+		def reader():
+			while not stop.is_set():
+				def drain():
+					for row_dict in tg_client.fetch_unsync_messages():
+						row_dict["sent"] = True
+				reads.track(drain)
+
+		threads = [threading.Thread(target=writer), threading.Thread(target=reader)]
+		for thread in threads:
+			thread.start()
+		time.sleep(seconds)
+		stop.set()
+		for thread in threads:
+			thread.join()
+		print "%-8s writes: %6.1f/s (locked %d, worst %6.1f ms)  reads: %6.1f/s (locked %d, worst %6.1f ms)" % (
+				journal_mode, writes.ops / seconds, writes.locked, writes.max_latency * 1000,
+				reads.ops / seconds, reads.locked, reads.max_latency * 1000)
+		vk_client.close()
+		tg_client.close()
+	finally:
+		shutil.rmtree(work_dir)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.
+	for journal_mode in ("DELETE", "WAL"):
+		run(journal_mode, seconds)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Compares hot queries on a synthetic db before and after the schema migrations: the baseline queries of DBClient
+# (2435c94, verbatim) on the baseline schema against the current DBClient on the migrated db.
+# Usage: python benchmarks/bench_db_indexes.py [rows]
+
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import db_ops
+from synchrobot.chat_user import User
+
+USERS = 1000
+PIPES = 50
+REPEATS = 5
+
+BASELINE_SCHEMA = [
+	'''CREATE TABLE users
+					(user_id INT NOT NULL,
+					name TEXT,
+					last_contact_date DATE,
+					want_time BOOLEAN,
+					mute_dialog BOOLEAN,
+					platform TEXT CHECK(platform = 'vk' or platform = 'tg'),
+					username TEXT,
+					other_keys TEXT,
+					PRIMARY KEY (user_id, platform))''',
+	'''CREATE TABLE messages
+					(internal_id INTEGER PRIMARY KEY AUTOINCREMENT,
+					message_id INT NOT NULL,
+					tg_chat_id INT,
+					vk_chat_id INT,
+					sender_id INT NOT NULL,
+					sender_name TEXT,
+					username TEXT,
+					msg_type TEXT,
+					content TEXT,
+					date DATE)''',
+	'''CREATE TABLE msg_pipe
+						(id INTEGER PRIMARY KEY AUTOINCREMENT,
+						tg_chat_id INT,
+						vk_chat_id INT,
+						is_active BOOLEAN DEFAULT 0,
+						code TEXT,
+						UNIQUE (tg_chat_id, vk_chat_id))''',
+	'''CREATE TABLE online_stats
+					(user_id INTEGER REFERENCES users(user_id),
+					is_online BOOLEAN NOT NULL,
+					using_mobile BOOLEAN NOT NULL,
+					timing DATE NOT NULL)''',
+]
+
+
+def baseline_fetch_unsync_messages(conn, platform):
+	curr_chat_id = platform + "_chat_id"
+	other_chat_id = ("vk" if platform == "tg" else "tg") + "_chat_id"
+
+	c = conn.cursor()
+	c.execute("SELECT date, sender_name, username, content, msg_pipe." + curr_chat_id + ", internal_id" +
+				" FROM messages " +
+				"JOIN msg_pipe ON messages." + other_chat_id + " = msg_pipe." + other_chat_id +
+				" WHERE messages." + curr_chat_id + " is NULL")
+
+	rows = c.fetchall()
+	for row in rows:
+		row_dict = {"date": row[0], "sender_name": row[1], "username": row[2],
+					"content": row[3], curr_chat_id: row[4]}
+		yield row_dict
+
+
+def baseline_check_pending_chats(conn, code):
+	c = conn.cursor()
+	c.execute("SELECT * FROM msg_pipe WHERE code = ? AND is_active = 0", (code,))
+	rows = c.fetchall()
+	for row in rows:
+		row_dict = {"id": row[0], "tg_chat_id": row[1], "vk_chat_id": row[2]}
+		yield row_dict
+
+
+def fill(conn, rows):
+	c = conn.cursor()
+	c.executemany("INSERT INTO msg_pipe VALUES (NULL, ?, ?, ?, ?)",
+			((-i, 2000000000 + i, int(i % 5 != 0), "/code%d" % i) for i in range(PIPES)))
+	# almost every message is already synced, a few hundreds are waiting in each direction
+	def messages():
+		for i in xrange(rows):
+			pipe = i % PIPES
+			tg_chat_id = -pipe if i % 2000 != 0 else None
+			vk_chat_id = 2000000000 + pipe if i % 2000 != 1 else None
+			yield (i, tg_chat_id, vk_chat_id, i % USERS, "name", "username", "text", "hello", 1500000000 + i)
+	c.executemany("INSERT INTO messages VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)", messages())
+	c.executemany("INSERT INTO online_stats VALUES (?, ?, ?, ?)",
+			((i % USERS, random.random() < .3, random.random() < .1, 1500000000 + 600 * (i // USERS))
+			for i in xrange(rows)))
+	conn.commit()
+
+
+def measure(name, func):
+	timings = []
+	for _ in range(REPEATS):
+		start = time.time()
+		func()
+		timings.append(time.time() - start)
+	print "  %-28s best %8.2f ms" % (name, min(timings) * 1000)
+
+
+def run_baseline_queries(conn):
+	user = User(USERS // 2, "name", 0, False, False)
+	measure("fetch_unsync_messages(vk)", lambda: list(baseline_fetch_unsync_messages(conn, "vk")))
+	measure("fetch_unsync_messages(tg)", lambda: list(baseline_fetch_unsync_messages(conn, "tg")))
+	measure("user statistics query", lambda: conn.execute(
+			"SELECT timing, is_online, using_mobile FROM online_stats WHERE user_id = ?", (user.id,)).fetchall())
+	measure("get_monitored_chats", lambda: [row[0] for row in conn.execute(
+			"SELECT vk_chat_id FROM msg_pipe WHERE is_active == 1").fetchall()])
+	measure("check_pending_chats", lambda: list(baseline_check_pending_chats(conn, "/code5")))
+
+
+def run_queries(vk_client, tg_client):
+	user = User(USERS // 2, "name", 0, False, False)
+	measure("fetch_unsync_messages(vk)", lambda: list(vk_client.fetch_unsync_messages(do_update=False)))
+	measure("fetch_unsync_messages(tg)", lambda: list(tg_client.fetch_unsync_messages(do_update=False)))
+	# the query of get_user_statistics, decoding is out of scope here
+	measure("user statistics query", lambda: vk_client.conn.execute(
+			"SELECT timing, is_online, using_mobile FROM online_stats WHERE user_id = ?", (user.id,)).fetchall())
+	measure("get_monitored_chats", vk_client.get_monitored_chats)
+	measure("check_pending_chats", lambda: list(vk_client.check_pending_chats("/code5")))
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+	work_dir = tempfile.mkdtemp()
+	db_ops.DBClient.DB_NAME = os.path.join(work_dir, "bench.db")
+	try:
+		conn = sqlite3.connect(db_ops.DBClient.DB_NAME)
+		for statement in BASELINE_SCHEMA:
+			conn.execute(statement)
+		print "Filling %d rows per table..." % rows
+		fill(conn, rows)
+		print "Baseline schema and queries:"
+		run_baseline_queries(conn)
+		conn.close()
+
+		start = time.time()
+		vk_client = db_ops.DBClient("vk")  # the baseline db is upgraded on connect
+		print "Migration took %.2f s" % (time.time() - start)
+		tg_client = db_ops.DBClient("tg")
+		print "Schema version %d:" % vk_client.get_schema_version()
+		run_queries(vk_client, tg_client)
+		vk_client.close()
+		tg_client.close()
+	finally:
+		shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Startup cost: `import synchrobot` in a fresh interpreter, as on every start of pipe.py, against the plotting stack
+# which is loaded on the first /stats (or by the warm-up once the pipe is live). Each run is a new process, so
+# nothing is cached in sys.modules.
+# Exits with 1 if the median import takes more than `budget_ms` or the import pulls in the plotting stack: use it
+# to catch regressions.
+# Usage: python benchmarks/bench_import_time.py [runs] [budget_ms]
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+DEFERRED_MODULES = ["numpy", "matplotlib", "scipy"]
+
+PROBE = """
+import json, sys, time
+sys.path.insert(0, %r)
+start = time.time()
+%s
+elapsed = time.time() - start
+print json.dumps({"seconds": elapsed, "loaded": [name for name in %r if name in sys.modules]})
+"""
+
+
+def probe(statement):
+	output = subprocess.check_output([sys.executable, "-c", PROBE % (ROOT, statement, DEFERRED_MODULES)])
+	return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(name, statement, runs):
+	results = [probe(statement) for _ in xrange(runs)]
+	timings = sorted(result["seconds"] for result in results)
+	median = timings[len(timings) / 2]
+	print "%-16s median %7.1f ms, min %7.1f ms, max %7.1f ms; loaded: %s" % (name, median * 1000, timings[0] * 1000,
+			timings[-1] * 1000, ", ".join(results[0]["loaded"]) or "-")
+	return median, results[0]["loaded"]
+
+
+def main():
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+	budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+	median, loaded = measure("import synchrobot", "import synchrobot", runs)
+	measure("first /stats", "import synchrobot.stats_processing as sp\nstart = time.time()\nsp.load_plotting()",
+			runs)
+
+	failed = False
+	if loaded:
+		print "REGRESSION: the import loads %s" % ", ".join(loaded)
+		failed = True
+	if budget_ms is not None and median * 1000 > budget_ms:
+		print "REGRESSION: the import takes %.1f ms, the budget is %.1f ms" % (median * 1000, budget_ms)
+		failed = True
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# End-to-end latency of VK -> pipe hand-off over a local fake long-poll server: the former loop (a new connection
+# per poll plus a fixed 1 s sleep) against LongPollWorker (keep-alive session, no sleep).
+# Usage: python benchmarks/bench_longpoll_latency.py [messages]
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urlparse
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot.sync_vk_app import LongPollWorker, SyncVkNode
+
+
+class FakeLongPollServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeLongPollHandler)
+		self.events = []  # (ts, update)
+		self.cv = threading.Condition()
+		self.connections = 0
+
+	def handle_error(self, request, client_address):
+		pass  # clients are dropped at shutdown
+
+	def push_message(self):
+		with self.cv:
+			ts = len(self.events) + 1
+			# the message timestamp carries the moment it was sent
+			self.events.append((ts, [SyncVkNode.NEW_MESSAGE_ID, ts, 0, 1, time.time(), "", "text", {}]))
+			self.cv.notify_all()
+
+
+class FakeLongPollHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1  # a reply goes out in a single write, no Nagle / delayed ACK stalls
+
+	def setup(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		self.server.connections += 1
+
+	def do_GET(self):
+		params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+		ts = int(params['ts'][0])
+		# messages come often enough, so `wait` is never expired here. A timed wait of python 2 polls with sleeps,
+		# which would add its own latency
+		with self.server.cv:
+			while len(self.server.events) < ts:
+				self.server.cv.wait()
+			updates = [update for event_ts, update in self.server.events if event_ts >= ts]
+			new_ts = len(self.server.events) + 1
+		body = json.dumps({'ts': new_ts, 'updates': updates})
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+def legacy_loop(server_address, on_updates, stop_event):
+	ts = 1
+	while not stop_event.is_set():
+		url = "http://{0}?act=a_check&key=key&ts={1}&wait=25&mode=2".format(server_address, ts)
+		answer = requests.get(url, headers={"Connection": "close"}).json()
+		ts = answer['ts']
+		on_updates(answer['updates'])
+		time.sleep(1)
+
+
+def measure(name, run_client, messages):
+	server = FakeLongPollServer()
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	server_address = "127.0.0.1:{0}/im".format(server.server_address[1])
+	latencies = []
+
+	def on_updates(updates):
+		now = time.time()
+		latencies.extend(now - update[4] for update in updates)
+
+	run_client(server_address, on_updates)
+	for _ in range(messages):
+		time.sleep(random.uniform(.05, .5))
+		server.push_message()
+	while len(latencies) < messages:
+		time.sleep(.1)
+	latencies.sort()
+	print "%-14s median %7.1f ms, p90 %7.1f ms, max %7.1f ms, connections %d" % (name,
+			latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * .9)] * 1000, latencies[-1] * 1000,
+			server.connections)
+	server.shutdown()
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+	stop_event = threading.Event()
+
+	def run_legacy(server_address, on_updates):
+		thread = threading.Thread(target=legacy_loop, args=(server_address, on_updates, stop_event))
+		thread.daemon = True
+		thread.start()
+
+	def run_worker(server_address, on_updates):
+		worker = LongPollWorker(lambda: {'server': server_address, 'key': 'key', 'ts': 1}, on_updates, scheme="http")
+		thread = threading.Thread(target=worker.run)
+		thread.daemon = True
+		thread.start()
+
+	measure("legacy", run_legacy, messages)
+	stop_event.set()
+	measure("LongPollWorker", run_worker, messages)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Insert rate and on-disk bytes per observation for online observations: the former row-by-row inserts, bulk
+# inserts into online_stats and the compact layout.
+# Usage: python benchmarks/bench_observations_ingest.py [watched users] [epochs]
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import db_ops
+from synchrobot.chat_user import User
+
+
+def append_row_by_row(db_client, users_to_state_d):
+	c = db_client.conn.cursor()
+	for user, (is_online, using_mobile) in users_to_state_d.iteritems():
+		c.execute("INSERT INTO online_stats VALUES (?, ?, ?, ?)", (user.id, is_online, using_mobile, int(time.time())))
+	db_client.conn.commit()
+
+
+def db_size(db_client):
+	c = db_client.conn.cursor()
+	c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+	c.fetchall()
+	c.execute("PRAGMA page_count")
+	page_count = c.fetchone()[0]
+	c.execute("PRAGMA page_size")
+	return page_count * c.fetchone()[0]
+
+
+def run(name, users_to_state_d, epochs, append, compact):
+	work_dir = tempfile.mkdtemp()
+	db_ops.DBClient.DB_NAME = os.path.join(work_dir, "bench.db")
+	db_ops.DBClient.COMPACT_OBSERVATIONS = compact
+	try:
+		db_client = db_ops.DBClient("vk")
+		initial_size = db_size(db_client)
+		start = time.time()
+		for _ in range(epochs):
+			append(db_client, users_to_state_d)
+		elapsed = time.time() - start
+		observations = epochs * len(users_to_state_d)
+		print "%-12s %10.0f obs/s %8.1f bytes/obs" % (name, observations / elapsed,
+				float(db_size(db_client) - initial_size) / observations)
+		db_client.close()
+	finally:
+		shutil.rmtree(work_dir)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	users_num = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	epochs = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+	users_to_state_d = dict((User(1000000 + i, "name", 0, False, False), (i % 3 == 0, i % 7 == 0))
+			for i in range(users_num))
+	# histograms are excluded: they are the same for every layout
+	update_histograms = db_ops.DBClient._update_histograms
+	db_ops.DBClient._update_histograms = lambda self, c, timing, observations: None
+	try:
+		run("row-by-row", users_to_state_d, epochs, append_row_by_row, False)
+		run("bulk", users_to_state_d, epochs, db_ops.DBClient.append_users_observations, False)
+		run("compact", users_to_state_d, epochs, db_ops.DBClient.append_users_observations, True)
+	finally:
+		db_ops.DBClient._update_histograms = update_histograms
+
+
+if __name__ == "__main__":
+	main()
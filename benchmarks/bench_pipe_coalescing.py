@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Bursts of piped messages, delivered by both UnsyncMessagesHandler with and without coalescing: API calls per
+# delivered message and, for telegram against the fake Bot API of bench_tg_send_queue.py (a send per chat per
+# second), the time until the last message of the burst is delivered. The vk side is measured against a stub
+# batcher which accepts every call right away.
+# Usage: python benchmarks/bench_pipe_coalescing.py [messages per chat] [chats]
+
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import telepot
+import telepot.api
+
+import bench_tg_send_queue
+from synchrobot import db_ops, memory_storage, rate_limits, sync_tg_bot, sync_vk_app
+
+VK_GROUP_IDS = 2000000000
+
+
+class StubBatcher(object):
+	def __init__(self):
+		self.calls = 0
+
+	def submit(self, method, **method_args):
+		self.calls += 1
+		call = rate_limits.PendingCall(method, method_args)
+		call.set_result(self.calls)
+		return call
+
+
+def make_pipes(chats, messages_per_chat):
+	store = memory_storage.MemoryStore()
+	tg_storage = memory_storage.MemoryStorage("tg", store)
+	vk_storage = memory_storage.MemoryStorage("vk", store)
+	for tg_chat_id in xrange(1, chats + 1):
+		tg_storage.set_pending_chat(tg_chat_id, VK_GROUP_IDS + tg_chat_id, "/code{0}".format(tg_chat_id))
+		for row_dict in vk_storage.check_pending_chats("/code{0}".format(tg_chat_id)):
+			row_dict["confirmed"] = True
+	# a burst: short messages of every chat, interleaved as they come
+	now = int(time.time())
+	vk_storage.add_msgs([(i, VK_GROUP_IDS + i % chats + 1, 1, u"name", u"username", "text",
+			u"burst message #{0}".format(i), now) for i in xrange(chats * messages_per_chat)])
+	tg_storage.add_msgs([(i, i % chats + 1, 1, u"name", u"username", "text", u"burst message #{0}".format(i), now)
+			for i in xrange(chats * messages_per_chat)])
+	return tg_storage, vk_storage
+
+
+def is_delivered(storage):
+	return next(storage.fetch_unsync_messages(do_update=False), None) is None
+
+
+def report(name, messages, calls, elapsed=None):
+	print "%-18s %5d messages, %5d api calls, %.3f calls per message%s" % (name, messages, calls,
+			calls / float(messages), "" if elapsed is None else ", delivered within %.1f s" % elapsed)
+
+
+def run_tg(chats, messages_per_chat, coalesce):
+	bench_tg_send_queue.reset_server()
+	tg_storage, _ = make_pipes(chats, messages_per_chat)
+	bot = sync_tg_bot.LimitsAwareBot("token")
+	handler = sync_tg_bot.UnsyncMessagesHandler(tg_storage, bot, coalesce=coalesce)
+	scheduler = db_ops.Scheduler([handler])
+
+	start = time.time()
+	while not is_delivered(tg_storage):
+		handler()
+		scheduler.wait()
+	elapsed = time.time() - start
+	scheduler.close()
+	bot.close()
+	counters = bench_tg_send_queue.FakeBotApiHandler.counters
+	report("tg, %s" % ("coalesced" if coalesce else "one by one"), chats * messages_per_chat,
+			counters["sent"] + counters["429"], elapsed)
+
+
+def run_vk(chats, messages_per_chat, coalesce):
+	_, vk_storage = make_pipes(chats, messages_per_chat)
+	api = StubBatcher()
+	handler = sync_vk_app.UnsyncMessagesHandler(vk_storage, api, sync_vk_app.Outbox(), coalesce=coalesce)
+	while not is_delivered(vk_storage):
+		handler.handler_hook()
+	report("vk, %s" % ("coalesced" if coalesce else "one by one"), chats * messages_per_chat, api.calls)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.CRITICAL)
+	messages_per_chat = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+	chats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+	server = bench_tg_send_queue.FakeBotApiServer(("127.0.0.1", 0), bench_tg_send_queue.FakeBotApiHandler)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	api_url = "http://127.0.0.1:{0}/bot".format(server.server_address[1])
+	telepot.api._methodurl = lambda req, **user_kw: "{0}{1}/{2}".format(api_url, req[0], req[1])
+
+	for coalesce in (False, True):
+		run_vk(chats, messages_per_chat, coalesce)
+	for coalesce in (False, True):
+		run_tg(chats, messages_per_chat, coalesce)
+	telepot.api._pools["default"].clear()  # keep-alive connections
+	server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
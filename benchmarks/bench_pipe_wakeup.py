@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Pipe latency: from a telegram message accepted by the ingest buffer to its fetch by the delivery handler of the vk
+# node. The former fixed-period polling loop (0.3 s sleep, 4 s handler period) against the event-driven scheduler.
+# Usage: python benchmarks/bench_pipe_wakeup.py [messages]
+
+import datetime as dt
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import db_ops, memory_storage
+
+TG_CHAT_ID = -1
+VK_CHAT_ID = 2000000001
+POLLING_SLEEP_SECONDS = 0.3
+POLLING_PERIOD_SECONDS = 4
+
+
+class DeliveryHandler(db_ops.Handler):
+	def __init__(self, db_client, put_times, latencies):
+		super(DeliveryHandler, self).__init__(db_client)
+		self.period = self.FALLBACK_PERIOD
+		self.put_times = put_times
+		self.latencies = latencies
+
+	def handler_hook(self, **kwargs):
+		for row_dict in self.db_client.fetch_unsync_messages():
+			self.latencies.append(time.time() - self.put_times[row_dict["date"]])
+			row_dict["sent"] = True
+
+
+def run(name, event_driven, messages):
+	store = memory_storage.MemoryStore()
+	tg_storage = memory_storage.MemoryStorage("tg", store)
+	vk_storage = memory_storage.MemoryStorage("vk", store)
+	tg_storage.set_pending_chat(TG_CHAT_ID, VK_CHAT_ID, "/code")
+	for row_dict in vk_storage.check_pending_chats("/code"):
+		row_dict["confirmed"] = True
+	ingest_buffer = db_ops.MessageIngestBuffer(tg_storage)
+
+	put_times = {}
+	latencies = []
+	handler = DeliveryHandler(vk_storage, put_times, latencies)
+	scheduler = db_ops.Scheduler([handler])
+	if event_driven:
+		scheduler.wake_on(vk_storage, db_ops.StorageEvents.MESSAGES_ADDED, "vk", handler)
+	else:
+		handler.period = dt.timedelta(seconds=POLLING_PERIOD_SECONDS)
+	stop = threading.Event()
+	iterations = [0]
+
+	def event_loop():
+		while not stop.is_set():
+			handler()
+			iterations[0] += 1
+			if event_driven:
+				scheduler.wait()
+			else:
+				time.sleep(POLLING_SLEEP_SECONDS)
+
+	loop_thread = threading.Thread(target=event_loop)
+	loop_thread.start()
+	start = time.time()
+	random.seed(0)
+	for msg_id in xrange(messages):
+		time.sleep(random.uniform(0, 0.5))
+		put_times[msg_id] = time.time()
+		ingest_buffer.put(msg_id, TG_CHAT_ID, 1, u"name", u"username", "text", u"hello", msg_id)
+	while len(latencies) < messages:
+		time.sleep(0.05)
+	elapsed = time.time() - start
+	stop.set()
+	handler.wake()
+	loop_thread.join()
+	scheduler.close()
+	ingest_buffer.close()
+
+	latencies.sort()
+	print "%-8s median %7.1f ms, p90 %7.1f ms, max %7.1f ms, %5.1f loop iterations/s" % (name,
+			latencies[len(latencies) / 2] * 1000, latencies[len(latencies) * 9 / 10] * 1000, latencies[-1] * 1000,
+			iterations[0] / elapsed)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+	run("polling", False, messages)
+	run("events", True, messages)
+
+
+if __name__ == "__main__":
+	main()
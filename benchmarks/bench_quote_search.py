@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Inline queries against QuoteStore on synthetic corpora (zipf-distributed words, several subject files): load time
+# and latency of searches by the kind of query, uncached (the cache is cleared before each query) and answered by the
+# cache filled beforehand. The former get_quote read the whole subject file on every query, its latency is given for
+# comparison.
+# Usage: python benchmarks/bench_quote_search.py [quotes ...]
+
+import bisect
+import io
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import quotes
+
+SUBJECTS = ["movies", "science", "sports", "random"]
+VOCABULARY_SIZE = 50000
+QUERIES_PER_KIND = 200
+
+
+def make_word(rng):
+	return u"".join(rng.choice(u"abcdefghijklmnopqrstuvwxyz") for _ in xrange(rng.randint(2, 10)))
+
+
+def make_corpus(directory, quotes_number, rng):
+	vocabulary = list(set(make_word(rng) for _ in xrange(VOCABULARY_SIZE)))
+	rng.shuffle(vocabulary)
+	weights = [1. / (rank + 1) for rank in xrange(len(vocabulary))]
+	total = sum(weights)
+	cumulative = []
+	accumulated = 0.
+	for weight in weights:
+		accumulated += weight / total
+		cumulative.append(accumulated)
+
+	def pick():
+		return vocabulary[min(len(vocabulary) - 1, bisect.bisect_left(cumulative, rng.random()))]
+
+	files = [io.open(os.path.join(directory, subject + ".txt"), "w", encoding="utf-8") for subject in SUBJECTS]
+	for i in xrange(quotes_number):
+		words = [pick() for _ in xrange(rng.randint(4, 30))]
+		files[i % len(files)].write(u"{0}. ({1} {2})\n".format(u" ".join(words).capitalize(), pick().capitalize(),
+				pick().capitalize()))
+	for f in files:
+		f.close()
+	return vocabulary
+
+
+def percentiles(timings):
+	timings = sorted(timings)
+	return timings[len(timings) / 2] * 1000, timings[int(len(timings) * .99)] * 1000
+
+
+def measure(name, queries, search, cache=None):
+	"""
+	:param cache: LRUCache cleared before each query, for latency of the search itself
+	"""
+	timings = []
+	found = 0
+	for query in queries:
+		if cache is not None:
+			cache.entries.clear()
+		start = time.time()
+		found += len(search(query))
+		timings.append(time.time() - start)
+	p50, p99 = percentiles(timings)
+	print "  %-34s p50 %7.3f ms, p99 %7.3f ms, %4.1f results per query" % (name, p50, p99,
+			found / float(len(queries)))
+
+
+def run(quotes_number, rng):
+	directory = tempfile.mkdtemp(prefix="quotes_bench_")
+	try:
+		vocabulary = make_corpus(directory, quotes_number, rng)
+		start = time.time()
+		store = quotes.QuoteStore(directory)
+		print "%d quotes: loaded and indexed within %.2f s, %d words" % (len(store), time.time() - start,
+				len(store.vocabulary))
+
+		common = vocabulary[:100]
+		rare = vocabulary[len(vocabulary) / 2:]
+		kinds = [
+			("a common word", lambda: rng.choice(common) + u" "),
+			("a rare word", lambda: rng.choice(rare) + u" "),
+			("two words", lambda: u"{0} {1} ".format(rng.choice(vocabulary[:5000]), rng.choice(rare))),
+			("three words, being typed", lambda: u"{0} {1} {2}".format(rng.choice(common),
+					rng.choice(vocabulary[:5000]), rng.choice(vocabulary)[:2])),
+			("no match", lambda: u"qqqqqqqqqqqq "),
+		]
+		for name, make_query in kinds:
+			queries = [make_query() for _ in xrange(QUERIES_PER_KIND)]
+			measure(name, queries, store.search, store.answers)
+			for query in queries:
+				store.search(query)
+			measure(name + ", cached", queries, store.search)
+
+		def former_get_quote(query):
+			with open(os.path.join(directory, "random.txt")) as f:
+				return [rng.choice(f.readlines())]
+		measure("former get_quote", [u""] * QUERIES_PER_KIND, former_get_quote)
+	finally:
+		shutil.rmtree(directory)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	rng = random.Random(1)
+	for quotes_number in [int(arg) for arg in sys.argv[1:]] or [100000, 300000]:
+		run(quotes_number, rng)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Decoding of user observations into the attendance histogram: row-by-row python datetimes (the former path)
+# against the structured array of DBClient.get_user_statistics.
+# Usage: python benchmarks/bench_statistics_decoding.py
+
+import calendar
+import datetime as dt
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import db_ops, stats_processing
+from synchrobot.chat_user import User
+
+SIZES = [1000, 10000, 100000, 1000000]
+
+
+def legacy_histogram(db_client, user):
+	c = db_client.conn.cursor()
+	c.execute("SELECT timing, is_online, using_mobile FROM online_stats WHERE user_id = ?", (user.id,))
+	stats = np.array([[dt.datetime.fromtimestamp(row[0]), row[1], row[2]] for row in c.fetchall()], dtype=object)
+	online_per_hours = [[] for _ in range(24)]
+	mobiles_per_hours = [[] for _ in range(24)]
+	days_per_hours = [[] for _ in range(24)]
+	for row in stats:
+		online_per_hours[row[0].hour].append(row[1])
+		mobiles_per_hours[row[0].hour].append(row[2])
+		days_per_hours[row[0].hour].append(row[0].date())
+	return [len(np.unique(days)) for days in days_per_hours]
+
+
+def vectorized_histogram(db_client, user):
+	return stats_processing.histogram_from_statistics(db_client.get_user_statistics(user))
+
+
+def measure(func, *args):
+	start = time.time()
+	func(*args)
+	return time.time() - start
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	work_dir = tempfile.mkdtemp()
+	db_ops.DBClient.DB_NAME = os.path.join(work_dir, "bench.db")
+	try:
+		db_client = db_ops.DBClient("vk")
+		now = calendar.timegm(time.gmtime())
+		print "%10s %12s %12s %8s" % ("rows", "legacy, s", "new, s", "speedup")
+		for user_id, size in enumerate(SIZES):
+			user = User(user_id, "name", 0, False, False)
+			db_client.conn.executemany("INSERT INTO online_stats VALUES (?, ?, ?, ?)",
+					((user_id, i % 3 == 0, i % 7 == 0, now - 600 * i) for i in xrange(size)))
+			db_client.conn.commit()
+			legacy = measure(legacy_histogram, db_client, user)
+			vectorized = measure(vectorized_histogram, db_client, user)
+			print "%10d %12.3f %12.3f %7.1fx" % (size, legacy, vectorized, legacy / vectorized)
+		db_client.close()
+	finally:
+		shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# /stats rendering: plots made right on the event loop (as StatisticsProcessor used to) against plots handed to
+# a WorkerPool. The loop ticks every 10 ms meanwhile, its longest stall and the rendering throughput are reported.
+# Usage: python benchmarks/bench_stats_rendering.py [requests] [processes]
+
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import stats_processing, worker_pool
+from synchrobot.chat_user import User
+
+TICK_SECONDS = 0.01
+
+
+def make_histogram(seed):
+	rng = np.random.RandomState(seed)
+	histogram = np.zeros((24, 4), dtype=np.int64)
+	histogram[:, 0] = rng.randint(50, 100, 24)
+	histogram[:, 1] = histogram[:, 0] * rng.uniform(0, 1, 24)
+	histogram[:, 2] = histogram[:, 1] * rng.uniform(0, 1, 24)
+	histogram[:, 3] = rng.randint(1, 30, 24)
+	return histogram
+
+
+def report(name, requests, elapsed, stalls):
+	print "%-8s %6.2f plots/s, loop stall: max %7.1f ms, %5.1f%s of ticks late" % (name, requests / elapsed,
+			max(stalls) * 1000, len([stall for stall in stalls if stall > 5 * TICK_SECONDS]) * 100. / len(stalls), "%")
+
+
+def run_inline(jobs):
+	stalls = []
+	start = last_tick = time.time()
+	for histogram, user in jobs:
+		os.remove(stats_processing.make_attendance_plot(histogram, user))
+		now = time.time()
+		stalls.append(now - last_tick)
+		last_tick = now
+	report("inline", len(jobs), time.time() - start, stalls)
+
+
+def run_pool(jobs, processes):
+	pool = worker_pool.WorkerPool(processes, max_queued=len(jobs))
+	done = threading.Event()
+	rendered = []
+
+	def on_rendered(filename, error):
+		assert error is None, error
+		os.remove(filename)
+		rendered.append(filename)
+		if len(rendered) == len(jobs):
+			done.set()
+
+	stalls = []
+	start = last_tick = time.time()
+	for histogram, user in jobs:
+		assert pool.submit(stats_processing.make_attendance_plot, (histogram, user), on_rendered)
+	while not done.is_set():
+		done.wait(TICK_SECONDS)
+		now = time.time()
+		stalls.append(now - last_tick)
+		last_tick = now
+	report("pool/%d" % processes, len(jobs), time.time() - start, stalls)
+	pool.close()
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	requests = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+	processes = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+	jobs = [(make_histogram(i), User(i, u"user", 0, False, False, u"user{0}".format(i))) for i in xrange(requests)]
+
+	os.remove(stats_processing.make_attendance_plot(*jobs[0]))  # warm up
+	run_inline(jobs)
+	run_pool(jobs, processes)
+
+
+if __name__ == "__main__":
+	main()
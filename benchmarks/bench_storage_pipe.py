@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Storage overhead of the message pipe: telegram messages go through the ingest buffer while the vk node drains
+# and acknowledges them, observations are written meanwhile. sqlite backend against the in-memory (zero I/O) one.
+# Usage: python benchmarks/bench_storage_pipe.py [messages]
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from synchrobot import db_ops, memory_storage
+from synchrobot.chat_user import User
+
+TG_CHAT_ID = -1
+VK_CHAT_ID = 2000000001
+WATCHED_USERS = 1000
+
+
+def run(name, tg_storage, vk_storage, messages):
+	tg_storage.set_pending_chat(TG_CHAT_ID, VK_CHAT_ID, "/code")
+	for row_dict in vk_storage.check_pending_chats("/code"):
+		row_dict["confirmed"] = True
+	users_to_state_d = dict((User(i, "name", 0, False, False), (i % 3 == 0, i % 7 == 0))
+			for i in range(WATCHED_USERS))
+	ingest_buffer = db_ops.MessageIngestBuffer(tg_storage, max_rows=100, max_delay_ms=20)
+
+	def produce():
+		for msg_id in xrange(messages):
+			ingest_buffer.put(msg_id, TG_CHAT_ID, 1, u"name", u"username", "text", u"hello", msg_id)
+
+	start = time.time()
+	producer = threading.Thread(target=produce)
+	producer.start()
+	delivered = 0
+	epochs = 0
+	while delivered < messages:
+		for row_dict in vk_storage.fetch_unsync_messages():
+			row_dict["sent"] = True
+			delivered += 1
+		vk_storage.append_users_observations(users_to_state_d)
+		epochs += 1
+	elapsed = time.time() - start
+	producer.join()
+	ingest_buffer.close()
+	print "%-8s %8.0f msg/s end-to-end, %d observation epochs" % (name, messages / elapsed, epochs)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+	store = memory_storage.MemoryStore()
+	run("memory", memory_storage.MemoryStorage("tg", store), memory_storage.MemoryStorage("vk", store), messages)
+
+	work_dir = tempfile.mkdtemp()
+	db_ops.DBClient.DB_NAME = os.path.join(work_dir, "bench.db")
+	try:
+		tg_storage = db_ops.DBClient("tg")
+		vk_storage = db_ops.DBClient("vk")
+		run("sqlite", tg_storage, vk_storage, messages)
+		tg_storage.close()
+		vk_storage.close()
+	finally:
+		shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Delivery of piped messages into telegram by UnsyncMessagesHandler against the fake Bot API of
+# bench_tg_send_queue.py: throughput by the number of active pipes, one of them blocked by its user (403). The former
+# handler delivered at most 3 messages per 4 s tick to all pipes together and stopped at the first limited chat.
+# Usage: python benchmarks/bench_tg_delivery.py [messages per pipe]
+
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import telepot
+import telepot.api
+
+import bench_tg_send_queue
+from synchrobot import db_ops, memory_storage, sync_tg_bot
+
+FORMER_LIMIT = 3 / 4.  # messages per second
+BLOCKED_CHAT_ID = 1
+
+
+def run(pipes, messages_per_pipe):
+	bench_tg_send_queue.reset_server()
+	bench_tg_send_queue.FakeBotApiHandler.blocked_chats.add(BLOCKED_CHAT_ID)
+	store = memory_storage.MemoryStore()
+	tg_storage = memory_storage.MemoryStorage("tg", store)
+	vk_storage = memory_storage.MemoryStorage("vk", store)
+	for tg_chat_id in xrange(1, pipes + 1):
+		tg_storage.set_pending_chat(tg_chat_id, 2000000000 + tg_chat_id, "/code{0}".format(tg_chat_id))
+		for row_dict in vk_storage.check_pending_chats("/code{0}".format(tg_chat_id)):
+			row_dict["confirmed"] = True
+	bot = sync_tg_bot.LimitsAwareBot("token")
+	# a message per send: merged messages would never bring the count of sends up to the expected one
+	handler = sync_tg_bot.UnsyncMessagesHandler(tg_storage, bot, coalesce=False)
+	scheduler = db_ops.Scheduler([handler])
+	scheduler.wake_on(tg_storage, db_ops.StorageEvents.MESSAGES_ADDED, "tg", handler)
+
+	start = time.time()
+	vk_storage.add_msgs([(i, 2000000000 + i % pipes + 1, 1, u"name", u"username", "text", u"message #{0}".format(i),
+			int(start)) for i in xrange(pipes * messages_per_pipe)])
+	expected = (pipes - 1) * messages_per_pipe
+	counters = bench_tg_send_queue.FakeBotApiHandler.counters
+	while counters["sent"] < expected:
+		handler()
+		scheduler.wait()
+	elapsed = time.time() - start
+	scheduler.close()
+	bot.close()
+	print "%3d pipes: %5.1f msg/s delivered (%.0fx the former limit), %d attempts to the blocked chat" % (pipes,
+			expected / elapsed, expected / elapsed / FORMER_LIMIT, counters["403"])
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.CRITICAL)
+	messages_per_pipe = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+	server = bench_tg_send_queue.FakeBotApiServer(("127.0.0.1", 0), bench_tg_send_queue.FakeBotApiHandler)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	api_url = "http://127.0.0.1:{0}/bot".format(server.server_address[1])
+	telepot.api._methodurl = lambda req, **user_kw: "{0}{1}/{2}".format(api_url, req[0], req[1])
+
+	for pipes in (2, 5, 10, 30):
+		run(pipes, messages_per_pipe)
+	telepot.api._pools["default"].clear()  # keep-alive connections
+	server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
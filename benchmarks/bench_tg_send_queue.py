@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Telegram sends against a local fake Bot API which enforces the limits: 30 messages within any second overall and
+# a message per second to a chat (429 with retry_after otherwise). Workers sending as fast as they can against
+# LimitsAwareBot's queue: piped messages queued behind a time broadcast, without and with priority classes.
+# Usage: python benchmarks/bench_tg_send_queue.py [messages] [chats]
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import telepot
+import telepot.api
+import telepot.exception
+
+from synchrobot import sync_tg_bot
+
+ROUND_TRIP_SECONDS = 0.03
+GLOBAL_LIMIT = 30  # messages within any second
+CHAT_INTERVAL_SECONDS = 0.9  # a little lenient: requests of a chat may be reordered in flight by a few ms
+WORKERS = 8
+USER_CHATS = 10000  # ids of private chats with users
+
+
+class FakeBotApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1
+	mx = threading.Lock()
+	sent_times = collections.deque()
+	chat_times = {}
+	counters = collections.Counter()
+	blocked_chats = set()  # answered 403
+
+	def do_POST(self):
+		# the Bot API client posts multipart forms
+		form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ={"REQUEST_METHOD": "POST"})
+		time.sleep(ROUND_TRIP_SECONDS)
+		chat_id = int(form.getfirst("chat_id"))
+		with self.mx:
+			now = time.time()
+			while self.sent_times and self.sent_times[0] < now - 1:
+				self.sent_times.popleft()
+			if chat_id in self.blocked_chats:
+				self.counters["403"] += 1
+				answer = {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+			elif len(self.sent_times) >= GLOBAL_LIMIT or now - self.chat_times.get(chat_id, 0) < CHAT_INTERVAL_SECONDS:
+				self.counters["429"] += 1
+				answer = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+						"parameters": {"retry_after": 1}}
+			else:
+				self.sent_times.append(now)
+				self.chat_times[chat_id] = now
+				self.counters["sent"] += 1
+				answer = {"ok": True, "result": {"message_id": self.counters["sent"], "chat": {"id": chat_id},
+						"date": int(now), "text": form.getfirst("text")}}
+		body = json.dumps(answer)
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeBotApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def reset_server():
+	with FakeBotApiHandler.mx:
+		FakeBotApiHandler.sent_times.clear()
+		FakeBotApiHandler.chat_times.clear()
+		FakeBotApiHandler.counters.clear()
+	time.sleep(1.1)
+
+
+def report(name, messages, elapsed, extra=""):
+	counters = FakeBotApiHandler.counters
+	print "%-8s %5.1f msg/s delivered, %4d 429s, %3d lost%s" % (name, counters["sent"] / elapsed, counters["429"],
+			messages - counters["sent"], extra)
+
+
+def run_unlimited(messages, chats):
+	reset_server()
+	bot = telepot.Bot("token")
+	jobs = collections.deque(xrange(messages))
+
+	def worker():
+		while True:
+			try:
+				i = jobs.popleft()
+			except IndexError:
+				return
+			try:
+				bot.sendMessage(i % chats + 1, "message #{0}".format(i))
+			except telepot.exception.TelegramError:
+				pass
+
+	start = time.time()
+	threads = [threading.Thread(target=worker) for _ in xrange(WORKERS)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	report("direct", messages, time.time() - start)
+
+
+def run_queue(name, messages, chats, prioritized):
+	reset_server()
+	bot = sync_tg_bot.LimitsAwareBot("token")
+	start = time.time()
+	calls = []
+	# a time broadcast to private chats of users is queued first, piped messages to `chats` follow
+	notifications = messages * 3 / 4
+	for i in xrange(notifications):
+		priority = bot.PRIORITY_NOTIFICATION if prioritized else bot.PRIORITY_PIPE
+		calls.append((bot.PRIORITY_NOTIFICATION, bot.send(USER_CHATS + i, "time #{0}".format(i), priority)))
+	for i in xrange(messages - notifications):
+		calls.append((bot.PRIORITY_PIPE, bot.send(i % chats + 1, "message #{0}".format(i), bot.PRIORITY_PIPE)))
+	done_times = collections.defaultdict(list)
+	for kind, call in calls:
+		call.add_done_callback(lambda call_, kind=kind: done_times[kind].append(time.time() - start))
+	for kind, call in calls:
+		call.result()
+	elapsed = time.time() - start
+	bot.close()
+	mean = lambda values: sum(values) / len(values)
+	report(name, messages, elapsed, "; mean delivery: piped %4.1f s, notifications %4.1f s" % (
+			mean(done_times[bot.PRIORITY_PIPE]), mean(done_times[bot.PRIORITY_NOTIFICATION])))
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.ERROR)
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+	chats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+	server = FakeBotApiServer(("127.0.0.1", 0), FakeBotApiHandler)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	api_url = "http://127.0.0.1:{0}/bot".format(server.server_address[1])
+	telepot.api._methodurl = lambda req, **user_kw: "{0}{1}/{2}".format(api_url, req[0], req[1])
+
+	print "limit of the queue: %d msg/s" % sync_tg_bot.LimitsAwareBot.MESSAGES_PER_SECOND
+	run_unlimited(messages, chats)
+	run_queue("fifo", messages, chats, False)
+	run_queue("priority", messages, chats, True)
+	telepot.api._pools["default"].clear()  # keep-alive connections
+	server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
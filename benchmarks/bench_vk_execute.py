@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# messages.send throughput against a local fake vk endpoint with a fixed round-trip time: a request per call
+# (vk_requests) against calls coalesced into `execute` requests (VkExecuteBatcher). Every 10th message is rejected
+# by the fake server to check that errors are routed to their own callers.
+# Usage: python benchmarks/bench_vk_execute.py [messages]
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import vk_requests
+import vk_requests.exceptions
+from vk_requests.auth import VKSession
+
+from synchrobot import rate_limits, sync_vk_app
+
+ROUND_TRIP_SECONDS = 0.02
+VK_REQUESTS_PER_SECOND = 3
+FAILING_TEXT = "reject me"
+UNLIMITED_RATE = 10 ** 6
+
+
+class FakeVkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1
+	next_msg_id = [0]
+	requests_served = [0]
+
+	def do_POST(self):
+		params = urlparse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])))
+		method = self.path.rsplit("/", 1)[-1]
+		time.sleep(ROUND_TRIP_SECONDS)
+		self.requests_served[0] += 1
+		if method == "execute":
+			results = []
+			errors = []
+			for call_method, args in re.findall(r"API\.([\w.]+)\((\{.*?\})\)(?=[,\]])", params["code"][0]):
+				if FAILING_TEXT in json.loads(args)["message"]:
+					results.append(False)
+					errors.append({"method": call_method, "error_code": 9, "error_msg": "Flood control"})
+				else:
+					results.append(self.send_message())
+			answer = {"response": results}
+			if errors:
+				answer["execute_errors"] = errors
+		elif FAILING_TEXT in params["message"][0]:
+			answer = {"error": {"error_code": 9, "error_msg": "Flood control"}}
+		else:
+			answer = {"response": self.send_message()}
+		body = json.dumps(answer)
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_message(self):
+		self.next_msg_id[0] += 1
+		return self.next_msg_id[0]
+
+	def log_message(self, *args):
+		pass
+
+
+class FakeVkServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def message(i):
+	return "message #{0}{1}".format(i, ", " + FAILING_TEXT if i % 10 == 9 else "")
+
+
+def report(name, messages, elapsed, requests_made, errors):
+	print "%-8s %7.1f msg/s, %4d requests, %2d errors routed; at %d requests/s of vk: %6.1f msg/s" % (name,
+			messages / elapsed, requests_made, errors, VK_REQUESTS_PER_SECOND,
+			VK_REQUESTS_PER_SECOND * float(messages) / requests_made)
+
+
+def run_direct(api_url, messages):
+	session = VKSession()
+	session.API_URL = api_url
+	session.access_token = "token"
+	api = vk_requests.API(session)
+	served = FakeVkHandler.requests_served[0]
+	errors = 0
+	start = time.time()
+	for i in xrange(messages):
+		try:
+			api.messages.send(peer_id=1, random_id=i, message=message(i))
+		except vk_requests.exceptions.VkAPIError:
+			errors += 1
+	report("direct", messages, time.time() - start, FakeVkHandler.requests_served[0] - served, errors)
+
+
+def run_execute(api_url, messages):
+	# raw throughput, the rate is accounted in the report
+	unlimited = rate_limits.RateScheduler(UNLIMITED_RATE, UNLIMITED_RATE, UNLIMITED_RATE, UNLIMITED_RATE)
+	batcher = sync_vk_app.VkExecuteBatcher("token", "5.0", api_url=api_url, rate_scheduler=unlimited)
+	start = time.time()
+	calls = [batcher.submit("messages.send", peer_id=1, random_id=i, message=message(i)) for i in xrange(messages)]
+	errors = 0
+	for i, call in enumerate(calls):
+		try:
+			call.result()
+			assert i % 10 != 9, "a rejected message got a result"
+		except vk_requests.exceptions.VkAPIError as e:
+			assert i % 10 == 9 and e.message == "Flood control", "an error is routed to a wrong caller"
+			errors += 1
+	elapsed = time.time() - start
+	batcher.close()
+	report("execute", messages, elapsed, batcher.requests_made, errors)
+
+
+def main():
+	logging.basicConfig()
+	logging.getLogger().setLevel(logging.WARNING)
+	messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+	server = FakeVkServer(("127.0.0.1", 0), FakeVkHandler)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+	api_url = "http://127.0.0.1:{0}/method/".format(server.server_address[1])
+
+	run_direct(api_url, messages)
+	run_execute(api_url, messages)
+	server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
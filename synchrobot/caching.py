@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Author: Ivan Senin
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+	"""
+	Thread-safe mapping of at most `max_size` entries: the least recently used one is evicted first. Entries older
+	than `ttl_seconds` are treated as missing (None: never expire). `on_evict(key, value)` is called out of the lock
+	for every entry which leaves the cache other than by `put` of the same value
+	"""
+	def __init__(self, max_size, ttl_seconds=None, on_evict=None):
+		assert max_size > 0
+		self.max_size = max_size
+		self.ttl_seconds = ttl_seconds
+		self.on_evict = on_evict
+		self.entries = collections.OrderedDict()  # key -> (value, put time), the most recently used is the last
+		self.mx = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def _is_expired(self, entry, now):
+		return self.ttl_seconds is not None and now - entry[1] > self.ttl_seconds
+
+	def _evicted(self, evicted):
+		if self.on_evict is not None:
+			for key, value in evicted:
+				self.on_evict(key, value)
+
+	def get(self, key, default=None):
+		evicted = []
+		with self.mx:
+			entry = self.entries.pop(key, None)
+			if entry is None or self._is_expired(entry, time.time()):
+				if entry is not None:
+					evicted.append((key, entry[0]))
+				self.misses += 1
+				value = default
+			else:
+				self.entries[key] = entry
+				self.hits += 1
+				value = entry[0]
+		self._evicted(evicted)
+		return value
+
+	def put(self, key, value):
+		evicted = []
+		with self.mx:
+			entry = self.entries.pop(key, None)
+			if entry is not None and entry[0] is not value:
+				evicted.append((key, entry[0]))
+			self.entries[key] = (value, time.time())
+			while len(self.entries) > self.max_size:
+				evicted_key, (evicted_value, _) = self.entries.popitem(last=False)
+				evicted.append((evicted_key, evicted_value))
+		self._evicted(evicted)
+
+	def invalidate(self, key):
+		with self.mx:
+			entry = self.entries.pop(key, None)
+		if entry is not None:
+			self._evicted([(key, entry[0])])
+
+	def purge_expired(self):
+		"""
+		:return: number of evicted entries
+		"""
+		now = time.time()
+		with self.mx:
+			evicted = [(key, entry[0]) for key, entry in self.entries.iteritems() if self._is_expired(entry, now)]
+			for key, _ in evicted:
+				del self.entries[key]
+		self._evicted(evicted)
+		return len(evicted)
+
+	def __len__(self):
+		with self.mx:
+			return len(self.entries)
+
+	def hit_rate(self):
+		with self.mx:
+			lookups = self.hits + self.misses
+			return float(self.hits) / lookups if lookups else 0.
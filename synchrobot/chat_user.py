@@ -5,19 +5,31 @@ import calendar
 import time
 import datetime as dt
 import json
+import threading
 
 class User(object):
 	def __init__(self, id, name, last_seen, want_time, muted, username="", additional_keys="{}"):
 		super(User, self).__init__()
+		self.registry = None  # set by UserRegistry
 		self.id = id
 		self.name = name
-		self.username = username
+		self._username = username
 		self._last_seen = last_seen
 		self._want_time = want_time
 		self._muted = muted
 		self.dirty = True
 		self.other_keys = json.loads(additional_keys) if additional_keys else {}
 
+	def get_username(self): return self._username
+
+	def set_username(self, username):
+		old_username = self._username
+		self._username = username
+		self.dirty = True
+		if self.registry is not None:
+			self.registry.reindex(self, old_username)
+	username = property(get_username, set_username)
+
 	def get_seen(self): return self._last_seen
 
 	def set_seen(self, seen):
@@ -53,3 +65,91 @@ class User(object):
 	def serialized_keys(self):
 		return json.dumps(self.other_keys)
 
+	def __getstate__(self):
+		# a copy sent to another process is detached from the registry
+		state = self.__dict__.copy()
+		state['registry'] = None
+		return state
+
+
+
+class UserRegistry(object):
+	"""
+	Users of a platform indexed by id and by username. A single internal lock keeps both indexes consistent, take
+	`lock` to make several operations atomic. A username change of a registered user is reindexed on assignment
+	"""
+	def __init__(self, users=()):
+		self.lock = threading.RLock()
+		self.__by_id = {}
+		self.__by_username = {}
+		for user in users:
+			self.add(user)
+
+	def add(self, user):
+		"""
+		Registers a user, replaces a registered one with the same id
+		"""
+		assert isinstance(user, User)
+		with self.lock:
+			old_user = self.__by_id.get(user.id)
+			if old_user is not None:
+				self.__unindex_username(old_user, old_user.username)
+				old_user.registry = None
+			self.__by_id[user.id] = user
+			user.registry = self
+			if user.username:
+				self.__by_username[user.username] = user
+
+	def reindex(self, user, old_username):
+		with self.lock:
+			if self.__by_id.get(user.id) is not user:
+				return
+			self.__unindex_username(user, old_username)
+			if user.username:
+				self.__by_username[user.username] = user
+
+	def __unindex_username(self, user, username):
+		if username and self.__by_username.get(username) is user:
+			del self.__by_username[username]
+
+	def get(self, id, default=None):
+		with self.lock:
+			return self.__by_id.get(id, default)
+
+	def find_by_username(self, username):
+		"""
+		:return: `User` or None
+		"""
+		with self.lock:
+			return self.__by_username.get(username)
+
+	def __getitem__(self, id):
+		with self.lock:
+			return self.__by_id[id]
+
+	def __contains__(self, id):
+		with self.lock:
+			return id in self.__by_id
+
+	def __len__(self):
+		with self.lock:
+			return len(self.__by_id)
+
+	def keys(self):
+		with self.lock:
+			return self.__by_id.keys()
+
+	def values(self):
+		"""
+		:return: list of users, a snapshot
+		"""
+		with self.lock:
+			return self.__by_id.values()
+
+	def iteritems(self):
+		"""
+		Iterates over a snapshot of (id, user) pairs
+		"""
+		with self.lock:
+			items = self.__by_id.items()
+		return iter(items)
@@ -1,20 +1,283 @@
 # -*- coding: utf-8 -*-
 # Author: Ivan Senin
 
+import Queue
 import calendar
 import datetime as dt
+import itertools
 import logging
-import numpy as np
 import os
 import sqlite3
+import threading
 import time
 
-from synchrobot.chat_user import User
+from synchrobot.chat_user import User, UserRegistry
 
 
-class DBClient(object):
-	DB_NAME = 'pipe_data.db'
+def _migrate_v2_indexes(db_client, c):
+	# the unsync join filters by destination chat column being NULL and joins by the source one
+	c.execute("CREATE INDEX IF NOT EXISTS messages_unsync_tg ON messages (tg_chat_id, vk_chat_id)")
+	c.execute("CREATE INDEX IF NOT EXISTS messages_unsync_vk ON messages (vk_chat_id, tg_chat_id)")
+	# covers get_user_statistics completely, no table lookups
+	c.execute("CREATE INDEX IF NOT EXISTS online_stats_user_timing ON online_stats "
+			"(user_id, timing, is_online, using_mobile)")
+	c.execute("CREATE INDEX IF NOT EXISTS msg_pipe_active_code ON msg_pipe (is_active, code)")
+
+
+def _migrate_v3_delivery_cursors(db_client, c):
+	# cursors of existing pipes are initialized lazily by the first fetch
+	c.execute('''CREATE TABLE IF NOT EXISTS delivery_cursors
+				(pipe_id INTEGER NOT NULL REFERENCES msg_pipe(id),
+				platform TEXT CHECK(platform = 'vk' or platform = 'tg'),
+				last_internal_id INTEGER NOT NULL,
+				PRIMARY KEY (pipe_id, platform))''')
+
+
+def _migrate_v4_observations_rollup(db_client, c):
+	c.execute('''CREATE TABLE IF NOT EXISTS online_stats_hourly
+				(user_id INTEGER REFERENCES users(user_id),
+				hour_timing INTEGER NOT NULL,
+				samples INTEGER NOT NULL,
+				online INTEGER NOT NULL,
+				mobile INTEGER NOT NULL,
+				PRIMARY KEY (user_id, hour_timing))''')
+	c.execute("CREATE INDEX IF NOT EXISTS online_stats_timing ON online_stats (timing)")
+	# freed pages of compacted observations are returned by `PRAGMA incremental_vacuum`. Connections ask for
+	# incremental auto vacuum, but an existing db is switched by a full VACUUM only, which holds the exclusive lock for
+	# the whole rewrite: it is left to the `vacuum` maintenance command. It is an optimization only, until then
+	# the space is just reused by new rows
+	c.execute("PRAGMA auto_vacuum")
+	if c.fetchone()[0] != 2:
+		db_client.logger.warning("%s is not switched to incremental auto vacuum yet, a vacuum is pending: stop the nodes"
+				" and run `python -m synchrobot.db_ops vacuum`", db_client.DB_NAME)
+
+
+def _migrate_v5_histograms(db_client, c):
+	c.execute('''CREATE TABLE IF NOT EXISTS online_stats_histogram
+				(user_id INTEGER REFERENCES users(user_id),
+				hour INTEGER NOT NULL,
+				samples INTEGER NOT NULL,
+				online INTEGER NOT NULL,
+				mobile INTEGER NOT NULL,
+				days INTEGER NOT NULL,
+				last_day TEXT,
+				PRIMARY KEY (user_id, hour))''')
+	return DBClient.rebuild_histograms
+
+
+def _migrate_v6_compact_observations(db_client, c):
+	# compact layout: an epoch row per observation and a 2-bit state (is_online * 2 + using_mobile) per user.
+	# Keyed by epoch: writes and compaction are cheap, per-user reads are served by histograms
+	c.execute('''CREATE TABLE IF NOT EXISTS observation_epochs
+				(epoch_id INTEGER PRIMARY KEY,
+				timing INTEGER NOT NULL)''')
+	c.execute("CREATE INDEX IF NOT EXISTS observation_epochs_timing ON observation_epochs (timing)")
+	c.execute('''CREATE TABLE IF NOT EXISTS online_states
+				(epoch_id INTEGER NOT NULL REFERENCES observation_epochs(epoch_id),
+				user_id INTEGER NOT NULL,
+				state INTEGER NOT NULL,
+				PRIMARY KEY (epoch_id, user_id)) WITHOUT ROWID''')
+	# both layouts as one relation of raw observations
+	c.execute('''CREATE VIEW IF NOT EXISTS online_observations AS
+				SELECT user_id, is_online, using_mobile, timing FROM online_stats
+				UNION ALL
+				SELECT user_id, state / 2, state % 2, timing FROM online_states JOIN observation_epochs
+				ON online_states.epoch_id = observation_epochs.epoch_id''')
+
+
+def local_hour_start(timing):
+	"""
+	Observations are bucketed by hours of local time: a zone may be off UTC by a fraction of an hour
+	:return: UTC timestamp of the beginning of the local hour of a UTC timestamp
+	"""
+	return timing - calendar.timegm(time.localtime(timing)) % 3600
+
+
+def local_day_and_hour(timing):
+	"""
+	:return: ("YYYY-MM-DD", hour) of the local time of a UTC timestamp: the histogram bucket of an observation
+	"""
+	local_time = time.localtime(timing)
+	return time.strftime("%Y-%m-%d", local_time), local_time.tm_hour
+
+
+class StorageEvents(object):
+	"""
+	In-process notifications about changes of the storage, so a node is woken up by changes of the other one instead
+	of polling for them. Callbacks are called on the thread which made the change: keep them short
+	"""
+	MESSAGES_ADDED = "messages_added"  # new messages waiting for delivery into the platform
+	PIPES_CHANGED = "pipes_changed"
+
+	def __init__(self):
+		self.logger = logging.getLogger(__name__)
+		self.listeners = {}  # (event, platform) -> list of callbacks
+		self.listeners_mx = threading.Lock()
+
+	def subscribe(self, event, platform, callback):
+		with self.listeners_mx:
+			self.listeners.setdefault((event, platform), []).append(callback)
+
+	def unsubscribe(self, event, platform, callback):
+		with self.listeners_mx:
+			callbacks = self.listeners.get((event, platform), [])
+			if callback in callbacks:
+				callbacks.remove(callback)
+
+	def publish(self, event, platform=None):
+		"""
+		:param platform: the platform concerned, None for all of them
+		"""
+		with self.listeners_mx:
+			callbacks = [callback for (event_, platform_), callbacks_ in self.listeners.iteritems()
+					if event_ == event and platform in (None, platform_) for callback in callbacks_]
+		for callback in callbacks:
+			try:
+				callback()
+			except BaseException as e:
+				self.logger.exception("StorageEvents: %s listener failed. Reason: %s", event, e.message)
+
+
+class Storage(object):
+	"""
+	The storage interface of a node. It is what nodes and handlers rely on, bulk-oriented where it matters.
+	Every implementation is bound to a platform ('vk' or 'tg') and must be thread-safe: a node, its helper threads
+	and the other node use the same data
+	"""
 	SUPPORTED_PLATFORMS = ["vk", "tg"]
+	# shared by every storage of the process: nodes subscribe to changes made through the storage of the other one
+	events = StorageEvents()
+	RAW_OBSERVATIONS_MAX_AGE = dt.timedelta(days=30)
+	# a numpy dtype spec: numpy is imported by the statistics methods, not along with the storage
+	OBSERVATION_DTYPE = [('timing', 'datetime64[s]'), ('is_online', '?'), ('using_mobile', '?')]
+
+	def fetch_users(self):
+		"""
+		:return: `UserRegistry` of users of the current platform
+		"""
+		raise NotImplementedError()
+
+	def update_user(self, users, is_new_ones=False):
+		"""
+		Stores a `User` or a list of them, inserts if `is_new_ones`
+		"""
+		raise NotImplementedError()
+
+	def add_msg(self, msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date):
+		self.add_msgs([(msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date)])
+
+	def add_msgs(self, rows):
+		"""
+		Stores messages received by the current platform and publishes MESSAGES_ADDED for the other one
+		:param rows: list of (msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date)
+		"""
+		raise NotImplementedError()
+
+	def fetch_unsync_messages(self, do_update=True):
+		"""
+		A generator of dicts (date, sender_name, username, content, <platform>_chat_id, internal_id, pipe_id) of
+		messages waiting for delivery into the current platform. A consumer acknowledges a delivered row by setting
+		`row_dict['sent']`. Delivery is at-least-once
+		"""
+		raise NotImplementedError()
+
+	def ack_messages(self, row_dicts):
+		"""
+		Marks rows of `fetch_unsync_messages` as delivered at once
+		:return: number of acknowledged rows
+		"""
+		raise NotImplementedError()
+
+	def get_monitored_chats(self):
+		"""
+		:return: list of chat ids of the current platform with an active pipe
+		"""
+		raise NotImplementedError()
+
+	def set_pending_chat(self, tg_chat_id, vk_chat_id, code):
+		"""
+		Registers a pipe waiting for confirmation by `code`. Raises UserWarning("UNIQUE") if the pipe exists.
+		Changes of pipes publish PIPES_CHANGED for both platforms
+		"""
+		raise NotImplementedError()
+
+	def get_pending_chat_ids(self):
+		"""
+		:return: dict of chat id of the current platform to activation code of a pending pipe
+		"""
+		raise NotImplementedError()
+
+	def remove_pipe(self, tg_chat_id):
+		raise NotImplementedError()
+
+	def check_pending_chats(self, code):
+		"""
+		A generator of dicts (id, tg_chat_id, vk_chat_id) of pipes pending for `code`. A consumer activates a pipe by
+		setting `row_dict['confirmed']`, other pipes of its telegram chat are removed
+		"""
+		raise NotImplementedError()
+
+	def append_users_observations(self, users_to_state_d, timing=None):
+		"""
+		Stores an observation epoch: dict of `User` to (is_online, using_mobile) at the moment `timing` (unix time,
+		now by default)
+		"""
+		raise NotImplementedError()
+
+	def get_latest_observation_time(self):
+		"""
+		:return: unix time of the latest observation epoch, None if there were none. Statistics do not change until
+			it does
+		"""
+		raise NotImplementedError()
+
+	def get_user_histogram(self, user):
+		"""
+		:return: numpy array of 24 rows (hours of local time) with columns (samples, online, mobile, distinct days)
+		"""
+		raise NotImplementedError()
+
+	def get_user_statistics(self, user):
+		"""
+		:return: numpy structured array of OBSERVATION_DTYPE for a given user, ordered by timing
+		"""
+		raise NotImplementedError()
+
+	def compact_observations(self, max_age=None):
+		"""
+		Rolls observations older than `max_age` up into hourly aggregates, the history stays available
+		:return: number of compacted observations
+		"""
+		raise NotImplementedError()
+
+	def close(self):
+		pass
+
+
+class DBClient(Storage):
+	DB_NAME = 'pipe_data.db'
+	BASE_SCHEMA_VERSION = 1
+	# (target version, migration function). Keep it sorted, never edit applied migrations -- append new ones
+	MIGRATIONS = [
+		(2, _migrate_v2_indexes),
+		(3, _migrate_v3_delivery_cursors),
+		(4, _migrate_v4_observations_rollup),
+		(5, _migrate_v5_histograms),
+		(6, _migrate_v6_compact_observations),
+	]
+	SCHEMA_VERSION = MIGRATIONS[-1][0]
+	FETCH_PAGE_SIZE = 100
+	COMPACTION_WINDOW_HOURS = 24
+	# write new observations in the compact layout (epoch row + packed per-user states) instead of online_stats
+	COMPACT_OBSERVATIONS = False
+	ACK_BATCH_SIZE = 50
+	ACK_BATCH_SECONDS = 2
+	# WAL lets the pipe read while another node writes; NORMAL sync is still consistent in WAL mode, the last
+	# transactions could be lost on power failure only, that is covered by at-least-once delivery
+	JOURNAL_MODE = "WAL"
+	SYNCHRONOUS = "NORMAL"
+	BUSY_TIMEOUT_MS = 5000
+	CACHED_STATEMENTS = 256
 
 	def __init__(self, bot_platform):
 		assert bot_platform in self.SUPPORTED_PLATFORMS, "Unsupported platform"
@@ -22,10 +285,45 @@ class DBClient(object):
 		self.logger = logging.getLogger(__name__ + "(" +self.__platform + ")")
 		have_saved_data = os.path.isfile(self.DB_NAME)
 		self.logger.info("Connecting to %s ...", DBClient.DB_NAME)
-		self.conn = sqlite3.connect(DBClient.DB_NAME)
+		self.__local = threading.local()
+		self.__connections = []
+		self.__connections_mx = threading.Lock()
 		if not have_saved_data:
 			self.logger.info("%s doesn't exist. Creating new one ...", self.DB_NAME)
 			self.create_fresh_db()
+		self.migrate()
+
+	@property
+	def conn(self):
+		"""
+		A connection of the current thread. Every thread gets its own one, so nodes, their handlers and helper
+		threads never share a connection (and its transaction)
+		"""
+		conn = getattr(self.__local, "conn", None)
+		if conn is None:
+			conn = self._connect()
+			self.__local.conn = conn
+			with self.__connections_mx:
+				self.__connections.append(conn)
+		return conn
+
+	def _connect(self):
+		# sqlite3 keeps compiled statements in a per-connection cache keyed by sql text. All queries here are built
+		# from constant pieces, so every one of them is prepared once per connection
+		conn = sqlite3.connect(self.DB_NAME, timeout=self.BUSY_TIMEOUT_MS / 1000.,
+				cached_statements=self.CACHED_STATEMENTS, check_same_thread=False)
+		# takes effect on a new file only, before anything is written to it; an existing db is switched by `vacuum`
+		conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+		journal_mode = conn.execute("PRAGMA journal_mode = " + self.JOURNAL_MODE).fetchone()[0]
+		if journal_mode.upper() != self.JOURNAL_MODE.upper():
+			self.logger.warning("Cannot switch %s to %s journal mode. Current one: %s", self.DB_NAME,
+					self.JOURNAL_MODE, journal_mode)
+		conn.execute("PRAGMA synchronous = " + self.SYNCHRONOUS)
+		conn.execute("PRAGMA busy_timeout = %d" % self.BUSY_TIMEOUT_MS)
+		conn.create_function("local_hour_start", 1, local_hour_start)
+		conn.create_function("local_day", 1, lambda timing: local_day_and_hour(timing)[0])
+		conn.create_function("local_hour", 1, lambda timing: local_day_and_hour(timing)[1])
+		return conn
 
 	def create_fresh_db(self):
 		c = self.conn.cursor()
@@ -79,6 +377,45 @@ class DBClient(object):
 		self.conn.commit()
 		self.logger.info("Brand new tables were created")
 
+	def get_schema_version(self):
+		"""
+		:return: schema version of the db. A db without version info is considered as a base one
+		"""
+		c = self.conn.cursor()
+		c.execute("CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL)")
+		c.execute("SELECT MAX(version) FROM schema_version")
+		version = c.fetchone()[0]
+		if version is None:
+			version = self.BASE_SCHEMA_VERSION
+			c.execute("INSERT INTO schema_version VALUES (?)", (version,))
+			self.conn.commit()
+		return version
+
+	def migrate(self):
+		"""
+		Upgrades an existing db in place up to SCHEMA_VERSION. Every migration must be idempotent: both nodes
+		could start migrating the same file simultaneously.
+		A migration may return a DBClient method to call once the schema is up to date, e.g. to fill a new table
+		"""
+		version = self.get_schema_version()
+		if version > self.SCHEMA_VERSION:
+			raise UserWarning("db schema version {0} is newer than supported {1}".format(version,
+					self.SCHEMA_VERSION))
+		c = self.conn.cursor()
+		post_migration_steps = []
+		for target_version, migration in self.MIGRATIONS:
+			if target_version <= version:
+				continue
+			self.logger.info("Migrating %s from schema version %d to %d ...", self.DB_NAME, version, target_version)
+			post_migration_step = migration(self, c)
+			if post_migration_step is not None and post_migration_step not in post_migration_steps:
+				post_migration_steps.append(post_migration_step)
+			c.execute("UPDATE schema_version SET version = ? WHERE version < ?", (target_version, target_version))
+			self.conn.commit()
+			version = target_version
+		for post_migration_step in post_migration_steps:
+			post_migration_step(self)
+
 	def update_user(self, users, is_new_ones=False):
 		if not users:
 			return
@@ -95,15 +432,15 @@ class DBClient(object):
 						 user.username, user.serialized_keys()))
 			else:
 				c.execute('''UPDATE users SET name = ?, last_contact_date = ?, want_time = ?, mute_dialog = ?,
-				          other_keys = ?  WHERE user_id = ? AND platform = ?''',
-						(user.name, user.last_seen, user.want_time, user.muted, user.serialized_keys(),
-						user.id, self.__platform))
+				          username = ?, other_keys = ?  WHERE user_id = ? AND platform = ?''',
+						(user.name, user.last_seen, user.want_time, user.muted, user.username,
+						user.serialized_keys(), user.id, self.__platform))
 		self.conn.commit()
 		self.logger.info("%d users were flushed to db", len(users))
 
 	def fetch_users(self):
 		c = self.conn.cursor()
-		users = {}
+		users = UserRegistry()
 		for row in c.execute("SELECT * FROM users WHERE platform = ?", (self.__platform,)):
 			id = int(row[0])
 			name = row[1]
@@ -112,40 +449,145 @@ class DBClient(object):
 			muted = bool(row[4])
 			username = row[6]
 			json_keys = row[7]
-			users[id] = User(id, name, last_seen, want_time, muted, username, json_keys)
-			users[id].dirty = False
+			user = User(id, name, last_seen, want_time, muted, username, json_keys)
+			user.dirty = False
+			users.add(user)
 		return users
 
-	def add_msg(self, msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date):
+	def add_msgs(self, rows):
+		"""
+		Stores messages of the current platform within a single transaction
+		:param rows: list of (msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date)
+		"""
+		if not rows:
+			return
 		chat_id_placeholder = "?, NULL" if self.__platform == 'tg' else "NULL, ?"
 		c = self.conn.cursor()
-		c.execute("INSERT INTO messages VALUES (NULL, ?, " + chat_id_placeholder + ", ?, ?, ?, ?, ?, ?)",
-				(msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date))
-
+		c.executemany("INSERT INTO messages VALUES (NULL, ?, " + chat_id_placeholder + ", ?, ?, ?, ?, ?, ?)", rows)
 		self.conn.commit()
+		self.events.publish(StorageEvents.MESSAGES_ADDED, "vk" if self.__platform == "tg" else "tg")
 
 	def fetch_unsync_messages(self, do_update=True):
-		# a generator
+		"""
+		A generator of messages waiting for delivery into the current platform. Rows are streamed pipe by pipe in
+		pages of FETCH_PAGE_SIZE starting right after the delivery cursor of the pipe, so neither memory nor query cost
+		depend on a backlog which was already delivered.
+		A consumer acknowledges a delivered row by setting `row_dict['sent']`. Acknowledgements are applied in a single
+		transaction once ACK_BATCH_SIZE of them are collected, ACK_BATCH_SECONDS passed since the oldest one, or
+		the iteration is over (exhausted, interrupted by `break` or the generator is closed).
+		Delivery is at-least-once: acknowledgements which were not flushed before a crash are lost, so those messages
+		are delivered once again after a restart. A message is never dropped without an acknowledgement.
+		"""
+		curr_chat_id = self.__platform + "_chat_id"
+		other_chat_id = ("vk" if self.__platform == "tg" else "tg") + "_chat_id"
+
+		yielded = []
+		first_ack_time = None
+		try:
+			for pipe_id, curr_chat, other_chat in self._get_active_pipes():
+				last_internal_id = self._get_delivery_cursor(pipe_id, other_chat)
+				while True:
+					c = self.conn.cursor()
+					c.execute("SELECT date, sender_name, username, content, internal_id FROM messages" +
+							" WHERE " + other_chat_id + " = ? AND " + curr_chat_id + " IS NULL AND internal_id > ?" +
+							" ORDER BY internal_id LIMIT ?", (other_chat, last_internal_id, self.FETCH_PAGE_SIZE))
+					rows = c.fetchall()
+					for row in rows:
+						row_dict = {"date": row[0], "sender_name": row[1], "username": row[2],
+									"content": row[3], curr_chat_id: curr_chat, "internal_id": row[4],
+									"pipe_id": pipe_id}
+						if do_update:
+							yielded.append(row_dict)
+						yield row_dict
+						if not do_update:
+							continue
+						if first_ack_time is None and "sent" in row_dict:
+							first_ack_time = time.time()
+						if len(yielded) >= self.ACK_BATCH_SIZE or (first_ack_time is not None and
+								time.time() - first_ack_time > self.ACK_BATCH_SECONDS):
+							self.ack_messages([yielded_row for yielded_row in yielded if "sent" in yielded_row])
+							yielded = []
+							first_ack_time = None
+					if len(rows) < self.FETCH_PAGE_SIZE:
+						break
+					last_internal_id = rows[-1][4]
+		finally:
+			if yielded:
+				self.ack_messages([yielded_row for yielded_row in yielded if "sent" in yielded_row])
 
+	def _get_active_pipes(self):
+		"""
+		:return: list of (pipe id, chat id of the current platform, chat id of the other one)
+		"""
+		other_platform = "vk" if self.__platform == "tg" else "tg"
+		c = self.conn.cursor()
+		c.execute("SELECT id, " + self.__platform + "_chat_id, " + other_platform + "_chat_id FROM msg_pipe"
+				" WHERE is_active = 1")
+		return c.fetchall()
+
+	def _get_delivery_cursor(self, pipe_id, other_chat):
+		"""
+		A delivery cursor is a high-watermark of a pipe in the direction of the current platform: every message
+		of the pipe with internal_id <= cursor is delivered
+		"""
 		curr_chat_id = self.__platform + "_chat_id"
 		other_chat_id = ("vk" if self.__platform == "tg" else "tg") + "_chat_id"
+		c = self.conn.cursor()
+		c.execute("SELECT last_internal_id FROM delivery_cursors WHERE pipe_id = ? AND platform = ?",
+				(pipe_id, self.__platform))
+		row = c.fetchone()
+		if row is not None:
+			return row[0]
 
+		# a new pipe or an upgraded db: start right before the oldest undelivered message
+		c.execute("SELECT MIN(internal_id) FROM messages WHERE " + other_chat_id + " = ? AND " + curr_chat_id +
+				" IS NULL", (other_chat,))
+		first_unsync_id = c.fetchone()[0]
+		if first_unsync_id is None:
+			c.execute("SELECT MAX(internal_id) FROM messages")
+			first_unsync_id = (c.fetchone()[0] or 0) + 1
+		try:
+			c.execute("INSERT INTO delivery_cursors VALUES (?, ?, ?)", (pipe_id, self.__platform, first_unsync_id - 1))
+			self.conn.commit()
+		except sqlite3.IntegrityError:
+			# the other thread was first
+			self.conn.rollback()
+			return self._get_delivery_cursor(pipe_id, other_chat)
+		return first_unsync_id - 1
+
+	def ack_messages(self, row_dicts):
+		"""
+		Marks rows of `fetch_unsync_messages` as delivered and moves delivery cursors of their pipes in a single
+		transaction
+		:return: number of acknowledged rows
+		"""
+		if not row_dicts:
+			return 0
+		curr_chat_id = self.__platform + "_chat_id"
+		other_chat_id = ("vk" if self.__platform == "tg" else "tg") + "_chat_id"
 		c = self.conn.cursor()
-		c.execute("SELECT date, sender_name, username, content, msg_pipe." + curr_chat_id + ", internal_id" +
-					" FROM messages " +
-					"JOIN msg_pipe ON messages." + other_chat_id + " = msg_pipe." + other_chat_id +
-					" WHERE messages." + curr_chat_id + " is NULL")
+		c.executemany("UPDATE messages SET " + curr_chat_id + " = ? WHERE internal_id = ? ",
+				[(row_dict[curr_chat_id], row_dict["internal_id"]) for row_dict in row_dicts])
 
-		rows = c.fetchall()
-		for row in rows:
-			row_dict = {"date": row[0], "sender_name": row[1], "username": row[2],
-						"content": row[3], curr_chat_id: row[4]}
-			yield row_dict
-			if do_update and "sent" in row_dict:
-				internal_msg_id = row[5]
-				c.execute("UPDATE messages SET " + curr_chat_id + " = ? WHERE internal_id = ? ",
-						(row_dict[curr_chat_id], internal_msg_id))
-				self.conn.commit()
+		max_acked_ids = {}
+		for row_dict in row_dicts:
+			max_acked_ids[row_dict["pipe_id"]] = max(row_dict["internal_id"], max_acked_ids.get(row_dict["pipe_id"], 0))
+		for pipe_id, max_acked_id in max_acked_ids.iteritems():
+			# the cursor stops right before the oldest message which is still waiting for delivery
+			c.execute("SELECT last_internal_id, (SELECT MIN(internal_id) FROM messages WHERE " + other_chat_id +
+					" = msg_pipe." + other_chat_id + " AND " + curr_chat_id + " IS NULL AND internal_id > "
+					"last_internal_id) FROM delivery_cursors JOIN msg_pipe ON msg_pipe.id = delivery_cursors.pipe_id"
+					" WHERE pipe_id = ? AND platform = ?", (pipe_id, self.__platform))
+			row = c.fetchone()
+			if row is None:
+				continue
+			last_internal_id, first_unsync_id = row
+			new_cursor = max_acked_id if first_unsync_id is None else first_unsync_id - 1
+			if new_cursor > last_internal_id:
+				c.execute("UPDATE delivery_cursors SET last_internal_id = ? WHERE pipe_id = ? AND platform = ?",
+						(new_cursor, pipe_id, self.__platform))
+		self.conn.commit()
+		return len(row_dicts)
 
 	def get_monitored_chats(self):
 		c = self.conn.cursor()
@@ -163,6 +605,7 @@ class DBClient(object):
 			if ie.message.split()[0] == "UNIQUE":
 				raise UserWarning("UNIQUE")
 		self.conn.commit()
+		self.events.publish(StorageEvents.PIPES_CHANGED)
 
 	def get_pending_chat_ids(self):
 		c = self.conn.cursor()
@@ -175,8 +618,11 @@ class DBClient(object):
 
 	def remove_pipe(self, tg_chat_id):
 		c = self.conn.cursor()
+		c.execute("DELETE FROM delivery_cursors WHERE pipe_id IN (SELECT id FROM msg_pipe WHERE tg_chat_id = ?)",
+				(tg_chat_id,))
 		c.execute("DELETE FROM msg_pipe WHERE tg_chat_id = ?", (tg_chat_id,))
 		self.conn.commit()
+		self.events.publish(StorageEvents.PIPES_CHANGED)
 
 	def check_pending_chats(self, code):
 		assert isinstance(code, str) or isinstance(code, unicode), "activation code must be a string"
@@ -189,68 +635,567 @@ class DBClient(object):
 			yield  row_dict
 			if "confirmed" in row_dict:
 				c.execute("UPDATE msg_pipe SET is_active = 1 WHERE id = ?", (int(row_dict['id']),))
+				c.execute("DELETE FROM delivery_cursors WHERE pipe_id IN "
+						"(SELECT id FROM msg_pipe WHERE tg_chat_id = ? AND id != ?)",
+						(int(row_dict['tg_chat_id']), int(row_dict['id'])))
 				c.execute("DELETE FROM msg_pipe WHERE tg_chat_id = ? AND id != ?",
 						(int(row_dict['tg_chat_id']), int(row_dict['id'])))
 				self.conn.commit()
+				self.events.publish(StorageEvents.PIPES_CHANGED)
 				break
 
-	def append_users_observations(self, users_to_state_d):
-		current_ts = calendar.timegm(time.gmtime())
+	def append_users_observations(self, users_to_state_d, timing=None):
+		"""
+		Stores an observation epoch: states of all the given users at the moment `timing` (now by default), within
+		a single transaction
+		"""
+		current_ts = calendar.timegm(time.gmtime()) if timing is None else timing
+		observations = [(user.id, bool(is_online), bool(using_mobile))
+				for user, (is_online, using_mobile) in users_to_state_d.iteritems()]
+		if not observations:
+			return
+		c = self.conn.cursor()
+		if self.COMPACT_OBSERVATIONS:
+			c.execute("INSERT INTO observation_epochs VALUES (NULL, ?)", (current_ts,))
+			epoch_id = c.lastrowid
+			c.executemany("INSERT INTO online_states VALUES (?, ?, ?)", [(epoch_id, user_id, is_online * 2 + using_mobile)
+					for user_id, is_online, using_mobile in observations])
+		else:
+			c.executemany("INSERT INTO online_stats VALUES (?, ?, ?, ?)", [(user_id, is_online, using_mobile, current_ts)
+					for user_id, is_online, using_mobile in observations])
+		self._update_histograms(c, current_ts, observations)
+		self.conn.commit()
+
+	def _update_histograms(self, c, timing, observations):
+		"""
+		Adds an observation epoch to hourly histograms in the current transaction. Epochs come in time order, so
+		a distinct day is the one which differs from the last seen day of the bucket
+		:param observations: list of (user_id, is_online, using_mobile)
+		"""
+		day, hour = local_day_and_hour(timing)
+		c.executemany("INSERT OR IGNORE INTO online_stats_histogram VALUES (?, ?, 0, 0, 0, 0, NULL)",
+				[(user_id, hour) for user_id, _, _ in observations])
+		c.executemany("UPDATE online_stats_histogram SET samples = samples + 1, online = online + ?,"
+				" mobile = mobile + ?, days = days + (CASE WHEN last_day = ? THEN 0 ELSE 1 END), last_day = ?"
+				" WHERE user_id = ? AND hour = ?",
+				[(int(bool(is_online)), int(bool(using_mobile)), day, day, user_id, hour)
+				for user_id, is_online, using_mobile in observations])
+
+	def _compute_histograms(self, c, user_id=None):
+		"""
+		Builds hourly histograms from scratch out of raw and rolled up observations, bucketed the same way as
+		`_update_histograms` does
+		:return: list of (user_id, hour, samples, online, mobile, days, last_day)
+		"""
+		user_filter = "" if user_id is None else " WHERE user_id = ?"
+		c.execute("SELECT user_id, hour, SUM(samples), SUM(online), SUM(mobile), COUNT(DISTINCT day), MAX(day) FROM"
+				" (SELECT user_id, local_hour(timing) AS hour, local_day(timing) AS day, 1 AS samples,"
+				" is_online AS online, using_mobile AS mobile FROM online_observations" + user_filter +
+				" UNION ALL SELECT user_id, local_hour(hour_timing), local_day(hour_timing), samples, online, mobile"
+				" FROM online_stats_hourly" + user_filter + ") GROUP BY user_id, hour", () if user_id is None else (user_id, user_id))
+		return c.fetchall()
+
+	def rebuild_histograms(self):
+		"""
+		Recomputes all hourly histograms out of raw and rolled up observations
+		:return: number of histogram buckets
+		"""
 		c = self.conn.cursor()
-		for user, (is_online, using_mobile) in users_to_state_d.iteritems():
-			c.execute("INSERT INTO online_stats VALUES (?, ?, ?, ?)", (user.id, is_online, using_mobile, current_ts))
+		buckets = self._compute_histograms(c)
+		c.execute("DELETE FROM online_stats_histogram")
+		c.executemany("INSERT INTO online_stats_histogram VALUES (?, ?, ?, ?, ?, ?, ?)", buckets)
 		self.conn.commit()
+		self.logger.info("%d histogram buckets were rebuilt", len(buckets))
+		return len(buckets)
+
+	def check_histograms(self):
+		"""
+		Compares maintained hourly histograms against raw and rolled up observations
+		:return: list of (user_id, hour, expected bucket, actual bucket) for every inconsistent bucket
+		"""
+		c = self.conn.cursor()
+		expected = dict(((row[0], row[1]), tuple(row[2:6])) for row in self._compute_histograms(c))
+		c.execute("SELECT user_id, hour, samples, online, mobile, days FROM online_stats_histogram")
+		actual = dict(((row[0], row[1]), tuple(row[2:])) for row in c.fetchall())
+		return [(user_id, hour, expected.get((user_id, hour)), actual.get((user_id, hour)))
+				for user_id, hour in sorted(set(expected.keys()) | set(actual.keys()))
+				if expected.get((user_id, hour)) != actual.get((user_id, hour))]
+
+	def get_user_histogram(self, user):
+		"""
+		:return: numpy array of 24 rows (hours of local time) with columns (samples, online, mobile, distinct days)
+		"""
+		import numpy as np
+		assert isinstance(user, User)
+		histogram = np.zeros((24, 4), dtype=np.int64)
+		c = self.conn.cursor()
+		c.execute("SELECT hour, samples, online, mobile, days FROM online_stats_histogram WHERE user_id = ?",
+				(user.id,))
+		for row in c.fetchall():
+			histogram[row[0]] = row[1:]
+		return histogram
+
+	def compact_observations(self, max_age=None):
+		"""
+		Rolls raw observations older than `max_age` up into per-user aggregates per local hour (number of samples,
+		online and mobile ones), deletes the raw rows and gives freed pages back to the file system.
+		Works window by window, so neither memory nor lock time depend on the size of the backlog
+		:return: number of compacted raw observations
+		"""
+		if max_age is None:
+			max_age = self.RAW_OBSERVATIONS_MAX_AGE
+		hour_seconds = 60 * 60
+		# whole local hours only, so an aggregate is never split between two runs
+		cutoff = local_hour_start(calendar.timegm(time.gmtime()) - int(max_age.total_seconds()))
+		c = self.conn.cursor()
+		next_window_sql = "SELECT MIN(timing) FROM (SELECT MIN(timing) AS timing FROM online_stats WHERE timing >= ?" \
+				" UNION ALL SELECT MIN(timing) FROM observation_epochs WHERE timing >= ?)"
+		c.execute(next_window_sql, (0, 0))
+		window_start = c.fetchone()[0]
+		compacted = 0
+		while window_start is not None and window_start < cutoff:
+			window_start = local_hour_start(window_start)
+			window_end = min(cutoff, window_start + self.COMPACTION_WINDOW_HOURS * hour_seconds)
+			c.execute("SELECT user_id, local_hour_start(timing) AS hour_timing, COUNT(*), SUM(is_online),"
+					" SUM(using_mobile) FROM online_observations WHERE timing >= ? AND timing < ?"
+					" GROUP BY user_id, hour_timing", (window_start, window_end))
+			aggregates = c.fetchall()
+			c.executemany("INSERT OR IGNORE INTO online_stats_hourly VALUES (?, ?, 0, 0, 0)",
+					[(user_id, hour_timing) for user_id, hour_timing, _, _, _ in aggregates])
+			c.executemany("UPDATE online_stats_hourly SET samples = samples + ?, online = online + ?,"
+					" mobile = mobile + ? WHERE user_id = ? AND hour_timing = ?",
+					[(samples, online, mobile, user_id, hour_timing)
+					for user_id, hour_timing, samples, online, mobile in aggregates])
+			c.execute("DELETE FROM online_stats WHERE timing >= ? AND timing < ?", (window_start, window_end))
+			compacted += c.rowcount
+			c.execute("DELETE FROM online_states WHERE epoch_id IN (SELECT epoch_id FROM observation_epochs"
+					" WHERE timing >= ? AND timing < ?)", (window_start, window_end))
+			compacted += c.rowcount
+			c.execute("DELETE FROM observation_epochs WHERE timing >= ? AND timing < ?", (window_start, window_end))
+			self.conn.commit()
+			c.execute(next_window_sql, (window_end, window_end))
+			window_start = c.fetchone()[0]
+		if compacted:
+			c.execute("PRAGMA incremental_vacuum")
+			c.fetchall()
+			self.logger.info("%d raw observations older than %s were rolled up", compacted, str(max_age))
+		return compacted
+
+	def vacuum(self):
+		"""
+		Rewrites the db file, switching it to incremental auto vacuum. Holds the exclusive lock until done: run it
+		while the nodes are stopped
+		"""
+		self.conn.commit()
+		c = self.conn.cursor()
+		c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+		start_time = time.time()
+		c.execute("VACUUM")
+		self.logger.info("%s was vacuumed within %.1f seconds", self.DB_NAME, time.time() - start_time)
+
+	def get_latest_observation_time(self):
+		c = self.conn.cursor()
+		# both are index lookups
+		c.execute("SELECT MAX(timing) FROM (SELECT MAX(timing) AS timing FROM online_stats"
+				" UNION ALL SELECT MAX(timing) FROM observation_epochs)")
+		return c.fetchone()[0]
 
 	def get_user_statistics(self, user):
 		"""
-		:return: numpy.matrix with columns (dt.datetime, is_online, using_mobile) for a given user
+		:return: numpy structured array of OBSERVATION_DTYPE (timing as UTC datetime64, is_online, using_mobile)
+			for a given user, ordered by timing
 		"""
+		import numpy as np
 		assert isinstance(user, User)
 		c = self.conn.cursor()
-		c.execute("SELECT timing, is_online, using_mobile FROM online_stats WHERE user_id = ?", (user.id,))
-		rows = c.fetchall()
+		# raw and rolled up rows are read from a single snapshot: a concurrent compaction moves rows between them
+		self.conn.commit()
+		c.execute("BEGIN")
+		try:
+			c.execute("SELECT COUNT(*) FROM online_observations WHERE user_id = ?", (user.id,))
+			raw_count = c.fetchone()[0]
+			# a row is packed into a single integer: python objects are created per value, so it is 3x less of them
+			c.execute("SELECT timing * 4 + is_online * 2 + using_mobile FROM online_observations WHERE user_id = ?"
+					" ORDER BY timing", (user.id,))
+			raw = np.fromiter(itertools.chain.from_iterable(c), dtype=np.int64, count=raw_count)
+			c.execute("SELECT hour_timing, samples, online, mobile FROM online_stats_hourly WHERE user_id = ?"
+					" ORDER BY hour_timing", (user.id,))
+			hourly = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 4)
+		finally:
+			self.conn.rollback()
+
+		# rolled up history is expanded back into samples stamped with the beginning of their hour. It gives the same
+		# hourly distribution and distinct days as raw observations. Mobile samples go online first; counts of an
+		# aggregate are clamped, so an inconsistent one (more mobile than online samples) cannot break the expansion
+		samples = hourly[:, 1]
+		online = np.minimum(hourly[:, 2], samples)
+		online_mobile = np.minimum(hourly[:, 3], online)
+		offline_mobile = np.clip(hourly[:, 3] - online_mobile, 0, samples - online)
+		state_counts = np.column_stack((online_mobile, online - online_mobile, offline_mobile,
+				samples - online - offline_mobile)).ravel()
+		expanded_timing = np.repeat(np.repeat(hourly[:, 0], 4), state_counts)
+		expanded_online = np.repeat(np.tile([True, True, False, False], len(hourly)), state_counts)
+		expanded_mobile = np.repeat(np.tile([True, False, True, False], len(hourly)), state_counts)
+
+		stats = np.empty(len(expanded_timing) + raw_count, dtype=self.OBSERVATION_DTYPE)
+		stats['timing'] = np.concatenate((expanded_timing, raw >> 2)).astype('datetime64[s]')
+		stats['is_online'] = np.concatenate((expanded_online, raw & 2 != 0))
+		stats['using_mobile'] = np.concatenate((expanded_mobile, raw & 1 != 0))
+		return stats
+
+	def close(self):
+		with self.__connections_mx:
+			for conn in self.__connections:
+				conn.close()
+			self.__connections = []
+		self.__local = threading.local()
+		self.logger.info("Connections to %s closed", self.DB_NAME)
+
+
+class MessageIngestBuffer(object):
+	"""
+	Write-behind buffer of incoming chat messages. `put` returns as soon as a message is queued; a flusher thread
+	stores queued messages within a single transaction once `max_rows` of them are queued or the oldest one waits
+	for `max_delay_ms`. A failed flush keeps messages queued and is retried.
+	`close` flushes everything, so a clean shutdown never loses an accepted message
+	"""
+	def __init__(self, db_client, max_rows=100, max_delay_ms=200):
+		self.logger = logging.getLogger(__name__)
+		self.db_client = db_client
+		self.max_rows = max_rows
+		self.max_delay = max_delay_ms / 1000.
+		self.rows = []
+		self.oldest_put_time = None
+		self.closed = False
+		self.cv = threading.Condition()
+		self.flushes = 0
+		self.flushed_rows = 0
+		self.max_batch_size = 0
+		self.total_flush_latency = 0.
+		self.max_flush_latency = 0.
+		self.flusher_thread = threading.Thread(target=self._flusher)
+		self.flusher_thread.daemon = True
+		self.flusher_thread.start()
+
+	def put(self, msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date):
+		with self.cv:
+			if self.closed:
+				raise UserWarning("The buffer is closed")
+			self.rows.append((msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date))
+			if self.oldest_put_time is None:
+				# the flusher sleeps without a timeout while the buffer is empty
+				self.oldest_put_time = time.time()
+				self.cv.notify()
+			elif len(self.rows) >= self.max_rows:
+				self.cv.notify()
+
+	def _flusher(self):
+		while True:
+			with self.cv:
+				while not self.closed and (not self.rows or (len(self.rows) < self.max_rows and
+						time.time() < self.oldest_put_time + self.max_delay)):
+					self.cv.wait(None if not self.rows else self.oldest_put_time + self.max_delay - time.time())
+				if self.closed:
+					return
+			if not self.flush():
+				time.sleep(self.max_delay)
+
+	def flush(self):
+		"""
+		:return: False if there are messages which were not stored
+		"""
+		with self.cv:
+			rows = self.rows
+			oldest_put_time = self.oldest_put_time
+			self.rows = []
+			self.oldest_put_time = None
 		if not rows:
-			return np.matrix([])
-		cast_to_datetime = lambda tup: [dt.datetime.fromtimestamp(tup[0]), tup[1], tup[2]]
-		return np.apply_along_axis(cast_to_datetime, 1,  np.matrix(rows))
+			return True
+		try:
+			self.db_client.add_msgs(rows)
+		except BaseException as e:
+			self.logger.exception("MessageIngestBuffer: cannot flush %d messages. Reason: %s", len(rows), e.message)
+			with self.cv:
+				self.rows = rows + self.rows
+				self.oldest_put_time = oldest_put_time
+			return False
+		latency = time.time() - oldest_put_time
+		with self.cv:
+			self.flushes += 1
+			self.flushed_rows += len(rows)
+			self.max_batch_size = max(self.max_batch_size, len(rows))
+			self.total_flush_latency += latency
+			self.max_flush_latency = max(self.max_flush_latency, latency)
+		return True
+
+	def get_counters(self):
+		"""
+		:return: dict of flushes, flushed messages, batch sizes and flush latencies (from put of the oldest message
+			of a batch to its commit)
+		"""
+		with self.cv:
+			flushes = max(self.flushes, 1)
+			return {"flushes": self.flushes, "messages": self.flushed_rows, "pending": len(self.rows),
+					"avg_batch_size": float(self.flushed_rows) / flushes, "max_batch_size": self.max_batch_size,
+					"avg_flush_latency_ms": self.total_flush_latency * 1000 / flushes,
+					"max_flush_latency_ms": self.max_flush_latency * 1000}
 
 	def close(self):
-		self.conn.close()
-		self.logger.info("Connection to %s closed", self.DB_NAME)
+		with self.cv:
+			self.closed = True
+			self.cv.notify()
+		self.flusher_thread.join()
+		attempts = 5
+		while not self.flush() and attempts > 0:
+			attempts -= 1
+			time.sleep(self.max_delay)
+		if self.rows:
+			self.logger.error("MessageIngestBuffer: %d messages were not stored", len(self.rows))
+		self.logger.info("MessageIngestBuffer closed. Counters: %s", str(self.get_counters()))
+
+
+def format_message(row_dict):
+	"""
+	:return: unicode text of a row of `fetch_unsync_messages` as it is delivered
+	"""
+	msg_time = dt.datetime.fromtimestamp(row_dict["date"]).strftime('%H:%M:%S')
+	return u"{0} ({1}), {2}: {3}".format(row_dict["sender_name"], row_dict["username"], msg_time,
+			row_dict["content"])
+
+
+def coalesce_messages(row_dicts, chat_key, max_length=None):
+	"""
+	Merges runs of consecutive rows bound for the same chat (`row_dict[chat_key]`) into a single text, a line per
+	row, of at most `max_length` characters. A row which is longer by itself goes alone, so does every row without
+	`max_length`. Order is kept
+	:return: generator of (list of row dicts, utf-8 text)
+	"""
+	rows = []
+	lines = []
+	length = 0
+	for row_dict in row_dicts:
+		line = format_message(row_dict)
+		if rows and (max_length is None or row_dict[chat_key] != rows[0][chat_key] or
+				length + 1 + len(line) > max_length):
+			yield rows, u"\n".join(lines).encode('utf-8')
+			rows = []
+			lines = []
+		length = length + 1 + len(line) if rows else len(line)
+		rows.append(row_dict)
+		lines.append(line)
+	if rows:
+		yield rows, u"\n".join(lines).encode('utf-8')
 
 
 class Handler(object):
+	# event-driven handlers are woken up by `wake`; they still run this often to catch up with changes made by other
+	# processes and to retry failures
+	FALLBACK_PERIOD = dt.timedelta(seconds=30)
+
 	def __init__(self, db_client=None, api=None):
 		self.period = None  # you must set this timedelta in inherited class or override is_time_to_go method
 		self.time_to_go = dt.datetime.now()
 		self.db_client = db_client
 		self.api = api
+		self.wake_requested = False
+		self.wakeup_event = None  # set by a Scheduler
+		self.next_delay = None
 
 	def handler_hook(self, **kwargs):
 		pass
 
+	def wake(self):
+		"""
+		Makes the handler due right away regardless of its period. Safe to call from any thread
+		"""
+		self.wake_requested = True
+		if self.wakeup_event is not None:
+			self.wakeup_event.set()
+
+	def run_again_in(self, delay):
+		"""
+		Replaces the period once. A hook calls it when it has more work than it is allowed to do per run
+		"""
+		self.next_delay = delay
+
 	def is_time_to_go(self, current_time):
 		assert not self.period is None, "You must set self.period value or override is_time_to_go method"
-		return current_time > self.time_to_go
+		return self.wake_requested or current_time > self.time_to_go
+
+	def seconds_to_go(self, current_time):
+		"""
+		:return: seconds until the handler is due, zero or less if it is. Override it along with is_time_to_go
+		"""
+		if self.wake_requested:
+			return 0
+		return (self.time_to_go - current_time).total_seconds()
 
 	def __call__(self, *args, **kwargs):
 		# Do not override this method. Use a hook
 		if self.is_time_to_go(dt.datetime.now()):
+			# a wake up during the hook makes it due once again
+			self.wake_requested = False
+			self.next_delay = None
 			result = self.handler_hook(**kwargs)
-			if self.period:
-				self.time_to_go = dt.datetime.now() + self.period
+			delay = self.next_delay if self.next_delay is not None else self.period
+			if delay is not None:
+				self.time_to_go = dt.datetime.now() + delay
 			return result
 
 
+class UnsyncDeliveryHandler(Handler):
+	"""
+	Delivers messages of the other node into the platform of its storage. Sends are asynchronous, the hook never
+	waits for them: finished ones are acknowledged on the next run, rows of a merged message together. A failed chat
+	is suspended alone and its later sends are taken back, so a chat gets its messages in order.
+	A platform supplies `submit_send` and, if it can take sends back, `take_back`
+	"""
+	CHAT_KEY = None  # destination chat column of fetched rows
+	MAX_IN_FLIGHT = 100  # sends
+	RETRY_DELAY = dt.timedelta(seconds=10)  # unsent messages of a chat go again in order
+	MAX_MESSAGE_LENGTH = 4096
+	SENDS_PER_CHAT = None  # in flight; None if sends queued after a failed one can be taken back
+
+	def __init__(self, db_client, api, coalesce=True):
+		"""
+		:param coalesce: whether consecutive messages for a chat are merged into a single send
+		"""
+		super(UnsyncDeliveryHandler, self).__init__(db_client, api)
+		self.period = self.FALLBACK_PERIOD  # woken up by messages of the other node and by finished sends
+		self.logger = logging.getLogger(__name__)
+		self.max_length = self.MAX_MESSAGE_LENGTH if coalesce else None
+		self.in_flight = {}  # internal id of the first row -> (row dicts, PendingCall)
+		self.chat_retry_times = {}  # chat id -> time its delivery is resumed at
+
+	def submit_send(self, chat_id, row_dicts, msg_text):
+		"""
+		:param msg_text: utf-8 text of the rows
+		:return: PendingCall of the send
+		"""
+		raise NotImplementedError()
+
+	def take_back(self, chat_id, calls):
+		"""
+		Called once a send to the chat has failed, with the sends to the chat which are still in flight
+		:return: list of calls which are taken back, they are never delivered
+		"""
+		return []
+
+	def failure_reason(self, error):
+		return error.message
+
+	def handler_hook(self, **kwargs):
+		now = dt.datetime.now()
+		sent_rows = []
+		failed_chats = set()
+		for internal_id, (row_dicts, call) in self.in_flight.items():
+			if not call.done():
+				continue
+			del self.in_flight[internal_id]
+			try:
+				call.result(0)
+				sent_rows.extend(row_dicts)
+			except BaseException as e:
+				chat_id = row_dicts[0][self.CHAT_KEY]
+				if chat_id not in failed_chats:
+					self.logger.error("%s: cannot deliver %d message(s) to chat %d. Reason: %s", type(self).__name__,
+							len(row_dicts), chat_id, self.failure_reason(e))
+				failed_chats.add(chat_id)
+		for chat_id in failed_chats:
+			self.chat_retry_times[chat_id] = now + self.RETRY_DELAY
+			chat_calls = dict((id(call), internal_id) for internal_id, (row_dicts, call) in self.in_flight.iteritems()
+					if row_dicts[0][self.CHAT_KEY] == chat_id)
+			still_sending = [self.in_flight[internal_id][1] for internal_id in chat_calls.itervalues()]
+			for call in self.take_back(chat_id, still_sending):
+				del self.in_flight[chat_calls[id(call)]]
+		self.db_client.ack_messages(sent_rows)
+
+		for chat_id, retry_time in self.chat_retry_times.items():
+			if retry_time <= now:
+				del self.chat_retry_times[chat_id]
+		if self.chat_retry_times:
+			self.run_again_in(min(self.chat_retry_times.values()) - now)
+
+		sending = set()
+		chat_sends = {}
+		for row_dicts, _ in self.in_flight.itervalues():
+			sending.update(row_dict["internal_id"] for row_dict in row_dicts)
+			chat_sends[row_dicts[0][self.CHAT_KEY]] = chat_sends.get(row_dicts[0][self.CHAT_KEY], 0) + 1
+		unsync_rows = (row_dict for row_dict in self.db_client.fetch_unsync_messages(do_update=False)
+				if row_dict["internal_id"] not in sending and row_dict[self.CHAT_KEY] not in self.chat_retry_times)
+		for row_dicts, msg_text in coalesce_messages(unsync_rows, self.CHAT_KEY, self.max_length):
+			if len(self.in_flight) >= self.MAX_IN_FLIGHT:
+				break
+			chat_id = row_dicts[0][self.CHAT_KEY]
+			if self.SENDS_PER_CHAT is not None and chat_sends.get(chat_id, 0) >= self.SENDS_PER_CHAT:
+				continue
+			chat_sends[chat_id] = chat_sends.get(chat_id, 0) + 1
+			self.logger.info("Sending %d unsync message(s) to chat %d: %s", len(row_dicts), chat_id,
+					str([row_dict["internal_id"] for row_dict in row_dicts]))
+			call = self.submit_send(chat_id, row_dicts, msg_text)
+			self.in_flight[row_dicts[0]["internal_id"]] = (row_dicts, call)
+			call.add_done_callback(lambda call_: self.wake())
+
+
+class Scheduler(object):
+	"""
+	Sleeps an event loop of a node until one of its handlers is due: it is woken up or its period is over
+	"""
+	MAX_SLEEP_SECONDS = 1.  # the loop still checks its stop signal and helper threads
+
+	def __init__(self, handlers):
+		self.wakeup_event = threading.Event()
+		self.handlers = handlers
+		self.subscriptions = []
+		for handler in handlers:
+			handler.wakeup_event = self.wakeup_event
+
+	def wake_on(self, storage, event, platform, handler):
+		"""
+		Wakes `handler` up on a StorageEvents `event` of the storage, until `close`
+		"""
+		storage.events.subscribe(event, platform, handler.wake)
+		self.subscriptions.append((storage, event, platform, handler.wake))
+
+	def wait(self):
+		now = dt.datetime.now()
+		timeout = min([self.MAX_SLEEP_SECONDS] + [handler.seconds_to_go(now) for handler in self.handlers])
+		if timeout > 0:
+			self.wakeup_event.wait(timeout)
+		self.wakeup_event.clear()
+
+	def close(self):
+		for storage, event, platform, callback in self.subscriptions:
+			storage.events.unsubscribe(event, platform, callback)
+		self.subscriptions = []
+
+
+class WakingQueue(Queue.Queue):
+	"""
+	A queue which wakes its consumer (a Handler) up on every put
+	"""
+	def __init__(self, maxsize=0):
+		Queue.Queue.__init__(self, maxsize)
+		self.consumer = None
+
+	def put(self, item, block=True, timeout=None):
+		Queue.Queue.put(self, item, block, timeout)
+		consumer = self.consumer
+		if consumer is not None:
+			consumer.wake()
+
+
 class UserUpdatesHandler(Handler):
-	def __init__(self, db_client, users_d):
+	def __init__(self, db_client, users):
+		"""
+		:param users: `UserRegistry` of the node
+		"""
 		super(UserUpdatesHandler, self).__init__(db_client)
 		self.period = dt.timedelta(seconds=20)
 		self.logger = logging.getLogger(__name__)
-		self.users = users_d.values()
+		self.users = users
 
 	def handler_hook(self, **kwargs):
-		users_mx = kwargs["users_mx"]
 		new_users = kwargs["new_users"]
 
 		counter = 30
@@ -263,9 +1208,41 @@ class UserUpdatesHandler(Handler):
 			new_users_l.append(user)
 		self.db_client.update_user(new_users_l, is_new_ones=True)
 
-		with users_mx:
-			users_to_update = filter(lambda user: user.dirty, self.users)[:max(0, counter)]
+		with self.users.lock:
+			users_to_update = filter(lambda user: user.dirty, self.users.values())[:max(0, counter)]
 			for user in users_to_update:
 				self.logger.info("UserUpdatesHandler: flushing to db dirty user: (%d, %s)", user.id, user.name)
 				user.dirty = False
-			self.db_client.update_user(users_to_update)
+		self.db_client.update_user(users_to_update)
+
+
+if __name__ == "__main__":
+	import argparse
+	import sys
+
+	parser = argparse.ArgumentParser(description="Maintenance of the pipe db")
+	parser.add_argument("command", choices=["migrate", "compact", "vacuum", "rebuild-histograms", "check-histograms"],
+			help="migrate: upgrade schema; compact: roll old observations up; vacuum: rewrite the db file and switch "
+			"it to incremental auto vacuum, the nodes must be stopped; rebuild-histograms: recompute hourly "
+			"histograms out of observations; check-histograms: compare hourly histograms against observations")
+	parser.add_argument("--db", dest="db_name", type=str, default=DBClient.DB_NAME, metavar="db_filename",
+			help="a path to the db file")
+	args = parser.parse_args()
+
+	logging.basicConfig(format='%(asctime)s:%(levelname)s:%(name)s:%(message)s', level=logging.INFO)
+	DBClient.DB_NAME = args.db_name
+	db_client = DBClient("vk")  # the schema is upgraded on connect
+	if args.command == "compact":
+		db_client.compact_observations()
+	elif args.command == "vacuum":
+		db_client.vacuum()
+	elif args.command == "rebuild-histograms":
+		db_client.rebuild_histograms()
+	elif args.command == "check-histograms":
+		mismatches = db_client.check_histograms()
+		for user_id, hour, expected, actual in mismatches:
+			logging.warning("user %d, hour %d: expected %s, got %s", user_id, hour, str(expected), str(actual))
+		logging.info("%d inconsistent histogram buckets", len(mismatches))
+		db_client.close()
+		sys.exit(1 if mismatches else 0)
+	db_client.close()
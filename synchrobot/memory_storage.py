@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Author: Ivan Senin
+
+import bisect
+import calendar
+import logging
+import threading
+import time
+
+from synchrobot.chat_user import User, UserRegistry
+from synchrobot.db_ops import Storage, StorageEvents, local_day_and_hour, local_hour_start
+
+
+class MemoryStore(object):
+	"""
+	Data of both platforms. Share a single instance between MemoryStorage objects of the nodes
+	"""
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.users = {}  # (platform, user id) -> (name, last_seen, want_time, muted, username, serialized keys)
+		self.messages = []  # dicts, the position of a message is internal_id - 1
+		self.chat_messages = {}  # (source platform, chat id) -> internal ids in ascending order
+		self.pipes = {}  # pipe id -> dict(id, tg_chat_id, vk_chat_id, is_active, code)
+		self.next_pipe_id = 1
+		self.delivery_cursors = {}  # (pipe id, platform) -> internal id
+		self.observations = {}  # user id -> list of (timing, is_online, using_mobile)
+		self.hourly = {}  # user id -> dict of hour timing -> [samples, online, mobile]
+		self.histograms = {}  # user id -> dict of local hour -> [samples, online, mobile, days, last day]
+		self.latest_observation_time = None
+
+
+class MemoryStorage(Storage):
+	"""
+	Pure in-memory storage: no I/O at all. Meant for tests, benchmarks and as a zero-cost baseline for a db backend
+	"""
+	FETCH_PAGE_SIZE = 100
+
+	def __init__(self, bot_platform, store=None):
+		assert bot_platform in self.SUPPORTED_PLATFORMS, "Unsupported platform"
+		self.__platform = bot_platform
+		self.__other_platform = "vk" if bot_platform == "tg" else "tg"
+		self.logger = logging.getLogger(__name__ + "(" + self.__platform + ")")
+		self.store = store if store is not None else MemoryStore()
+
+	def fetch_users(self):
+		users = UserRegistry()
+		with self.store.lock:
+			for (platform, id), (name, last_seen, want_time, muted, username, json_keys) in \
+					self.store.users.iteritems():
+				if platform == self.__platform:
+					user = User(id, name, last_seen, want_time, muted, username, json_keys)
+					user.dirty = False
+					users.add(user)
+		return users
+
+	def update_user(self, users, is_new_ones=False):
+		if not users:
+			return
+		if isinstance(users, User):
+			users = [users]
+		if not isinstance(users[0], User):
+			raise ValueError("don't want to update strange thing")
+		with self.store.lock:
+			for user in users:
+				key = (self.__platform, user.id)
+				if is_new_ones == (key in self.store.users):
+					continue
+				self.store.users[key] = (user.name, user.last_seen, user.want_time, user.muted, user.username,
+						user.serialized_keys())
+
+	def add_msgs(self, rows):
+		with self.store.lock:
+			for msg_id, chat_id, sender_id, sender_name, username, msg_type, content, date in rows:
+				internal_id = len(self.store.messages) + 1
+				self.store.messages.append({"internal_id": internal_id, "message_id": msg_id,
+						self.__platform + "_chat_id": chat_id, self.__other_platform + "_chat_id": None,
+						"sender_id": sender_id, "sender_name": sender_name, "username": username,
+						"msg_type": msg_type, "content": content, "date": date})
+				self.store.chat_messages.setdefault((self.__platform, chat_id), []).append(internal_id)
+		if rows:
+			self.events.publish(StorageEvents.MESSAGES_ADDED, self.__other_platform)
+
+	def fetch_unsync_messages(self, do_update=True):
+		curr_chat_id = self.__platform + "_chat_id"
+		other_chat_id = self.__other_platform + "_chat_id"
+		with self.store.lock:
+			pipes = [(pipe["id"], pipe[curr_chat_id], pipe[other_chat_id]) for pipe in self.store.pipes.values()
+					if pipe["is_active"]]
+		for pipe_id, curr_chat, other_chat in pipes:
+			with self.store.lock:
+				last_internal_id = self.store.delivery_cursors.get((pipe_id, self.__platform), 0)
+			while True:
+				with self.store.lock:
+					ids = self.store.chat_messages.get((self.__other_platform, other_chat), [])
+					page = []
+					for internal_id in ids[bisect.bisect_right(ids, last_internal_id):]:
+						msg = self.store.messages[internal_id - 1]
+						if msg[curr_chat_id] is None:
+							page.append(msg)
+							if len(page) == self.FETCH_PAGE_SIZE:
+								break
+				for msg in page:
+					row_dict = {"date": msg["date"], "sender_name": msg["sender_name"], "username": msg["username"],
+							"content": msg["content"], curr_chat_id: curr_chat, "internal_id": msg["internal_id"],
+							"pipe_id": pipe_id}
+					try:
+						yield row_dict
+					finally:
+						if do_update and "sent" in row_dict:
+							self.ack_messages([row_dict])
+				if len(page) < self.FETCH_PAGE_SIZE:
+					break
+				last_internal_id = page[-1]["internal_id"]
+
+	def ack_messages(self, row_dicts):
+		curr_chat_id = self.__platform + "_chat_id"
+		other_chat_id = self.__other_platform + "_chat_id"
+		with self.store.lock:
+			pipe_ids = set()
+			for row_dict in row_dicts:
+				self.store.messages[row_dict["internal_id"] - 1][curr_chat_id] = row_dict[curr_chat_id]
+				pipe_ids.add(row_dict["pipe_id"])
+			for pipe_id in pipe_ids:
+				if pipe_id not in self.store.pipes:
+					continue
+				# the cursor stops right before the oldest message which is still waiting for delivery
+				key = (pipe_id, self.__platform)
+				ids = self.store.chat_messages.get((self.__other_platform, self.store.pipes[pipe_id][other_chat_id]), [])
+				position = bisect.bisect_right(ids, self.store.delivery_cursors.get(key, 0))
+				while position < len(ids) and self.store.messages[ids[position] - 1][curr_chat_id] is not None:
+					position += 1
+				if position > 0:
+					self.store.delivery_cursors[key] = ids[position - 1]
+		return len(row_dicts)
+
+	def get_monitored_chats(self):
+		with self.store.lock:
+			return [pipe[self.__platform + "_chat_id"] for pipe in self.store.pipes.values() if pipe["is_active"]]
+
+	def set_pending_chat(self, tg_chat_id, vk_chat_id, code):
+		assert self.__platform == "tg", "Pipe could be established only from telegram"
+		assert isinstance(code, str), "activation code must be a string"
+		with self.store.lock:
+			for pipe in self.store.pipes.values():
+				if pipe["tg_chat_id"] == tg_chat_id and pipe["vk_chat_id"] == vk_chat_id:
+					self.logger.warning("IntegrityError: UNIQUE constraint failed")
+					raise UserWarning("UNIQUE")
+			pipe_id = self.store.next_pipe_id
+			self.store.next_pipe_id += 1
+			self.store.pipes[pipe_id] = {"id": pipe_id, "tg_chat_id": tg_chat_id, "vk_chat_id": vk_chat_id,
+					"is_active": False, "code": code}
+		self.events.publish(StorageEvents.PIPES_CHANGED)
+
+	def get_pending_chat_ids(self):
+		with self.store.lock:
+			return dict((pipe[self.__platform + "_chat_id"], pipe["code"]) for pipe in self.store.pipes.values()
+					if not pipe["is_active"])
+
+	def _remove_pipes(self, pipe_ids):
+		for pipe_id in pipe_ids:
+			del self.store.pipes[pipe_id]
+			for platform in self.SUPPORTED_PLATFORMS:
+				self.store.delivery_cursors.pop((pipe_id, platform), None)
+
+	def remove_pipe(self, tg_chat_id):
+		with self.store.lock:
+			self._remove_pipes([pipe["id"] for pipe in self.store.pipes.values() if pipe["tg_chat_id"] == tg_chat_id])
+		self.events.publish(StorageEvents.PIPES_CHANGED)
+
+	def check_pending_chats(self, code):
+		assert isinstance(code, str) or isinstance(code, unicode), "activation code must be a string"
+		code = str(code)
+		with self.store.lock:
+			rows = [{"id": pipe["id"], "tg_chat_id": pipe["tg_chat_id"], "vk_chat_id": pipe["vk_chat_id"]}
+					for pipe in self.store.pipes.values() if pipe["code"] == code and not pipe["is_active"]]
+		for row_dict in rows:
+			yield row_dict
+			if "confirmed" in row_dict:
+				with self.store.lock:
+					if row_dict["id"] in self.store.pipes:
+						self.store.pipes[row_dict["id"]]["is_active"] = True
+					self._remove_pipes([pipe["id"] for pipe in self.store.pipes.values()
+							if pipe["tg_chat_id"] == row_dict["tg_chat_id"] and pipe["id"] != row_dict["id"]])
+				self.events.publish(StorageEvents.PIPES_CHANGED)
+				break
+
+	def append_users_observations(self, users_to_state_d, timing=None):
+		current_ts = calendar.timegm(time.gmtime()) if timing is None else timing
+		day, hour = local_day_and_hour(current_ts)
+		with self.store.lock:
+			if users_to_state_d:
+				self.store.latest_observation_time = max(self.store.latest_observation_time, current_ts)
+			for user, (is_online, using_mobile) in users_to_state_d.iteritems():
+				is_online, using_mobile = bool(is_online), bool(using_mobile)
+				self.store.observations.setdefault(user.id, []).append((current_ts, is_online, using_mobile))
+				bucket = self.store.histograms.setdefault(user.id, {}).setdefault(hour,
+						[0, 0, 0, 0, None])
+				bucket[0] += 1
+				bucket[1] += is_online
+				bucket[2] += using_mobile
+				if bucket[4] != day:
+					bucket[3] += 1
+					bucket[4] = day
+
+	def get_latest_observation_time(self):
+		with self.store.lock:
+			return self.store.latest_observation_time
+
+	def get_user_histogram(self, user):
+		import numpy as np
+		assert isinstance(user, User)
+		histogram = np.zeros((24, 4), dtype=np.int64)
+		with self.store.lock:
+			for hour, bucket in self.store.histograms.get(user.id, {}).iteritems():
+				histogram[hour] = bucket[:4]
+		return histogram
+
+	def get_user_statistics(self, user):
+		import numpy as np
+		assert isinstance(user, User)
+		with self.store.lock:
+			rows = []
+			for hour_timing, (samples, online, mobile) in sorted(self.store.hourly.get(user.id, {}).iteritems()):
+				# the same expansion as DBClient does
+				online = min(online, samples)
+				online_mobile = min(mobile, online)
+				offline_mobile = max(0, min(mobile - online_mobile, samples - online))
+				rows.extend([(hour_timing, True, True)] * online_mobile +
+						[(hour_timing, True, False)] * (online - online_mobile) +
+						[(hour_timing, False, True)] * offline_mobile +
+						[(hour_timing, False, False)] * (samples - online - offline_mobile))
+			rows.extend(self.store.observations.get(user.id, []))
+		return np.array(rows, dtype=self.OBSERVATION_DTYPE)
+
+	def compact_observations(self, max_age=None):
+		if max_age is None:
+			max_age = self.RAW_OBSERVATIONS_MAX_AGE
+		cutoff = local_hour_start(calendar.timegm(time.gmtime()) - int(max_age.total_seconds()))
+		compacted = 0
+		with self.store.lock:
+			for user_id, observations in self.store.observations.iteritems():
+				position = bisect.bisect_left(observations, (cutoff,))
+				hourly = self.store.hourly.setdefault(user_id, {})
+				for timing, is_online, using_mobile in observations[:position]:
+					aggregate = hourly.setdefault(local_hour_start(timing), [0, 0, 0])
+					aggregate[0] += 1
+					aggregate[1] += is_online
+					aggregate[2] += using_mobile
+				del observations[:position]
+				compacted += position
+		return compacted
@@ -1,19 +1,162 @@
+# -*- coding: utf-8 -*-
+# Author: Ivan Senin
+
+import array
+import bisect
+import calendar
+import collections
+import heapq
+import io
+import logging
+import math
 import os
 import random
-import calendar
+import re
 import time
 
+from synchrobot.caching import LRUCache
+
 Q_PATH = "quotes"
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+ATTRIBUTION_RE = re.compile(r"\(([^()]+)\)\s*$", re.UNICODE)
 
 random.seed(calendar.timegm(time.gmtime()))
 
-def get_quote(subject = "random"):
-	if not isinstance(subject, str):
-		raise Exception ("subject must be a string")
 
-	directory = os.path.join(os.path.dirname(__file__), Q_PATH)
+def tokenize(text):
+	return WORD_RE.findall(text.lower())
+
+
+def _contains(postings, quote_id):
+	position = bisect.bisect_left(postings, quote_id)
+	return position < len(postings) and postings[position] == quote_id
+
+
+def _merge(postings_list):
+	"""
+	:return: generator of sorted distinct ids of several sorted postings
+	"""
+	last = None
+	for quote_id in heapq.merge(*postings_list):
+		if quote_id != last:
+			yield quote_id
+			last = quote_id
+
+
+class QuoteStore(object):
+	"""
+	Quotes of all subject files `<directory>/<subject>.txt`, a quote per line, loaded once. Quotes are numbered
+	from the shortest one, so postings of the inverted word index (sorted arrays of numbers) are in order of rank.
+	Searches are cached by their words
+	"""
+	MAX_RESULTS = 50  # inline query limit
+	MAX_COMPLETIONS = 30  # most frequent words of an unfinished last word of a query
+	MAX_PARTIAL_POSTINGS = 5000  # a word of more quotes does not bring partial matches
+	CACHE_SIZE = 1000
+
+	def __init__(self, directory=None):
+		self.logger = logging.getLogger(__name__)
+		directory = directory or os.path.join(os.path.dirname(__file__), Q_PATH)
+		loaded = []
+		self.subjects = []
+		for filename in sorted(os.listdir(directory)):
+			subject, extension = os.path.splitext(filename)
+			if extension != ".txt":
+				continue
+			subject_index = len(self.subjects)
+			self.subjects.append(subject)
+			with io.open(os.path.join(directory, filename), encoding='utf-8') as f:
+				for line_number, line in enumerate(f):
+					text = line.strip()
+					if text:
+						words = tokenize(text)
+						loaded.append((len(words), subject_index, line_number, text, words))
+		loaded.sort()
+
+		self.texts = []
+		self.result_ids = []  # "<subject>:<line number>", stable while lines above are not edited
+		self.subject_indices = array.array('H')
+		postings = collections.defaultdict(list)
+		for quote_id, (_, subject_index, line_number, text, words) in enumerate(loaded):
+			self.texts.append(text)
+			self.result_ids.append("{0}:{1}".format(self.subjects[subject_index], line_number))
+			self.subject_indices.append(subject_index)
+			for word in set(words):
+				postings[word].append(quote_id)
+		self.postings = dict((word, array.array('I', quote_ids)) for word, quote_ids in postings.iteritems())
+		self.vocabulary = sorted(self.postings)
+		self.answers = LRUCache(self.CACHE_SIZE)
+		self.logger.info("%d quotes of %d subjects are indexed, %d words", len(self.texts), len(self.subjects),
+				len(self.vocabulary))
+
+	def __len__(self):
+		return len(self.texts)
+
+	def get(self, quote_id):
+		"""
+		:return: (result id, title, text) of a quote; the title is its attribution or its subject
+		"""
+		text = self.texts[quote_id]
+		attribution = ATTRIBUTION_RE.search(text)
+		title = attribution.group(1) if attribution else self.subjects[self.subject_indices[quote_id]].capitalize()
+		return self.result_ids[quote_id], title, text
+
+	def random_quotes(self, number):
+		return random.sample(xrange(len(self.texts)), min(number, len(self.texts)))
+
+	def _term(self, word, is_prefix):
+		"""
+		:return: (idf, list of postings), postings of the most frequent completions of an unfinished word
+		"""
+		if is_prefix:
+			start = bisect.bisect_left(self.vocabulary, word)
+			end = bisect.bisect_left(self.vocabulary, word + u"\uffff", start)
+			postings_list = heapq.nlargest(self.MAX_COMPLETIONS, (self.postings[completion]
+					for completion in self.vocabulary[start:end]), key=len)
+		else:
+			postings_list = [self.postings[word]] if word in self.postings else []
+		frequency = max(len(postings) for postings in postings_list) if postings_list else 0
+		return math.log((len(self.texts) + 1.) / (frequency + 1)), postings_list
+
+	def _rank(self, words, is_prefix, limit):
+		terms = [self._term(word, is_prefix and i == len(words) - 1) for i, word in enumerate(words)]
+		terms.sort(key=lambda term: sum(len(postings) for postings in term[1]))
+		found = []
+		# quotes with all the words, the shortest first: the rarest term is walked, the rest are probed
+		if terms[0][1]:
+			for quote_id in _merge(terms[0][1]):
+				if all(any(_contains(postings, quote_id) for postings in term[1]) for term in terms[1:]):
+					found.append(quote_id)
+					if len(found) == limit:
+						return found
+		if len(terms) == 1:
+			return found
+		# then quotes with some of the words which are not too common, by the sum of idf of their words
+		found_set = set(found)
+		scores = {}
+		for idf, postings_list in terms:
+			if sum(len(postings) for postings in postings_list) > self.MAX_PARTIAL_POSTINGS:
+				continue
+			for quote_id in _merge(postings_list):
+				if quote_id not in found_set:
+					scores[quote_id] = scores.get(quote_id, 0.) + idf
+		found.extend(heapq.nsmallest(limit - len(found), scores, key=lambda quote_id: (-scores[quote_id], quote_id)))
+		return found
 
-	f = open(os.path.join(directory, subject + ".txt"))
-	lines = f.readlines()
-	f.close()
-	return random.choice(lines) + " \ "
\ No newline at end of file
+	def search(self, query, limit=None):
+		"""
+		Quotes with all the words of the query go first, then quotes with some of them. The last word matches as
+		a prefix unless the query ends with a space or punctuation: it may be typed yet
+		:return: list of at most `limit` (MAX_RESULTS by default) quote ids, empty for a query without words
+		"""
+		limit = min(limit or self.MAX_RESULTS, self.MAX_RESULTS)
+		words = tokenize(query)
+		if not words:
+			return []
+		is_prefix = query[-1:].isalnum()
+		key = (tuple(words), is_prefix)
+		found = self.answers.get(key)
+		if found is None:
+			found = self._rank(words, is_prefix, self.MAX_RESULTS)
+			self.answers.put(key, found)
+		return found[:limit]
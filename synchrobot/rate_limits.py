@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Author: Ivan Senin
+
+import threading
+import time
+
+
+class TokenBucket(object):
+	"""
+	`rate` tokens per second, at most `capacity` of them are saved up for a burst. Not thread-safe: guard it
+	"""
+	def __init__(self, rate, capacity, now=None):
+		self.rate = float(rate)
+		self.nominal_rate = self.rate  # the rate an adaptive owner brings it back to
+		self.capacity = float(capacity)
+		self.tokens = float(capacity)
+		self.updated = time.time() if now is None else now
+
+	def _refill(self, now):
+		if now > self.updated:
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+
+	def seconds_until(self, now, tokens=1):
+		"""
+		:return: seconds until `tokens` are available, 0 if they are
+		"""
+		self._refill(now)
+		if self.tokens >= tokens:
+			return 0.
+		return (tokens - self.tokens) / self.rate
+
+	def consume(self, now, tokens=1):
+		"""
+		:return: False if there are not enough tokens, nothing is consumed then
+		"""
+		if self.seconds_until(now, tokens) > 0:
+			return False
+		self.tokens -= tokens
+		return True
+
+
+class RateScheduler(object):
+	"""
+	Budget of API traffic: a global bucket of requests and a bucket of calls per peer. Rates adapt to the server
+	(AIMD): a rejection halves the rate of the bucket concerned, every success brings back INCREASE_STEP of it up to
+	the nominal rate. Thread-safe; it never sleeps, it tells how long to wait instead
+	"""
+	DECREASE_FACTOR = .5
+	INCREASE_STEP = .05  # of the nominal rate
+	MIN_RATE_FRACTION = .1
+	MAX_IDLE_PEERS = 10000
+
+	def __init__(self, rate, burst, peer_rate, peer_burst, peer_limits=None):
+		"""
+		:param peer_limits: callable returning (rate, burst) of a peer, overrides peer_rate and peer_burst
+		"""
+		self.mx = threading.Lock()
+		self.peer_limits = peer_limits if peer_limits is not None else lambda peer: (peer_rate, peer_burst)
+		self.bucket = TokenBucket(rate, burst)
+		self.peer_buckets = {}
+		self.decreases = 0
+
+	def _evict_idle(self, now):
+		# full buckets at nominal rate carry no state
+		idle_peers = [peer for peer, bucket in self.peer_buckets.iteritems()
+				if bucket.rate == bucket.nominal_rate and bucket.seconds_until(now, bucket.capacity) == 0]
+		for peer in idle_peers:
+			del self.peer_buckets[peer]
+		return len(idle_peers)
+
+	def _peer_bucket(self, peer, now):
+		bucket = self.peer_buckets.get(peer)
+		if bucket is None:
+			if len(self.peer_buckets) >= self.MAX_IDLE_PEERS:
+				self._evict_idle(now)
+			rate, burst = self.peer_limits(peer)
+			bucket = self.peer_buckets[peer] = TokenBucket(rate, burst, now)
+		return bucket
+
+	def evict_idle(self, now):
+		"""
+		Forgets peers which are back to a full bucket at the nominal rate
+		:return: number of evicted peers
+		"""
+		with self.mx:
+			return self._evict_idle(now)
+
+	def request_delay(self, now):
+		"""
+		:return: seconds until the next request is allowed
+		"""
+		with self.mx:
+			return self.bucket.seconds_until(now)
+
+	def peer_delay(self, peer, now):
+		"""
+		:return: seconds until a call to the peer is allowed, nothing is consumed
+		"""
+		with self.mx:
+			bucket = self.peer_buckets.get(peer)
+			return bucket.seconds_until(now) if bucket is not None else 0.
+
+	def consume_request(self, now):
+		with self.mx:
+			return self.bucket.consume(now)
+
+	def select(self, calls, max_calls, peer_of, now):
+		"""
+		Takes calls which fit into the peer budgets, in order. Calls of a peer are never reordered: a call which does
+		not fit holds the later ones of its peer back
+		:param peer_of: callable returning a peer of a call, None if the call is not limited per peer
+		:return: (list of selected calls, seconds until the first held back call fits or None)
+		"""
+		selected = []
+		held_peers = set()
+		wait = None
+		with self.mx:
+			for call in calls:
+				if len(selected) == max_calls:
+					break
+				peer = peer_of(call)
+				if peer is None:
+					selected.append(call)
+					continue
+				if peer in held_peers:
+					continue
+				bucket = self._peer_bucket(peer, now)
+				if bucket.consume(now):
+					selected.append(call)
+				else:
+					held_peers.add(peer)
+					seconds = bucket.seconds_until(now)
+					wait = seconds if wait is None else min(wait, seconds)
+		return selected, wait
+
+	def on_success(self, peer=None):
+		"""
+		A request (peer is None) or a call to a peer was accepted by the server
+		"""
+		with self.mx:
+			bucket = self.bucket if peer is None else self.peer_buckets.get(peer)
+			if bucket is not None:
+				bucket.rate = min(bucket.nominal_rate, bucket.rate + bucket.nominal_rate * self.INCREASE_STEP)
+
+	def on_rejected(self, peer=None, retry_after=None):
+		"""
+		The server refused for too many requests (peer is None) or for flooding a peer
+		:param retry_after: seconds the server asked to wait, if it did
+		"""
+		now = time.time()
+		with self.mx:
+			self.decreases += 1
+			bucket = self.bucket if peer is None else self._peer_bucket(peer, now)
+			bucket.seconds_until(now)  # tokens are accounted at the former rate
+			bucket.rate = max(bucket.nominal_rate * self.MIN_RATE_FRACTION, bucket.rate * self.DECREASE_FACTOR)
+			bucket.tokens = min(bucket.tokens, 0. if retry_after is None else -retry_after * bucket.rate)
+
+	def get_rates(self):
+		"""
+		:return: (current global rate, number of peers with a decreased rate)
+		"""
+		with self.mx:
+			return self.bucket.rate, len([bucket for bucket in self.peer_buckets.values()
+					if bucket.rate < bucket.nominal_rate])
+
+
+class PendingCall(object):
+	"""
+	A call queued until there is a rate budget for it. `result` blocks until the call is done, an error of the call
+	is raised
+	"""
+	def __init__(self, method, method_args):
+		self.method = method
+		self.method_args = method_args
+		self.submit_time = time.time()
+		self.attempts = 0
+		self.done_event = threading.Event()
+		self.value = None
+		self.error = None
+		self.callbacks = []
+		self.callbacks_mx = threading.Lock()
+
+	def set_result(self, value=None, error=None):
+		self.value = value
+		self.error = error
+		with self.callbacks_mx:
+			self.done_event.set()
+			callbacks = self.callbacks
+			self.callbacks = []
+		for callback in callbacks:
+			callback(self)
+
+	def add_done_callback(self, callback):
+		"""
+		`callback(call)` is called on the thread which completes the call, right away if it is done
+		"""
+		with self.callbacks_mx:
+			if not self.done_event.is_set():
+				self.callbacks.append(callback)
+				return
+		callback(self)
+
+	def done(self):
+		return self.done_event.is_set()
+
+	def result(self, timeout=None):
+		if not self.done_event.wait(timeout):
+			raise UserWarning("{0} is not done within {1} seconds".format(self.method, timeout))
+		if self.error is not None:
+			raise self.error
+		return self.value
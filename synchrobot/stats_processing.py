@@ -1,58 +1,134 @@
 # -*- coding: utf-8 -*-
 # Author: Ivan Senin
 
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
+import calendar
 import os
-from scipy.interpolate import spline
+import tempfile
 import threading
+import time
 
 import synchrobot
 import synchrobot.chat_user
 
 
-def get_filename(user):
-	DIR_NAME="stats_tmp"
+DIR_NAME = "stats_tmp"
+_plotting = None
+_plotting_mx = threading.Lock()
+
+
+def load_plotting():
+	"""
+	The numeric and plotting stack is imported on first use: it takes longer to load than the rest of the bot
+	:return: (numpy, matplotlib.pyplot, scipy.interpolate.spline)
+	"""
+	global _plotting
+	with _plotting_mx:
+		if _plotting is None:
+			import matplotlib as mpl
+			mpl.use('Agg')
+			import matplotlib.pyplot as plt
+			import numpy as np
+			from scipy.interpolate import spline
+			_plotting = (np, plt, spline)
+	return _plotting
 
-	filename = "stats_"
+
+def get_filename(user):
+	"""
+	:return: a path to a new file, unique across threads and processes: a cache may keep it for a while
+	"""
+	prefix = "stats_"
 	if isinstance(user, synchrobot.chat_user.User):
-		filename += "{0}_".format( user.username if user.username else "id" + str(user.id))
-	filename += threading.currentThread().getName() + ".png"
+		prefix += "{0}_".format(user.username if user.username else "id" + str(user.id))
 
 	if not os.path.exists(DIR_NAME):
 		os.mkdir(DIR_NAME)
-	return os.path.join(os.path.join(os.curdir, DIR_NAME), filename)
+	fd, filename = tempfile.mkstemp(suffix=".png", prefix=prefix, dir=os.path.join(os.curdir, DIR_NAME))
+	os.close(fd)
+	return filename
 
-def make_attendance_plot(stats, user=None):
+def remove_stale_files(max_age_seconds):
+	"""
+	Removes plots older than `max_age_seconds`
+	:return: number of removed files
+	"""
+	if not os.path.exists(DIR_NAME):
+		return 0
+	removed = 0
+	oldest_time = time.time() - max_age_seconds
+	for name in os.listdir(DIR_NAME):
+		filename = os.path.join(DIR_NAME, name)
+		try:
+			if os.path.getmtime(filename) < oldest_time:
+				os.remove(filename)
+				removed += 1
+		except OSError:
+			pass  # removed by somebody else
+	return removed
+
+def to_local_seconds(timings):
+	"""
+	:param timings: numpy array of UTC datetime64
+	:return: numpy array of int64 seconds shifted into the local time zone
+	"""
+	import numpy as np
+	DAY_SECONDS = 24 * 60 * 60
+	seconds = timings.astype('datetime64[s]').astype(np.int64)
+	utc_offset = lambda ts: calendar.timegm(time.localtime(ts)) - ts
+	unique_days, inverse = np.unique(seconds // DAY_SECONDS, return_inverse=True)
+	day_starts = unique_days * DAY_SECONDS
+	offsets_at_start = np.array([utc_offset(int(ts)) for ts in day_starts], dtype=np.int64)
+	offsets_at_end = np.array([utc_offset(int(ts) + DAY_SECONDS - 1) for ts in day_starts], dtype=np.int64)
+	offsets = offsets_at_start[inverse]
+	# the offset is changed within a day (DST), these few rows are shifted one by one
+	for i in np.flatnonzero((offsets_at_start != offsets_at_end)[inverse]):
+		offsets[i] = utc_offset(int(seconds[i]))
+	return seconds + offsets
+
+def histogram_from_statistics(stats):
+	"""
+	:param stats: numpy structured array of observations with fields (timing, is_online, using_mobile)
+	:return: numpy array of 24 rows (hours of local time) with columns (samples, online, mobile, distinct days)
+	"""
+	import numpy as np
+	HOURS = 24
+	histogram = np.zeros((HOURS, 4), dtype=np.int64)
+	if not len(stats):
+		return histogram
+	local_seconds = to_local_seconds(stats['timing'])
+	hours = (local_seconds // 3600) % HOURS
+	days = local_seconds // (HOURS * 3600)
+	histogram[:, 0] = np.bincount(hours, minlength=HOURS)
+	histogram[:, 1] = np.bincount(hours, weights=stats['is_online'], minlength=HOURS)
+	histogram[:, 2] = np.bincount(hours, weights=stats['using_mobile'], minlength=HOURS)
+	histogram[:, 3] = np.bincount(np.unique(days * HOURS + hours) % HOURS, minlength=HOURS)
+	return histogram
+
+def make_attendance_plot(histogram, user=None):
 	HOURS = 24
 	'''
-	:param stats: numpy.matrix with columns (datetime, was_online (bool), via mobile (bool))
+	:param histogram: numpy array of 24 rows (hours) with columns (samples, online, mobile, distinct days)
+		or observations as returned by `DBClient.get_user_statistics`
 	:return: image
 	'''
-	assert isinstance(stats, np.ndarray)
+	np, plt, spline = load_plotting()
+	assert isinstance(histogram, np.ndarray)
+	if histogram.dtype.names:
+		histogram = histogram_from_statistics(histogram)
+	assert histogram.shape == (HOURS, 4)
 	assert user is None or isinstance(user, synchrobot.chat_user.User)
 	subject_name = user.username if user else "any"
 	x_axis = range(HOURS)
-	online_per_hours = [[] for _ in range(HOURS)]
-	mobiles_per_hours = [[] for _ in range(HOURS)]
-	days_per_hours = [[] for _ in range(HOURS)]
-	for row in stats:
-		online_per_hours[row[0].hour].append(row[1])
-		mobiles_per_hours[row[0].hour].append(row[2])
-		days_per_hours[row[0].hour].append(row[0].date())
-
-	replace_nan = lambda x: 0 if x == np.nan else x
-	take_avg = lambda observations: replace_nan(np.average( np.array(observations, np.float)))
-	y_axis = map(take_avg, online_per_hours)
-	y_mobile_axis = map(take_avg, mobiles_per_hours)
+	samples_per_hours = histogram[:, 0]
+	days_per_hours = histogram[:, 3]
+
+	take_avg = lambda counts: np.where(samples_per_hours > 0, counts / np.maximum(samples_per_hours, 1.), 0.)
+	y_axis = take_avg(histogram[:, 1])
+	y_mobile_axis = take_avg(histogram[:, 2])
 
 	x_microticks = np.linspace(0, HOURS, HOURS*100)
 	y_mobile_s_axis = spline(x_axis, y_mobile_axis, x_microticks)
 
-	days_per_hours = map(np.unique, days_per_hours)
-
 	plt.figure()
 	plt.title("Probability density of `online` status for {0}".format(subject_name.encode('utf-8')))
 	plt.bar(x_axis, y_axis, align="center", color="cyan", hold=True, label="online")
@@ -63,12 +139,13 @@ def make_attendance_plot(stats, user=None):
 	plt.xlabel("Hours,\nTotal Number of Measurements,\nNumber of Distinct Days in View")
 	plt.ylabel("Probability of Appearance")
 	plt.grid(True)
-	plt.xticks(range(HOURS), ["{0}\n{1}\n{2}".format(i, len(online_per_hours[i]),
-			len(days_per_hours[i])) for i in range(HOURS)])
+	plt.xticks(range(HOURS), ["{0}\n{1}\n{2}".format(i, samples_per_hours[i], days_per_hours[i])
+			for i in range(HOURS)])
 	plt.gcf().subplots_adjust(bottom=0.2)
 
 	filename = get_filename(user)
 	plt.savefig(filename)
+	plt.close()
 	return filename
 
 
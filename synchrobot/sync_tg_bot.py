@@ -3,7 +3,6 @@
 # Author: Ivan Senin
 
 import Queue
-import collections
 import datetime as dt
 import logging
 import random
@@ -14,7 +13,7 @@ import time
 import telepot
 from telepot.namedtuple import InlineQueryResultArticle, InputTextMessageContent, ReplyKeyboardMarkup
 
-from synchrobot import db_ops, quotes
+from synchrobot import db_ops, quotes, rate_limits
 from synchrobot.chat_user import User
 
 
@@ -26,36 +25,46 @@ class SyncBot(object):
                   "Pleased to meet you again!"]
 	LONGPOLL_RETRY_RELAX_SECONDS = .7
 	VK_GROUP_IDS = 2000000000
+	INLINE_CACHE_SECONDS = 300  # answers to a query with words are cached by telegram as well
 
-	def __init__(self, token):
+	def __init__(self, token, storage=None):
+		"""
+		:param storage: db_ops.Storage of the telegram platform. DBClient is used by default
+		"""
 		self.logger = logging.getLogger(__name__)
 		assert isinstance(token, str)
 		self.bot = LimitsAwareBot(token)
 		self.logger.info("getMe request: %s", self.bot.getMe())
 
 		self.answerer = telepot.helper.Answerer(self.bot)
+		self.quote_store = quotes.QuoteStore()
 
-		self.db_client = db_ops.DBClient("tg")
+		self.db_client = storage if storage is not None else db_ops.DBClient("tg")
+		self.ingest_buffer = db_ops.MessageIngestBuffer(self.db_client)
 		self.users = self.db_client.fetch_users()
 		self.logger.info("%d users were fetched from db", len(self.users))
 		self.chats_to_monitor = self.db_client.get_monitored_chats()
 		self.logger.info("%d chatd_ids to monitor were fetched from db", len(self.chats_to_monitor))
-		self.msg_queue = Queue.Queue()
+		self.msg_queue = db_ops.WakingQueue()
 		self.new_users_to_register = Queue.Queue(15)
-		self.users_mx = threading.Lock()
-		self.chats_to_activate = Queue.Queue()
+		self.chats_to_activate = db_ops.WakingQueue()
 
 
 	def __event_loop(self, stop_signal_q):
 		self.logger.info("Starting event loop")
-		incoming_msg_handler = ChatMessagesHandler(self.db_client)
+		incoming_msg_handler = ChatMessagesHandler(self.ingest_buffer)
 		users_update_handler = db_ops.UserUpdatesHandler(self.db_client, self.users)
 		unsync_messages_handler = UnsyncMessagesHandler(self.db_client, self.bot)
 		time_notification = TimeNotificationHandler(self.bot)
 		pipe_control = PipeControlHandler(self.db_client, self.chats_to_activate, self.bot)
 
+		self.msg_queue.consumer = incoming_msg_handler
+		self.chats_to_activate.consumer = pipe_control
+		scheduler = db_ops.Scheduler([incoming_msg_handler, users_update_handler, unsync_messages_handler,
+				time_notification, pipe_control])
+		scheduler.wake_on(self.db_client, db_ops.StorageEvents.MESSAGES_ADDED, "tg", unsync_messages_handler)
+		scheduler.wake_on(self.db_client, db_ops.StorageEvents.PIPES_CHANGED, "tg", pipe_control)
 		try:
-			sleep_seconds = 0.3
 			while stop_signal_q.empty():
 				res = pipe_control()
 				if not res is None:
@@ -63,54 +72,57 @@ class SyncBot(object):
 				incoming_msg_handler(msg_queue=self.msg_queue)
 				time_notification(users=self.users)
 				unsync_messages_handler()
-				users_update_handler(users_mx=self.users_mx, new_users=self.new_users_to_register)
+				users_update_handler(new_users=self.new_users_to_register)
 
-				time.sleep(sleep_seconds)
+				scheduler.wait()
 		except KeyboardInterrupt:
 			self.logger.info("Event loop was interrupted by user")
+		finally:
+			scheduler.close()
 
 	def start(self, stop_signal_q = Queue.Queue()):
 		error_counter = 0
 		connected = False
 		dispatch = {'chat': self.on_chat_message, 'edited_chat': self.on_edited_message, 'inline_query': self.on_inline_query,
 				'chosen_inline_result': self.on_chosen_inline_result}
-		while not connected and error_counter < 5:
-			try:
-				self.bot.message_loop(callback=dispatch, relax=self.LONGPOLL_RETRY_RELAX_SECONDS)
-				connected = True
-			except BaseException as e:
-				self.logger.exception("Bot startup failed. Guess: %s", e.message)
-				error_counter += 1
-		if not connected:
-			raise UserWarning("Cannot startup bot. Is it the only instance?")
-		self.logger.info("Bot has been started up successfully")
-
-		self.__event_loop(stop_signal_q)
-		self.db_client.close()
+		try:
+			while not connected and error_counter < 5:
+				try:
+					self.bot.message_loop(callback=dispatch, relax=self.LONGPOLL_RETRY_RELAX_SECONDS)
+					connected = True
+				except BaseException as e:
+					self.logger.exception("Bot startup failed. Guess: %s", e.message)
+					error_counter += 1
+			if not connected:
+				raise UserWarning("Cannot startup bot. Is it the only instance?")
+			self.logger.info("Bot has been started up successfully")
+
+			self.__event_loop(stop_signal_q)
+		finally:
+			# the watchdog restarts a failed node in the same process: send workers must not outlive it
+			self.bot.close()
+			self.ingest_buffer.close()
+			self.db_client.close()
 		if not stop_signal_q.empty():
 			self.logger.info("Execution was stopped via stop-event")
 
 
 	def on_inline_query(self, msg):
-		self.logger.info("on_inline_query")
-		mutex = threading.Lock()
-
-		def compute(quote):
-			self.logger.info("Compute's quote: %s", quote)
-			with mutex:
-				query_id, from_id, query_string = telepot.glance(msg, flavor='inline_query')
-				self.logger.info("Inline query: query_id: %s, from_id: %d, query: %s", query_id, from_id, query_string)
-
-				articles = [InlineQueryResultArticle(
-						id='random_quote',
-						title="Random quote!",
-						input_message_content=InputTextMessageContent(
-						message_text= quote
-						)
-						)]
-
-				return (articles, 0)
-		self.answerer.answer(msg, compute, quotes.get_quote())
+		def compute():
+			query_id, from_id, query_string = telepot.glance(msg, flavor='inline_query')
+			self.logger.info("Inline query: query_id: %s, from_id: %d, query: %s", query_id, from_id, query_string)
+			found = self.quote_store.search(query_string)
+			cache_time = self.INLINE_CACHE_SECONDS
+			if not quotes.tokenize(query_string):
+				found = self.quote_store.random_quotes(self.quote_store.MAX_RESULTS)
+				cache_time = 0
+			articles = []
+			for quote_id in found:
+				result_id, title, text = self.quote_store.get(quote_id)
+				articles.append(InlineQueryResultArticle(id=result_id, title=title, description=text,
+						input_message_content=InputTextMessageContent(message_text=text)))
+			return articles, cache_time
+		self.answerer.answer(msg, compute)
 
 	def on_chosen_inline_result(self, msg):
 		result_id, from_id, query_string = telepot.glance(msg, flavor='chosen_inline_result')
@@ -120,9 +132,9 @@ class SyncBot(object):
 		text = "The synchrobot dublicates [text] messages to a chat in other platform working as a pipe. This way " \
 		       "a <i>transchat</i> is introduced. It's capable to connect people who prefer to chat in different " \
 		       "platforms\n" \
-				"Also if you add @synchrobot to your contact list, you'll be able to pick a <b>random famous " \
-		       "quote</b> in any chat via inline query technique: mention @synchrobot in the textfield and wait " \
-				"for a button!\n" \
+				"Also if you add @synchrobot to your contact list, you'll be able to pick a <b>famous " \
+		       "quote</b> in any chat via inline query technique: mention @synchrobot in the textfield, add words " \
+				"to search for or leave it blank for random ones and wait for buttons!\n" \
 				"Moreover, you can setup a pipe to a single vk-user via command /install_pipe_private vk_id\n" \
 				"Send /uninstall to remove current pipe\n" \
 				"Enjoy!\n"
@@ -134,13 +146,10 @@ class SyncBot(object):
 		self.logger.info("handling private chat")
 
 		is_new_user = False
-		if chat_id in self.users:
-			with self.users_mx:
-				user = self.users[chat_id]
-		else:
+		user = self.users.get(chat_id)
+		if user is None:
 			user = User(chat_id, msg['chat']['first_name'], 0, True, False)
-			with self.users_mx:
-				self.users[chat_id] = user
+			self.users.add(user)
 			is_new_user = True
 			self.new_users_to_register.put(user)
 			self.logger.info("New user was created: %s ", str(user))
@@ -212,65 +221,118 @@ class SyncBot(object):
 
 
 class ChatMessagesHandler(db_ops.Handler):
-	def __init__(self, db_client):
-		super(ChatMessagesHandler, self).__init__(db_client)
-		self.period = dt.timedelta(seconds=2)
+	MAX_MESSAGES_PER_TICK = 100
+
+	def __init__(self, ingest_buffer):
+		super(ChatMessagesHandler, self).__init__()
+		self.period = self.FALLBACK_PERIOD  # woken up by incoming messages
 		self.logger = logging.getLogger(__name__)
+		self.ingest_buffer = ingest_buffer
 
 	def handler_hook(self, **kwargs):
-		counter = 20
+		counter = self.MAX_MESSAGES_PER_TICK
 		while not kwargs["msg_queue"].empty() and counter > 0:
 			counter -= 1
 			msg = kwargs["msg_queue"].get()
 			content_type, chat_type, chat_id = telepot.glance(msg)
 			self.logger.info("ChatMessagesHandler: flushing to db msg: %s", str(msg))
-			self.db_client.add_msg(msg["message_id"], chat_id, msg["from"]["id"], msg["from"]["first_name"],
+			self.ingest_buffer.put(msg["message_id"], chat_id, msg["from"]["id"], msg["from"]["first_name"],
 					msg["from"]["username"], content_type, msg["text"], msg["date"])
+		if not kwargs["msg_queue"].empty():
+			self.wake()
 
 
-class UnsyncMessagesHandler(db_ops.Handler):
-	def __init__(self, db_client, bot):
-		super(UnsyncMessagesHandler, self).__init__(db_client, bot)
-		self.period = dt.timedelta(seconds=4)
-		self.logger = logging.getLogger(__name__)
+class UnsyncMessagesHandler(db_ops.UnsyncDeliveryHandler):
+	"""
+	Chats are delivered in parallel by the send queue of the bot: a message per chat is in progress, the rest of
+	the chat waits in order. A failure parks the chat in the bot until its later messages are taken back
+	"""
+	CHAT_KEY = "tg_chat_id"
+	MAX_IN_FLIGHT = 200  # sends
+	RETRY_DELAY = dt.timedelta(seconds=5)
+	MAX_MESSAGE_LENGTH = 4096  # sendMessage limit
 
-	def handler_hook(self, **kwargs):
-		counter = 3
-		for row_dict in self.db_client.fetch_unsync_messages():
-			counter -= 1
-			self.logger.info("Sending unsync message: %s ", str(row_dict))
-			msg_time = dt.datetime.fromtimestamp(row_dict["date"]).strftime('%H:%M:%S')
-			msg_text = "{0} ({1}), {2}: {3}".format(row_dict["sender_name"].encode('utf-8'),
-					row_dict["username"].encode('utf-8'), msg_time, row_dict["content"].encode('utf-8'))
-			chat_id = row_dict["tg_chat_id"]
-			if not self.api.is_hitting_limits(chat_id) and counter > 0:
-				if not self.api.sendMessage(chat_id, msg_text):
-					return
-				row_dict['sent'] = True
-				time.sleep(1)
-			else:
-				break
+	def submit_send(self, chat_id, row_dicts, msg_text):
+		return self.api.send(chat_id, msg_text, park_on_error=True)
+
+	def take_back(self, chat_id, calls):
+		cancelled = self.api.cancel(calls)
+		self.api.resume(chat_id)
+		return cancelled
+
+	def failure_reason(self, error):
+		return error.description if isinstance(error, telepot.exception.TelegramError) else error.message
+
+
+class BroadcastRound(object):
+	"""
+	Counts sends of a broadcast and reports the broadcast once the last one is done
+	"""
+	def __init__(self, name, recipients_number, skipped_number, period):
+		self.logger = logging.getLogger(__name__)
+		self.name = name
+		self.start_time = time.time()
+		self.period = period
+		self.skipped_number = skipped_number
+		self.waiting = recipients_number
+		self.failed = 0
+		self.mx = threading.Lock()
+
+	def on_sent(self, call):
+		try:
+			call.result(0)
+			is_failed = False
+		except BaseException:
+			is_failed = True
+		with self.mx:
+			self.waiting -= 1
+			self.failed += is_failed
+			if self.waiting:
+				return
+		elapsed = time.time() - self.start_time
+		log = self.logger.warning if elapsed > self.period.total_seconds() else self.logger.info
+		log("%s: broadcast was completed within %.1f s (period %.0f s), %d failed, %d skipped as still pending",
+				self.name, elapsed, self.period.total_seconds(), self.failed, self.skipped_number)
 
 
 class TimeNotificationHandler(db_ops.Handler):
+	SPREAD_FRACTION = .8  # of the period: sends of a broadcast are spread over it
+
 	def __init__(self, bot):
 		super(TimeNotificationHandler, self).__init__(api=bot)
 		self.period = dt.timedelta(seconds=20)
 		self.logger = logging.getLogger(__name__)
+		self.pending = {}  # chat id -> PendingCall of the latest notification
 
 	def handler_hook(self, **kwargs):
-		users = kwargs["users"]
-		for id, user in users.iteritems():
-				if user.want_time:
-					self.logger.info("TimeNotificationHandler: sending time to (%d, %s) ...",  id, user.name)
-					self.api.sendMessage(id, "Current time: <b>" + str(dt.datetime.now().time().strftime('%H:%M:%S')) +
-							"</b>", disable_notification=user.muted, parse_mode="html")
+		# sends go through the queue of the bot at notification priority: piped messages go first and the loop
+		# does not wait for them
+		recipients = [(id, user.muted) for id, user in kwargs["users"].iteritems() if user.want_time]
+		still_pending = dict((id, self.pending[id]) for id, _ in recipients
+				if id in self.pending and not self.pending[id].done())
+		recipients = [(id, muted) for id, muted in recipients if id not in still_pending]
+		self.pending = still_pending
+		if not recipients:
+			return
+
+		start_time = time.time()
+		spacing = self.period.total_seconds() * self.SPREAD_FRACTION / len(recipients)
+		broadcast = BroadcastRound("TimeNotificationHandler", len(recipients), len(still_pending), self.period)
+		self.logger.info("TimeNotificationHandler: sending time to %d users, %d are still pending", len(recipients),
+				len(still_pending))
+		for i, (id, muted) in enumerate(recipients):
+			send_time = start_time + i * spacing
+			text = "Current time: <b>" + dt.datetime.fromtimestamp(send_time).strftime('%H:%M:%S') + "</b>"
+			call = self.api.send(id, text, self.api.PRIORITY_NOTIFICATION, not_before=send_time,
+					disable_notification=muted, parse_mode="html")
+			call.add_done_callback(broadcast.on_sent)
+			self.pending[id] = call
 
 
 class PipeControlHandler(db_ops.Handler):
 	def __init__(self, db_client, control_msg_q, bot):
 		super(PipeControlHandler, self).__init__(db_client, bot)
-		self.period = dt.timedelta(seconds=5)
+		self.period = self.FALLBACK_PERIOD  # woken up by commands and pipe changes
 		self.logger = logging.getLogger(__name__)
 		self.control_msg_q = control_msg_q
 
@@ -298,37 +360,198 @@ class PipeControlHandler(db_ops.Handler):
 
 
 class LimitsAwareBot(telepot.Bot):
-	ALLOWED_PER_MIN = 20
+	"""
+	A bot which sends messages through a queue. Sends are released by a RateScheduler as soon as the Bot API limits
+	allow: a global bucket and a bucket per chat. Higher priority classes go first, sends to a chat keep their order
+	and a chat has a single send in progress. "Too many requests" slows the chat down and the send is queued again.
+	Another failure may park the chat until its owner has taken the later sends back
+	"""
+	MESSAGES_PER_SECOND = 25  # with the burst, at most 30 within any second
+	MESSAGES_BURST = 3
+	CHAT_MESSAGES_PER_SECOND = 1.
+	GROUP_MESSAGES_PER_SECOND = 19 / 60.  # at most 20 within any minute
+	PRIORITY_PIPE = 0
+	PRIORITY_NOTIFICATION = 1
+	SEND_WORKERS = 8
+	TOO_MANY_REQUESTS = 429
+	MAX_ATTEMPTS = 5
+	EVICTION_PERIOD_SECONDS = 60
+	TIMEOUT_SECONDS = 60
 
 	def __init__(self, *args, **kwargs):
 		super(LimitsAwareBot, self).__init__(*args, **kwargs)
 		self.logger = logging.getLogger(__name__)
-		self.outpost_timings = {}
-
-	def is_hitting_limits(self, chat_id):
-		if chat_id not in self.outpost_timings:
-			self.outpost_timings[chat_id] = collections.deque([dt.datetime.fromtimestamp(0)] * 20)
-		return (dt.datetime.now() - self.outpost_timings[chat_id][-1]).seconds < 1 \
-				or (dt.datetime.now() - self.outpost_timings[chat_id][-self.ALLOWED_PER_MIN]).seconds < 60
-
-	def sendMessage(self, chat_id, *args, **kwargs):
+		self.rate_scheduler = rate_limits.RateScheduler(self.MESSAGES_PER_SECOND, self.MESSAGES_BURST,
+				self.CHAT_MESSAGES_PER_SECOND, 1, peer_limits=self._chat_limits)
+		self.queues = [[] for _ in xrange(self.PRIORITY_NOTIFICATION + 1)]  # of PendingCall, by priority
+		self.busy_chats = set()
+		self.parked_chats = set()
+		self.closed = False
+		self.cv = threading.Condition()
+		self.last_eviction_time = time.time()
+		self.rejections = 0
+		for i in xrange(self.SEND_WORKERS):
+			worker = threading.Thread(target=self._worker, name="LimitsAwareBot-{0}".format(i))
+			worker.daemon = True
+			worker.start()
+
+	def _chat_limits(self, chat_id):
+		# negative ids are groups
+		return (self.CHAT_MESSAGES_PER_SECOND if chat_id > 0 else self.GROUP_MESSAGES_PER_SECOND), 1
+
+	@staticmethod
+	def _chat_of(call):
+		return call.method_args["chat_id"]
+
+	def send(self, chat_id, text, priority=PRIORITY_PIPE, not_before=None, park_on_error=False, **kwargs):
+		"""
+		Queues a message
+		:param not_before: unix time the message is held until, later messages to the chat wait for it
+		:param park_on_error: whether a failure of the send holds the later sends to the chat until `resume`
+		:return: PendingCall of the sent message, a TelegramError of the send is raised by its `result`
 		"""
+		kwargs.update(chat_id=chat_id, text=text)
+		call = rate_limits.PendingCall("sendMessage", kwargs)
+		call.priority = priority
+		call.not_before = not_before or 0
+		call.park_on_error = park_on_error
+		with self.cv:
+			if self.closed:
+				raise UserWarning("The bot is closed")
+			self.queues[priority].append(call)
+			self.cv.notify()
+		return call
+
+	def sendMessage(self, chat_id, text, parse_mode=None, disable_web_page_preview=None, disable_notification=None,
+			reply_to_message_id=None, reply_markup=None, priority=PRIORITY_PIPE):
+		"""
+		Sends through the queue and waits for the send, arguments are of telepot.Bot.sendMessage
 		:return: True if a deliver was successful, False otherwise
 		"""
 		try:
-			super(LimitsAwareBot, self).sendMessage(chat_id, *args, **kwargs)
+			self.send(chat_id, text, priority, parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview,
+					disable_notification=disable_notification, reply_to_message_id=reply_to_message_id,
+					reply_markup=reply_markup).result(self.TIMEOUT_SECONDS)
 		except telepot.exception.TelepotException as e:
 			self.logger.error("Cannot deliver a message. Reason: %s", e.message)
 			return False
 		except BaseException as be:
 			self.logger.exception("Unexpected excepton: %s", be.message)
 			return False
-		if chat_id not in self.outpost_timings:
-			self.outpost_timings[chat_id] = collections.deque([dt.datetime.fromtimestamp(0)] * 20)
-		self.outpost_timings[chat_id].append(dt.datetime.now())
-		self.outpost_timings[chat_id].popleft()
 		return True
 
+	def cancel(self, calls):
+		"""
+		Takes queued sends back, they fail with UserWarning. Sends in progress are not affected
+		:return: list of cancelled calls
+		"""
+		calls = set(id(call) for call in calls)
+		with self.cv:
+			cancelled = [call for queue in self.queues for call in queue if id(call) in calls]
+			for queue in self.queues:
+				queue[:] = [call for call in queue if id(call) not in calls]
+		for call in cancelled:
+			call.set_result(error=UserWarning("The send is cancelled"))
+		return cancelled
+
+	def resume(self, chat_id):
+		"""
+		Releases sends to a chat parked by a failure
+		"""
+		with self.cv:
+			self.parked_chats.discard(chat_id)
+			self.cv.notify_all()
+
+	def queued(self):
+		with self.cv:
+			return sum(len(queue) for queue in self.queues)
+
+	def _next_send(self):
+		"""
+		Waits (under `cv`) until a send is allowed
+		:return: PendingCall, None if closed
+		"""
+		while not self.closed:
+			now = time.time()
+			if now - self.last_eviction_time > self.EVICTION_PERIOD_SECONDS:
+				self.last_eviction_time = now
+				self.rate_scheduler.evict_idle(now)
+			calls = []
+			held_chats = self.busy_chats | self.parked_chats
+			wait = None
+			for queue in self.queues:
+				for call in queue:
+					chat_id = self._chat_of(call)
+					if chat_id in held_chats:
+						continue
+					if call.not_before > now:
+						held_chats.add(chat_id)
+						wait = min(wait, call.not_before - now) if wait is not None else call.not_before - now
+						continue
+					calls.append(call)
+			if calls:
+				budget_wait = self.rate_scheduler.request_delay(now)
+				if budget_wait <= 0:
+					selected, budget_wait = self.rate_scheduler.select(calls, 1, self._chat_of, now)
+					if selected:
+						call = selected[0]
+						self.rate_scheduler.consume_request(now)
+						self.queues[call.priority].remove(call)
+						self.busy_chats.add(self._chat_of(call))
+						return call
+				if budget_wait is not None:
+					wait = min(wait, budget_wait) if wait is not None else budget_wait
+			self.cv.wait(wait)
+		return None
+
+	def _worker(self):
+		while True:
+			with self.cv:
+				call = self._next_send()
+			if call is None:
+				return
+			self._deliver(call)
+
+	def _deliver(self, call):
+		chat_id = self._chat_of(call)
+		call.attempts += 1
+		result = error = None
+		try:
+			result = super(LimitsAwareBot, self).sendMessage(**call.method_args)
+			self.rate_scheduler.on_success(chat_id)
+		except telepot.exception.TelegramError as e:
+			error = e
+			if e.error_code == self.TOO_MANY_REQUESTS:
+				retry_after = e.json.get("parameters", {}).get("retry_after") if isinstance(e.json, dict) else None
+				self.rate_scheduler.on_rejected(chat_id, retry_after)
+				self.rejections += 1
+				self.logger.warning("LimitsAwareBot: too many requests to chat %d, retry after %s s", chat_id,
+						retry_after)
+		except BaseException as be:
+			error = be
+		with self.cv:
+			self.busy_chats.discard(chat_id)
+			is_retried = error is not None and getattr(error, "error_code", None) == self.TOO_MANY_REQUESTS and \
+					call.attempts < self.MAX_ATTEMPTS and not self.closed
+			if is_retried:
+				# ahead of the later sends to the chat
+				self.queues[call.priority].insert(0, call)
+			elif error is not None and call.park_on_error:
+				# no later send to the chat may go before the owner has taken them back
+				self.parked_chats.add(chat_id)
+			self.cv.notify_all()
+		if not is_retried:
+			call.set_result(result, error)
+
+	def close(self):
+		with self.cv:
+			self.closed = True
+			calls = [call for queue in self.queues for call in queue]
+			self.queues = [[] for _ in self.queues]
+			self.cv.notify_all()
+		for call in calls:
+			call.set_result(error=UserWarning("The bot is closed"))
+
 
 if __name__ == "__main__":
 	logging.basicConfig(format='%(asctime)s:%(levelname)s:%(name)s:%(message)s', level=logging.INFO)
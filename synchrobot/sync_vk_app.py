@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 # Author: Ivan Senin
 import Queue
+import collections
 import datetime as dt
+import functools
+import json
 import logging
+import os
 import requests
+import requests.adapters
 import threading
 import time
 
@@ -12,7 +17,8 @@ import vk_requests
 import vk_requests.exceptions
 from vk_requests.auth import VKSession
 
-from synchrobot import db_ops
+from synchrobot import caching, db_ops, rate_limits, worker_pool
+from synchrobot.rate_limits import PendingCall
 from synchrobot.chat_user import User
 import stats_processing
 
@@ -20,8 +26,13 @@ _WATCHES_FOR = "watches_for"
 
 class SyncVkNode(object):
 	NEW_MESSAGE_ID = 4
+	STATS_WORKERS = None  # a process per core
+	STATS_TIMEOUT_SECONDS = 60
 
-	def __init__(self, app_id, token):
+	def __init__(self, app_id, token, storage=None):
+		"""
+		:param storage: db_ops.Storage of the vk platform. DBClient is used by default
+		"""
 		self.logger = logging.getLogger(__name__)
 		self.app_id = app_id
 		self.__token = token
@@ -31,28 +42,35 @@ class SyncVkNode(object):
 		self._api = vk_requests.API(session)
 		self._api.friends.get()  # test
 		self.logger.info("vk connection established")
+		self.batching_api = VkExecuteBatcher(token, session.auth_api.api_version)
+		# /stats workers load the plotting stack on their own: the node process never imports it
+		self.render_pool = worker_pool.WorkerPool(self.STATS_WORKERS, timeout_seconds=self.STATS_TIMEOUT_SECONDS,
+				initializer=stats_processing.load_plotting)
 
-		self.db_client = db_ops.DBClient("vk")
+		self.db_client = storage if storage is not None else db_ops.DBClient("vk")
+		self.ingest_buffer = db_ops.MessageIngestBuffer(self.db_client)
 		self.users_d = self.db_client.fetch_users()
-		self.logger.info("%d users were fetched from db", len(self.users_d.keys()))
-		self.users_d_mx = threading.Lock()
+		self.logger.info("%d users were fetched from db", len(self.users_d))
 
 		self.chats_to_monitor = self.db_client.get_monitored_chats()
 		self.logger.info("%d chatd_ids to monitor were fetched from db", len(self.chats_to_monitor))
 		self.monitoring_mx = threading.Lock()
 
-		self.msg_queue = Queue.Queue(100)
+		self.msg_queue = db_ops.WakingQueue(100)
 		self.new_users_q = Queue.Queue()
-		self.outbox_msg_ids = []
-		self.outbox_msg_ids_mx = threading.Lock()
-		self.chats_to_activate_q = Queue.Queue()
+		self.outbox = Outbox()
+		self.chats_to_activate_q = db_ops.WakingQueue()
 		self.pending_chats_d = self.db_client.get_pending_chat_ids()
-		self.request_for_stats_q = Queue.Queue()
+		self.request_for_stats_q = db_ops.WakingQueue()
+		self.longpoll_worker = None
 		self.extend_vk_api()
 
 	def extend_vk_api(self):
 		self._api.fetch_users_from_web = self.fetch_users_from_web
 		self._api.get_user_objects = self.get_user_objects
+		self.batching_api.fetch_users_from_web = self.fetch_users_from_web
+		self.batching_api.add_users_from_web = self.add_users_from_web
+		self.batching_api.get_user_objects = self.get_user_objects
 
 	def fetch_users_from_web(self, ids, overwrite_users=False):
 		"""
@@ -66,19 +84,24 @@ class SyncVkNode(object):
 		assert isinstance(ids, list) and (isinstance(ids[0], int) or isinstance(ids[0], basestring)), "Type error"
 		self.logger.info("fetching users' information via web...")
 		try:
-			users_info = self._api.users.get(user_ids= ids,	fields='domain')
+			users_info = self.batching_api.users.get(user_ids=ids, fields='domain')
 		except BaseException as e:
 			self.logger.exception("Cannot fetch users from vk. Reason: %s", e.message)
 			return
+		return self.add_users_from_web(users_info, overwrite_users)
 
+	def add_users_from_web(self, users_info, overwrite_users=False):
+		"""
+		Registers users of a users.get answer (with the `domain` field)
+		:return: list of new users as `User` objects
+		"""
 		result = []
 		for user_info in users_info:
 			id = user_info['id']
-			if id in self.users_d.keys() and not overwrite_users:
+			if id in self.users_d and not overwrite_users:
 				continue
 			new_user = User(id, user_info['first_name'], 0, False, False, user_info['domain'])
-			with self.users_d_mx:
-				self.users_d[id] = new_user
+			self.users_d.add(new_user)
 			result.append(new_user)
 			self.new_users_q.put(new_user)
 		return result
@@ -95,17 +118,11 @@ class SyncVkNode(object):
 		if isinstance(ids, int) or isinstance(ids, basestring):
 			ids = [ids]
 		for id in ids:
-			if isinstance(id, int):
-				if id in self.users_d.keys():
-					result.append(self.users_d[id])
-				else:
-					unknown_ids.append(id)
-			elif isinstance(ids, basestring):
-				with self.users_d_mx:
-					if id in [user.username for user in self.users_d.values()]:
-						result.append( filter(lambda u: u.username == id, self.users_d.values())[0] )
-					else:
-						unknown_ids.append(id)
+			user = self.users_d.get(id) if isinstance(id, int) else self.users_d.find_by_username(id)
+			if user is not None:
+				result.append(user)
+			else:
+				unknown_ids.append(id)
 		result.extend(self.fetch_users_from_web(unknown_ids))
 		res_size = len(result)
 		if res_size != len(ids):
@@ -114,9 +131,7 @@ class SyncVkNode(object):
 		return result[0] if res_size == 1 else result
 
 	def find_by_username(self, username):
-		with self.users_d_mx:
-			result = filter(lambda user: user.username == username, self.users_d.values())
-		return result[0] if len(result) == 1 else result
+		return self.users_d.find_by_username(username)
 
 
 	def on_chat_message(self, msg_d):
@@ -130,7 +145,7 @@ class SyncVkNode(object):
 			if len(words) > 1:
 				try:
 					target = int(words[1])
-					user = self.users_d[target] if target in self.users_d.keys() else None
+					user = self.users_d.get(target)
 				except:
 					user = self.find_by_username(words[1])
 
@@ -154,99 +169,79 @@ class SyncVkNode(object):
 
 
 			if reply:
+				# the long-poll thread does not wait for the send
 				try:
-					self._api.messages.send(peer_id=source.id, message=reply)
+					self.outbox.submit_send(self.batching_api, peer_id=source.id,
+							message=reply).add_done_callback(self._on_reply_sent)
 				except BaseException as e:
 					self.logger.exception("Cannot send message to the user. Reason: %s", e.message)
 
-	def _start_longpoll_handler(self):
-		INVALID_VERSION = 4
-		SLEEP_SECONDS = 1
-		key = None
-		server = None
-		ts = None
-		while True:
-			if key is None:
-				try:
-					self.logger.info("Getting new keys for a long-poll...")
-					res_d = self._api.messages.getLongPollServer(need_pts=0)
-					server = res_d['server']
-					key = res_d['key']
-					ts = res_d['ts']
-					self.logger.info("Got keys. Success")
-				except BaseException as e:
-					self.logger.exception("Unable to get new long-poll keys. Reason: %s", e.message)
-					time.sleep(3)
-					ontinue
-
-			url = "https://{0}?act=a_check&key={1}&ts={2}&wait=25&mode=2".format(server, key, ts)
-			try:
-				req = requests.get(url)
-				answer = req.json()
-			except BaseException as e:
-				self.logger.exception("Long-poll request failure. Reason: %s", e.message)
-				time.sleep(SLEEP_SECONDS)
-				continue
+	def _on_reply_sent(self, call):
+		try:
+			call.result(0)
+		except BaseException as e:
+			self.logger.error("Cannot send message to the user. Reason: %s", e.message)
 
-			if 'failed' in answer:
-				self.logger.warning("Received `fail` from long-poll reply")
-				if answer['failed'] == INVALID_VERSION:
-					self.logger.error("Bad stuff: longpoll retured fail- %d", INVALID_VERSION)
-					raise ValueError("LongPoll resulted in FAIL-4")
-				key = None  # forces to get new keys
-				continue
-			ts = answer['ts']
-			updates = answer['updates']
-
-			for update in updates:
-				if update[0] == self.NEW_MESSAGE_ID:
-					msg_d = {'message_id': update[1],
-						'flags': update[2],
-						'from_id': update[3],
-						'timestamp': update[4],
-						'text': update[6],
-						'attachments': update[7]}
-					has_handled = False
-					with self.monitoring_mx:
-						if msg_d['from_id'] in self.chats_to_monitor:
-							self.msg_queue.put(msg_d)
+	def _start_longpoll_handler(self):
+		self.longpoll_worker = LongPollWorker(lambda: self._api.messages.getLongPollServer(need_pts=0),
+				self._on_longpoll_updates)
+		self.longpoll_worker.run()
+
+	def _on_longpoll_updates(self, updates):
+		for update in updates:
+			if update[0] == self.NEW_MESSAGE_ID:
+				msg_d = {'message_id': update[1],
+					'flags': update[2],
+					'from_id': update[3],
+					'timestamp': update[4],
+					'text': update[6],
+					'attachments': update[7]}
+				has_handled = False
+				with self.monitoring_mx:
+					if msg_d['from_id'] in self.chats_to_monitor:
+						self.msg_queue.put(msg_d)
+						has_handled = True
+					elif msg_d['from_id'] in self.pending_chats_d.keys() and msg_d['text']:
+						code = msg_d['text'].split()[0]
+						if code == self.pending_chats_d[msg_d['from_id']]:
+							self.logger.info("_on_longpoll_updates: found activation code match")
+							self.chats_to_activate_q.put((msg_d['from_id'], code))
 							has_handled = True
-						elif msg_d['from_id'] in self.pending_chats_d.keys() and msg_d['text']:
-							code = msg_d['text'].split()[0]
-							if code == self.pending_chats_d[msg_d['from_id']]:
-								self.logger.info("_start_longpoll_handler: found activation code match")
-								self.chats_to_activate_q.put((msg_d['from_id'], code))
-								has_handled = True
-					if not has_handled:
-						self.on_chat_message(msg_d)
-
-			time.sleep(SLEEP_SECONDS)
+				if not has_handled:
+					self.on_chat_message(msg_d)
 
 	def __event_loop(self, stop_signal_q):
 		collector_thread = None
 		self.logger.info("Starting event loop")
-		new_msg_handler = ChatHandler(self.db_client, self._api, self.msg_queue, self.users_d, self.outbox_msg_ids,
-				self.outbox_msg_ids_mx)
-		foreign_msg_handler = UnsyncMessagesHandler(self.db_client, self._api, self.outbox_msg_ids,
-				self.outbox_msg_ids_mx)
-		chats_state_handler = PipeUpdatesHandler(self.db_client, self.chats_to_activate_q, self._api)
+		new_msg_handler = ChatHandler(self.ingest_buffer, self.batching_api, self.msg_queue, self.users_d, self.outbox)
+		foreign_msg_handler = UnsyncMessagesHandler(self.db_client, self.batching_api, self.outbox)
+		chats_state_handler = PipeUpdatesHandler(self.db_client, self.chats_to_activate_q, self.batching_api)
 		user_updates_handler = db_ops.UserUpdatesHandler(self.db_client, self.users_d)
-		users_observer = UsersObservationHandler(self.db_client, self._api, self.users_d)
-		statistics_processor = StatisticsProcessor(self.db_client, self._api, self.request_for_stats_q)
-
+		users_observer = UsersObservationHandler(self.db_client, self.batching_api, self.users_d)
+		statistics_processor = StatisticsProcessor(self.db_client, self.batching_api, self.request_for_stats_q,
+				self.render_pool)
+		observations_compactor = ObservationsCompactionHandler(self.db_client)
+
+		self.msg_queue.consumer = new_msg_handler
+		self.chats_to_activate_q.consumer = chats_state_handler
+		self.request_for_stats_q.consumer = statistics_processor
+		scheduler = db_ops.Scheduler([new_msg_handler, foreign_msg_handler, chats_state_handler, user_updates_handler,
+				users_observer, statistics_processor, observations_compactor])
+		scheduler.wake_on(self.db_client, db_ops.StorageEvents.MESSAGES_ADDED, "vk", foreign_msg_handler)
+		scheduler.wake_on(self.db_client, db_ops.StorageEvents.PIPES_CHANGED, "vk", chats_state_handler)
 		try:
-			sleep_seconds = 0.3
 			while stop_signal_q.empty():
-				res = chats_state_handler(outbox_msg_ids_mx=self.outbox_msg_ids_mx, outbox_msg_ids=self.outbox_msg_ids)
+				res = chats_state_handler(outbox=self.outbox)
 				if not res is None:
 					self.chats_to_monitor, self.pending_chats_d = res
 				new_msg_handler()
 				foreign_msg_handler()
-				users_observer(users_mx=self.users_d_mx)
+				users_observer()
+				observations_compactor()
 				statistics_processor()
-				user_updates_handler(users_mx=self.users_d_mx, new_users=self.new_users_q)
+				user_updates_handler(new_users=self.new_users_q)
 
-				time.sleep(sleep_seconds)
+				scheduler.wait()
 				if collector_thread is None or not collector_thread.isAlive():
 					self.logger.info("Starting longpoll handler...")
 					collector_thread = threading.Thread(target=self._start_longpoll_handler)
@@ -254,122 +249,601 @@ class SyncVkNode(object):
 					collector_thread.start()
 		except KeyboardInterrupt:
 			self.logger.info("Event loop was interrupted by user")
+		finally:
+			scheduler.close()
 
 	def start(self, stop_signal_q = Queue.Queue()):
-		self.__event_loop(stop_signal_q)
-		self.db_client.close()
+		try:
+			self.__event_loop(stop_signal_q)
+		finally:
+			# the watchdog restarts a failed node in the same process: its threads and workers must not outlive it
+			if self.longpoll_worker is not None:
+				self.longpoll_worker.stop()
+			self.render_pool.close()
+			self.batching_api.close()
+			self.ingest_buffer.close()
+			self.db_client.close()
 		if not stop_signal_q.empty():
 			self.logger.info("Execution was stopped via stop-event")
 
 
-class ChatHandler(db_ops.Handler):
-	MAX_CACHED_USERS = 500
+class LongPollWorker(object):
+	"""
+	VK long-poll loop over a single keep-alive HTTP session. The next poll is issued right after updates are handed
+	off; it backs off only on errors
+	"""
+	INVALID_VERSION = 4
+	WAIT_SECONDS = 25
+	CONNECT_TIMEOUT_SECONDS = 5
+	READ_TIMEOUT_MARGIN_SECONDS = 10  # on top of WAIT_SECONDS
+	BACKOFF_BASE_SECONDS = .5
+	BACKOFF_MAX_SECONDS = 30
 
-	def __init__(self, db_client, api, msg_queue, users_d, outbox_msg_ids, outbox_msg_ids_mx):
-		super(ChatHandler, self).__init__(db_client, api)
-		self.period = dt.timedelta(seconds=3)
+	def __init__(self, get_server, on_updates, scheme="https"):
+		"""
+		:param get_server: callable returning dict with `server`, `key` and `ts` (messages.getLongPollServer)
+		:param on_updates: callable taking a list of updates
+		"""
 		self.logger = logging.getLogger(__name__)
-		self.msg_q = msg_queue
-		self.users_d = users_d
-		self.outbox_msg_ids = outbox_msg_ids
-		self.outbox_msg_ids_mx = outbox_msg_ids_mx
-
-	def find_sender_for_group_msgs(self, group_msgs):
-		if not group_msgs:
-			return
-		full_msgs_info = self.api.messages.getById(
-				message_ids=[msg['message_id'] for msg in group_msgs], preview_length=1)['items']
-		self.logger.info("Requested msgs from group chats %s", str(full_msgs_info))
-		for msg in group_msgs:
-			msg['user_id'] = (filter(lambda msg_: msg_['id'] == msg['message_id'], full_msgs_info)[0])['user_id']
+		self.get_server = get_server
+		self.on_updates = on_updates
+		self.scheme = scheme
+		self.stop_event = threading.Event()
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+		self.session.mount(scheme + "://", adapter)
+
+	def _backoff(self, errors_in_row):
+		self.stop_event.wait(min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * 2 ** (errors_in_row - 1)))
+
+	def run(self):
+		key = None
+		server = None
+		ts = None
+		errors_in_row = 0
+		try:
+			while not self.stop_event.is_set():
+				if key is None:
+					try:
+						self.logger.info("Getting new keys for a long-poll...")
+						res_d = self.get_server()
+						server = res_d['server']
+						key = res_d['key']
+						ts = res_d['ts']
+						self.logger.info("Got keys. Success")
+					except BaseException as e:
+						self.logger.exception("Unable to get new long-poll keys. Reason: %s", e.message)
+						errors_in_row += 1
+						self._backoff(errors_in_row)
+						continue
 
-	def handler_hook(self, **kwargs):
-		GROUP_IDS = 2000000000
+				try:
+					req = self.session.get("{0}://{1}".format(self.scheme, server),
+							params={'act': 'a_check', 'key': key, 'ts': ts, 'wait': self.WAIT_SECONDS, 'mode': 2},
+							timeout=(self.CONNECT_TIMEOUT_SECONDS, self.WAIT_SECONDS + self.READ_TIMEOUT_MARGIN_SECONDS))
+					answer = req.json()
+				except BaseException as e:
+					self.logger.exception("Long-poll request failure. Reason: %s", e.message)
+					errors_in_row += 1
+					self._backoff(errors_in_row)
+					continue
 
-		counter = 20
-		messages = []
-		while not self.msg_q.empty() and counter > 0:
-			counter -= 1
-			msg = self.msg_q.get()
-			with self.outbox_msg_ids_mx:
-				if msg['message_id'] in self.outbox_msg_ids:
-					self.outbox_msg_ids.remove(msg['message_id'])
+				if 'failed' in answer:
+					self.logger.warning("Received `fail` from long-poll reply")
+					if answer['failed'] == self.INVALID_VERSION:
+						self.logger.error("Bad stuff: longpoll retured fail- %d", self.INVALID_VERSION)
+						raise ValueError("LongPoll resulted in FAIL-4")
+					if 'ts' in answer:
+						ts = answer['ts']  # history is outdated, keys are still valid
+					else:
+						key = None  # forces to get new keys
 					continue
-			messages.append(msg)
+				errors_in_row = 0
+				ts = answer['ts']
+				self.on_updates(answer['updates'])
+		finally:
+			self.session.close()
+
+	def stop(self):
+		self.stop_event.set()
+
+
+class VkExecuteBatcher(object):
+	"""
+	A proxy of the vk API which coalesces calls of all its callers into `execute` requests of up to MAX_BATCH_SIZE
+	calls. `proxy.messages.send(**kwargs)` blocks until its own result arrives, `proxy.submit(method, **kwargs)`
+	returns a PendingCall right away. A failed call raises VkAPIError of its own, other calls of the batch are
+	not affected.
+	Requests and sends to a peer are released by a RateScheduler as soon as there is budget; its rates adapt to
+	"too many requests" and "flood control" errors. Rejected requests are retried
+	"""
+	MAX_BATCH_SIZE = 25  # execute limit
+	MAX_DELAY_SECONDS = .05  # the first call of a batch waits for company that long
+	REQUESTS_PER_SECOND = 3  # per user token
+	REQUESTS_BURST = 3
+	PEER_SENDS_PER_SECOND = 1
+	PEER_SENDS_BURST = 5
+	PEER_LIMITED_METHODS = frozenset(["messages.send"])
+	TOO_MANY_REQUESTS = 6
+	FLOOD_CONTROL = 9
+	MAX_ATTEMPTS = 5
+	TIMEOUT_SECONDS = 20
+
+	def __init__(self, token, api_version, api_url=VKSession.API_URL, rate_scheduler=None):
+		self.logger = logging.getLogger(__name__)
+		self.token = token
+		self.api_version = api_version
+		self.execute_url = api_url + "execute"
+		self.rate_scheduler = rate_scheduler if rate_scheduler is not None else rate_limits.RateScheduler(
+				self.REQUESTS_PER_SECOND, self.REQUESTS_BURST, self.PEER_SENDS_PER_SECOND, self.PEER_SENDS_BURST)
+		self.session = requests.Session()
+		self.calls = []
+		self.closed = False
+		self.cv = threading.Condition()
+		self.requests_made = 0
+		self.calls_made = 0
+		self.flusher_thread = threading.Thread(target=self._flusher)
+		self.flusher_thread.daemon = True
+		self.flusher_thread.start()
+
+	def __getattr__(self, name):
+		if name.startswith("_"):
+			raise AttributeError(name)
+		return _BatchedMethod(self, name)
+
+	def submit(self, method, **method_args):
+		call = PendingCall(method, method_args)
+		with self.cv:
+			if self.closed:
+				raise UserWarning("The batcher is closed")
+			self.calls.append(call)
+			self.cv.notify()
+		return call
+
+	def call(self, method, **method_args):
+		return self.submit(method, **method_args).result(self.TIMEOUT_SECONDS)
+
+	def _peer_of(self, call):
+		return call.method_args.get("peer_id") if call.method in self.PEER_LIMITED_METHODS else None
+
+	def _flusher(self):
+		while True:
+			with self.cv:
+				batch = self._next_batch()
+			if batch is None:
+				return
+			self._execute(batch)
 
-		group_msgs = []
+	def _next_batch(self):
+		"""
+		Waits (under `cv`) until a batch may be sent
+		:return: list of calls, None if closed
+		"""
+		while not self.closed:
+			if not self.calls:
+				self.cv.wait()
+				continue
+			now = time.time()
+			# the first call collects company unless the batch is full already
+			wait = 0 if len(self.calls) >= self.MAX_BATCH_SIZE else \
+					self.calls[0].submit_time + self.MAX_DELAY_SECONDS - now
+			wait = max(wait, self.rate_scheduler.request_delay(now))
+			if wait <= 0:
+				batch, wait = self.rate_scheduler.select(self.calls, self.MAX_BATCH_SIZE, self._peer_of, now)
+				if batch:
+					self.rate_scheduler.consume_request(now)
+					selected = set(id(call) for call in batch)
+					self.calls = [call for call in self.calls if id(call) not in selected]
+					return batch
+			self.cv.wait(wait)
+		return None
+
+	@staticmethod
+	def _encode_args(method_args):
+		args = {}
+		for key, value in method_args.iteritems():
+			if isinstance(value, (list, tuple)):
+				value = ",".join(str(item) for item in value)
+			if isinstance(value, str):
+				value = value.decode("utf-8")
+			args[key] = value
+		return json.dumps(args, ensure_ascii=False)
+
+	def _retry(self, batch):
+		"""
+		:return: calls which are out of attempts
+		"""
+		with self.cv:
+			if self.closed:
+				return batch
+			self.calls = [call for call in batch if call.attempts < self.MAX_ATTEMPTS] + self.calls
+			self.cv.notify()
+		return [call for call in batch if call.attempts >= self.MAX_ATTEMPTS]
+
+	def _execute(self, batch):
+		code = u"return [" + u",".join(u"API.{0}({1})".format(call.method, self._encode_args(call.method_args))
+				for call in batch) + u"];"
+		self.requests_made += 1
+		for call in batch:
+			call.attempts += 1
+		try:
+			req = self.session.post(self.execute_url, timeout=self.TIMEOUT_SECONDS,
+					data={"code": code.encode("utf-8"), "access_token": self.token, "v": self.api_version})
+			answer = req.json()
+			if "error" in answer:
+				raise vk_requests.exceptions.VkAPIError(answer["error"])
+			results = answer["response"]
+		except vk_requests.exceptions.VkAPIError as e:
+			failed = batch
+			if e.code == self.TOO_MANY_REQUESTS:
+				# nothing was executed: back to the queue, at a lower rate
+				self.rate_scheduler.on_rejected()
+				self.logger.warning("VkExecuteBatcher: too many requests, the rate is %.2f requests/s",
+						self.rate_scheduler.get_rates()[0])
+				failed = self._retry(batch)
+			for call in failed:
+				call.set_result(error=e)
+			return
+		except BaseException as e:
+			self.logger.error("VkExecuteBatcher: execute of %d calls failed. Reason: %s", len(batch), e.message)
+			for call in batch:
+				call.set_result(error=e)
+			return
+		self.rate_scheduler.on_success()
+		self.calls_made += len(batch)
+
+		# a failed call results in `false`, its error is the next one of execute_errors
+		errors = iter(answer.get("execute_errors", []))
+		for call, result in zip(batch, results):
+			if result is False:
+				error_data = next(errors, {"error_code": None, "error_msg": "execute: {0} failed".format(call.method)})
+				error = vk_requests.exceptions.VkAPIError(error_data)
+				if error.code == self.FLOOD_CONTROL:
+					self.rate_scheduler.on_rejected(self._peer_of(call))
+				elif error.code == self.TOO_MANY_REQUESTS:
+					self.rate_scheduler.on_rejected()
+				call.set_result(error=error)
+			else:
+				if self._peer_of(call) is not None:
+					self.rate_scheduler.on_success(self._peer_of(call))
+				call.set_result(result)
+		for call in batch[len(results):]:
+			call.set_result(error=UserWarning("execute returned no result for " + call.method))
+
+	def close(self):
+		with self.cv:
+			self.closed = True
+			calls = self.calls
+			self.calls = []
+			self.cv.notify()
+		for call in calls:
+			call.set_result(error=UserWarning("The batcher is closed"))
+		self.session.close()
+		self.logger.info("VkExecuteBatcher closed. %d calls within %d requests, %d rate decreases", self.calls_made,
+				self.requests_made, self.rate_scheduler.decreases)
+
+
+class _BatchedMethod(object):
+	def __init__(self, batcher, method):
+		self.batcher = batcher
+		self.method = method
+
+	def __getattr__(self, name):
+		return _BatchedMethod(self.batcher, self.method + "." + name)
+
+	def __call__(self, **method_args):
+		return self.batcher.call(self.method, **method_args)
+
+
+class SenderLookup(object):
+	"""
+	Senders of a batch of messages being resolved: a call of the lookup is in flight until `SenderResolver.poll`
+	tells it is done
+	"""
+	def __init__(self, messages):
+		self.messages = messages
+		self.group_msgs = []
+		self.call = None
+		self.unknown_ids = None  # ids asked from users.get, None while senders of group messages are asked
+		self.profiles = {}
+
+
+class SenderResolver(object):
+	"""
+	Resolves senders of incoming messages. Senders of group messages come from a single messages.getById per batch,
+	profiles come from the user registry: the web is asked only for truly unknown ids. Ids the web cannot resolve
+	are cached negatively for NEGATIVE_TTL_SECONDS.
+	Calls are asynchronous: `on_progress` is called on the thread of the API once a call of a lookup is done
+	"""
+	GROUP_IDS = 2000000000
+	NEGATIVE_CACHE_SIZE = 1000
+	NEGATIVE_TTL_SECONDS = 10 * 60
+	REPORT_PERIOD_SECONDS = 60
+
+	def __init__(self, api, users, on_progress):
+		"""
+		:param api: VkExecuteBatcher
+		"""
+		self.logger = logging.getLogger(__name__)
+		self.api = api
+		self.users = users
+		self.on_progress = on_progress
+		self.failed_ids = caching.LRUCache(self.NEGATIVE_CACHE_SIZE, self.NEGATIVE_TTL_SECONDS)
+		self.counters = collections.Counter()
+		self.last_report_time = time.time()
+
+	def _submit(self, lookup, method, **method_args):
+		lookup.call = self.api.submit(method, **method_args)
+		lookup.call.add_done_callback(lambda call: self.on_progress())
+
+	def start(self, messages):
+		"""
+		:return: SenderLookup of the messages, to be polled
+		"""
+		lookup = SenderLookup(messages)
 		for msg in messages:
-			if msg['from_id'] > GROUP_IDS:
-				group_msgs.append(msg)
+			if msg['from_id'] > self.GROUP_IDS:
+				lookup.group_msgs.append(msg)
 			else:
 				msg['user_id'] = msg['from_id']
+		if lookup.group_msgs:
+			self.counters["getById_calls"] += 1
+			self._submit(lookup, "messages.getById", message_ids=[msg['message_id'] for msg in lookup.group_msgs],
+					preview_length=1)
+		else:
+			self._lookup_profiles(lookup)
+		return lookup
+
+	def _lookup_profiles(self, lookup):
+		lookup.unknown_ids = []
+		for user_id in set(msg['user_id'] for msg in lookup.messages if msg['user_id'] is not None):
+			self.counters["lookups"] += 1
+			user = self.users.get(user_id)
+			if user is not None:
+				self.counters["hits"] += 1
+				lookup.profiles[user_id] = user
+			elif self.failed_ids.get(user_id):
+				self.counters["negative_hits"] += 1
+			else:
+				lookup.unknown_ids.append(user_id)
+		if lookup.unknown_ids:
+			self.counters["users_get_calls"] += 1
+			self._submit(lookup, "users.get", user_ids=lookup.unknown_ids, fields='domain')
+		elif lookup.messages:
+			# every batch used to ask the web for all its senders
+			self.counters["users_get_saved"] += 1
+
+	def _on_messages(self, lookup, answer):
+		self.logger.info("Requested msgs from group chats %s", str(answer['items']))
+		senders = dict((msg_['id'], msg_['user_id']) for msg_ in answer['items'])
+		for msg in lookup.group_msgs:
+			msg['user_id'] = senders.get(msg['message_id'])
+		self._lookup_profiles(lookup)
+
+	def _on_users(self, lookup, users_info):
+		self.api.add_users_from_web(users_info)
+		for user_id in lookup.unknown_ids:
+			user = self.users.get(user_id)
+			if user is None:
+				self.logger.warning("SenderResolver: vk does not know user %d", user_id)
+				self.failed_ids.put(user_id, True)
+			else:
+				lookup.profiles[user_id] = user
+
+	def poll(self, lookup):
+		"""
+		Takes results of finished calls of the lookup and submits the next one. Once done, msg['user_id'] of every
+		message is set, None if a group message is unknown to the server. Raises on an API failure
+		:return: dict of user id to `User` once the lookup is done (senders which cannot be resolved are missing),
+			None while a call is in flight
+		"""
+		while lookup.call is not None:
+			if not lookup.call.done():
+				return None
+			call, lookup.call = lookup.call, None
+			if lookup.unknown_ids is None:
+				self._on_messages(lookup, call.result(0))
+			else:
+				self._on_users(lookup, call.result(0))
+		self.report()
+		return lookup.profiles
+
+	def report(self):
+		now = time.time()
+		if now - self.last_report_time < self.REPORT_PERIOD_SECONDS:
+			return
+		minutes = (now - self.last_report_time) / 60
+		lookups = max(self.counters["lookups"], 1)
+		self.logger.info("SenderResolver: %d lookups, %.1f%s registry hits, %.1f%s negative hits; per minute: %.1f "
+				"users.get calls saved, %.1f users.get and %.1f messages.getById calls", self.counters["lookups"],
+				self.counters["hits"] * 100. / lookups, "%", self.counters["negative_hits"] * 100. / lookups, "%",
+				self.counters["users_get_saved"] / minutes, self.counters["users_get_calls"] / minutes,
+				self.counters["getById_calls"] / minutes)
+		self.counters = collections.Counter()
+		self.last_report_time = now
+
+
+class Outbox(object):
+	"""
+	Ids of messages sent by the node: the long-poll echoes them back and they must not be piped once again.
+	Sends are asynchronous, so an echo may come before its send returns: while sends are in flight an outgoing
+	message of an unknown id cannot be told apart yet
+	"""
+	OUTGOING_FLAG = 2  # of a long-poll message
+	MAX_IDS = 1000
+
+	def __init__(self):
+		self.mx = threading.RLock()
+		self.ids = set()
+		self.ids_order = collections.deque()
+		self.in_flight = 0
+
+	def send_started(self):
+		with self.mx:
+			self.in_flight += 1
+
+	def send_finished(self, msg_id=None):
+		"""
+		:param msg_id: id of the sent message, None if the send failed
+		"""
+		with self.mx:
+			self.in_flight -= 1
+			if msg_id is not None:
+				self.add(msg_id)
+
+	def _on_send_done(self, call):
+		try:
+			msg_id = call.result(0)
+		except BaseException:
+			msg_id = None
+		self.send_finished(msg_id)
+
+	def submit_send(self, api, **method_args):
+		"""
+		Submits messages.send to the batcher `api`, the send is accounted until it is done
+		:return: PendingCall
+		"""
+		self.send_started()
+		try:
+			call = api.submit("messages.send", **method_args)
+		except BaseException:
+			self.send_finished()
+			raise
+		call.add_done_callback(self._on_send_done)
+		return call
+
+	def add(self, msg_id):
+		with self.mx:
+			self.ids.add(msg_id)
+			self.ids_order.append(msg_id)
+			while len(self.ids_order) > self.MAX_IDS:
+				self.ids.discard(self.ids_order.popleft())
+
+	def is_echo(self, msg_d):
+		"""
+		:return: True for an echo of a sent message, False for a message to pipe, None if it is too early to tell
+		"""
+		with self.mx:
+			if msg_d['message_id'] in self.ids:
+				self.ids.discard(msg_d['message_id'])
+				return True
+			if msg_d['flags'] & self.OUTGOING_FLAG and self.in_flight > 0:
+				return None
+			return False
 
+
+class ChatHandler(db_ops.Handler):
+	MAX_CACHED_USERS = 500
+	MAX_MESSAGES_PER_TICK = 100  # messages.getById limit
+	RETRY_DELAY = dt.timedelta(seconds=3)
+	ECHO_CHECK_DELAY = dt.timedelta(milliseconds=200)
+
+	def __init__(self, ingest_buffer, api, msg_queue, users_d, outbox):
+		super(ChatHandler, self).__init__(api=api)
+		self.period = self.FALLBACK_PERIOD  # woken up by the long-poll and by finished calls
+		self.logger = logging.getLogger(__name__)
+		self.ingest_buffer = ingest_buffer
+		self.msg_q = msg_queue
+		self.sender_resolver = SenderResolver(api, users_d, self.wake)
+		self.lookup = None  # senders of a batch in flight, later messages wait for it to keep their order
+		self.retry_messages = []
+		self.outbox = outbox
+
+	def _take_messages(self):
+		candidates = self.retry_messages
+		self.retry_messages = []
+		counter = self.MAX_MESSAGES_PER_TICK - len(candidates)
+		while not self.msg_q.empty() and counter > 0:
+			counter -= 1
+			candidates.append(self.msg_q.get())
+		if not self.msg_q.empty():
+			self.wake()
+
+		messages = []
+		held_chats = set()
+		for msg in candidates:
+			if msg['from_id'] in held_chats:
+				self.retry_messages.append(msg)
+				continue
+			is_echo = self.outbox.is_echo(msg)
+			if is_echo is None:
+				# held until sends in flight are done, later messages of the chat wait for it
+				held_chats.add(msg['from_id'])
+				self.retry_messages.append(msg)
+			elif not is_echo:
+				messages.append(msg)
+		if self.retry_messages:
+			self.run_again_in(self.ECHO_CHECK_DELAY)
+		return messages
+
+	def handler_hook(self, **kwargs):
+		# senders are resolved by calls in flight, the hook never waits for them: a batch is stored once its calls
+		# are done
+		if self.lookup is None:
+			messages = self._take_messages()
+			if not messages:
+				return
+		else:
+			messages = self.lookup.messages
 		try:
-			self.find_sender_for_group_msgs(group_msgs)
-			self.api.fetch_users_from_web([msg['user_id'] for msg in messages])
+			if self.lookup is None:
+				self.lookup = self.sender_resolver.start(messages)
+			senders = self.sender_resolver.poll(self.lookup)
 		except BaseException as e:
-			self.logger.exception("Cannot get additional information about group messages. Reason: %s", e.message)
-			# saving group messages back to queue. Hope to successfully save them within next iteration
-			for g_msg in group_msgs:
-				self.msg_q.put(g_msg)
-				messages.remove(g_msg)
+			self.logger.exception("Cannot get additional information about messages. Reason: %s", e.message)
+			# hope to successfully save them within next iteration
+			self.retry_messages = messages + self.retry_messages
+			self.lookup = None
+			self.run_again_in(self.RETRY_DELAY)
+			return
+		if senders is None:
+			return
+		self.lookup = None
+		self.wake()  # the next batch
 
 		for msg in messages:
 			self.logger.info("ChatHandler: flushing to db msg: %s", str(msg))
-			self.db_client.add_msg(
+			sender = senders.get(msg['user_id'])
+			if sender is None:
+				self.logger.warning("ChatHandler: sender of msg %d is unknown", msg['message_id'])
+			self.ingest_buffer.put(
 					msg_id=msg['message_id'],
 					chat_id=msg['from_id'],
-					sender_id=msg['user_id'],
-					sender_name=self.users_d[msg['user_id']].name,
-					username=self.users_d[msg['user_id']].username,
+					sender_id=msg['user_id'] or 0,
+					sender_name=sender.name if sender else u"id{0}".format(msg['user_id'] or "?"),
+					username=sender.username if sender else u"",
 					msg_type="text",
 					content=msg['text'],
 					date=msg['timestamp'])
 
 
-class UnsyncMessagesHandler(db_ops.Handler):
-	def __init__(self, db_client, api, outbox_msg_ids, outbox_msg_ids_mx):
-		super(UnsyncMessagesHandler, self).__init__(db_client, api)
-		self.period = dt.timedelta(seconds=4)
-		self.logger = logging.getLogger(__name__)
-		self.outbox_msg_ids = outbox_msg_ids
-		self.outbox_msg_ids_mx = outbox_msg_ids_mx
-		self.send_counter = 3
-		self.send_counter_mx = threading.Lock()
+class UnsyncMessagesHandler(db_ops.UnsyncDeliveryHandler):
+	"""
+	Sends are released by the batcher as the rate budget allows. Sends of an execute request are all executed even if
+	an earlier one fails, so none can be taken back: a chat has a single send in flight
+	"""
+	CHAT_KEY = "vk_chat_id"
+	MAX_MESSAGE_LENGTH = 4096  # messages.send limit
+	SENDS_PER_CHAT = 1
 
-	def handler_hook(self, **kwargs):
-		for row_dict in self.db_client.fetch_unsync_messages():
-			with self.send_counter_mx:
-				self.send_counter -= 1
-			self.logger.info("Sending unsync message: %s ", str(row_dict))
-			msg_time = dt.datetime.fromtimestamp(row_dict["date"]).strftime('%H:%M:%S')
-			msg_text = "{0} ({1}), {2}: {3}".format(row_dict["sender_name"].encode('utf-8'),
-					row_dict["username"].encode('utf-8'), msg_time, row_dict["content"].encode('utf-8'))
-			target_chat = row_dict["vk_chat_id"]
-			with self.send_counter_mx:
-				if self.send_counter <= 0:
-					time.sleep(1)
-					self.send_counter = 3
-				try:
-					new_msg_id = self.api.messages.send(peer_id=target_chat,
-							chat_id=target_chat, random_id=row_dict['date'], message=msg_text)
-					with self.outbox_msg_ids_mx:
-						self.outbox_msg_ids.append(new_msg_id)
-					row_dict['sent'] = True
-				except vk_requests.exceptions.VkAPIError as e:
-					self.logger.error("UnsyncMessagesHandler: vk api error: %s; text: %s", e.message, msg_text)
-					msg = e.message.split()
-					if msg[0] == "Flood":
-						self.api.messages.send(peer_id=target_chat, chat_id=target_chat,
-								message="<Banned by flood control>")
-				except BaseException as be:
-					self.logger.exception("Unexpected exception: %s", be.message)
+	def __init__(self, db_client, api, outbox, coalesce=True):
+		"""
+		:param api: VkExecuteBatcher
+		"""
+		super(UnsyncMessagesHandler, self).__init__(db_client, api, coalesce)
+		self.outbox = outbox
+
+	def submit_send(self, chat_id, row_dicts, msg_text):
+		# a resend of the same rows is deduplicated by vk, a merge which has grown since is not. On flood control
+		# the batcher decreases the rate of the chat
+		return self.outbox.submit_send(self.api, peer_id=chat_id, chat_id=chat_id,
+				random_id=row_dicts[-1]["internal_id"], message=msg_text)
 
 
 class PipeUpdatesHandler(db_ops.Handler):
 	def __init__(self, db_client, chats_to_update_q, api):
 		super(PipeUpdatesHandler, self).__init__(db_client, api)
-		self.period = dt.timedelta(seconds=3)
+		self.period = self.FALLBACK_PERIOD  # woken up by activation codes and pipe changes
 		self.logger = logging.getLogger(__name__)
 		self.chats_to_update_q = chats_to_update_q
 
@@ -380,49 +854,111 @@ class PipeUpdatesHandler(db_ops.Handler):
 				if row_dict['vk_chat_id'] == vk_chat_id:
 					row_dict['confirmed'] = True
 					self.logger.info("PipeUpdatesHandler: chat %d confirmed", vk_chat_id)
-					outbox_msg_id = self.api.messages.send(peer_id=vk_chat_id, message="The pipe is confirmed")
-					with kwargs['outbox_msg_ids_mx']:
-						kwargs['outbox_msg_ids'].append(outbox_msg_id)
+					call = kwargs['outbox'].submit_send(self.api, peer_id=vk_chat_id, message="The pipe is confirmed")
+					call.add_done_callback(self._on_confirmation_sent)
 
 		chats_to_monitor = self.db_client.get_monitored_chats()
 		pending_chats_d = self.db_client.get_pending_chat_ids()
 		return chats_to_monitor, pending_chats_d
 
+	def _on_confirmation_sent(self, call):
+		try:
+			call.result(0)
+		except BaseException as e:
+			self.logger.error("PipeUpdatesHandler: cannot send a confirmation to chat %d. Reason: %s",
+					call.method_args["peer_id"], e.message)
+
+
+class ObservationEpoch(object):
+	"""
+	An observation in progress: chunks of users.get which are in flight and the states they have brought so far
+	"""
+	def __init__(self, user_ids, deadline):
+		self.timing = int(time.time())  # every state of the epoch is stored with the time the observation started
+		self.deadline = deadline
+		self.users_number = len(user_ids)
+		self.pending = []  # (user ids, attempts, PendingCall)
+		self.users_to_state_d = {}
+
 
 class UsersObservationHandler(db_ops.Handler):
 	MINUTES_FRACTION = 10
+	CHUNK_SIZE = 1000  # users.get limit of ids per call
+	MAX_CHUNK_ATTEMPTS = 3
+	MAX_OBSERVATION_TIME = dt.timedelta(minutes=2)  # the epoch is stored with the chunks collected by then
 
 	def __init__(self, db_client, api, users_d):
+		"""
+		:param api: VkExecuteBatcher
+		"""
 		super(UsersObservationHandler, self).__init__(db_client, api)
 		self.logger = logging.getLogger(__name__)
 		self.last_observation = dt.datetime.fromtimestamp(0)
 		self.users_d = users_d
+		self.epoch = None
 
 	def is_time_to_go(self, current_time):
+		if self.epoch is not None:
+			return self.wake_requested or current_time > self.epoch.deadline
 		return 0 == current_time.minute % self.MINUTES_FRACTION and \
 				current_time > self.last_observation + dt.timedelta(minutes=2)
 
-	def handler_hook(self, **kwargs):
-		users_mx = kwargs['users_mx']
-		with users_mx:
-			users_to_watch = map(lambda u: u.id, filter(lambda u: not u.muted, self.users_d.values()))
+	def seconds_to_go(self, current_time):
+		if self.is_time_to_go(current_time):
+			return 0
+		if self.epoch is not None:
+			return (self.epoch.deadline - current_time).total_seconds()
+		next_time = current_time.replace(second=0, microsecond=0) + \
+				dt.timedelta(minutes=self.MINUTES_FRACTION - current_time.minute % self.MINUTES_FRACTION)
+		return (next_time - current_time).total_seconds()
 
-		try:
-			users_info = self.api.users.get(user_ids=users_to_watch, fields="online")
-		except BaseException as be:
-			self.logger.exception("UsersObservationHandler: Unexpected exception: %s", be.message)
-			self.logger.warning("Observation was skipped")
+	def _submit_chunk(self, user_ids, attempts):
+		call = self.api.submit("users.get", user_ids=user_ids, fields="online")
+		self.epoch.pending.append((user_ids, attempts + 1, call))
+		call.add_done_callback(lambda call_: self.wake())
+
+	def handler_hook(self, **kwargs):
+		# chunks are fetched by the batcher within the rate budget, the hook only submits them and collects the
+		# finished ones: it is woken up by every finished chunk
+		if self.epoch is None:
+			users_to_watch = [user.id for user in self.users_d.values() if not user.muted]
+			self.last_observation = dt.datetime.now()
+			self.epoch = ObservationEpoch(users_to_watch, self.last_observation + self.MAX_OBSERVATION_TIME)
+			for i in xrange(0, len(users_to_watch), self.CHUNK_SIZE):
+				self._submit_chunk(users_to_watch[i:i + self.CHUNK_SIZE], 0)
+
+		pending = self.epoch.pending
+		self.epoch.pending = []
+		for user_ids, attempts, call in pending:
+			if not call.done():
+				self.epoch.pending.append((user_ids, attempts, call))
+				continue
+			try:
+				users_info = call.result(0)
+			except BaseException as be:
+				self.logger.warning("UsersObservationHandler: chunk of %d users failed (attempt %d): %s",
+						len(user_ids), attempts, be.message)
+				if attempts < self.MAX_CHUNK_ATTEMPTS:
+					self._submit_chunk(user_ids, attempts)
+				continue
+			for j_user in users_info:
+				user = self.users_d.get(j_user['id'])
+				if user is None:
+					continue
+				is_online = j_user['online'] == 1
+				using_mobile = "online_mobile" in j_user.keys()
+				self.epoch.users_to_state_d[user] = (is_online, using_mobile)
+		if self.epoch.pending and dt.datetime.now() <= self.epoch.deadline:
 			return
 
-		users_to_state_d = {}
-		for j_user in users_info:
-			id = j_user['id']
-			user = self.users_d[id]
-			is_online = j_user['online'] == 1
-			using_mobile = "online_mobile" in j_user.keys()
-			users_to_state_d[user] = (is_online, using_mobile)
-		self.db_client.append_users_observations(users_to_state_d)
-		self.last_observation = dt.datetime.now()
+		epoch = self.epoch
+		self.epoch = None
+		users_to_state_d = epoch.users_to_state_d
+		if not users_to_state_d:
+			if epoch.users_number:
+				self.logger.warning("Observation was skipped")
+			return
+		self.db_client.append_users_observations(users_to_state_d, epoch.timing)
 
 		# stats
 		total_num = len(users_to_state_d.keys())
@@ -431,15 +967,54 @@ class UsersObservationHandler(db_ops.Handler):
 		mobile_fraction = float(using_mobile * 100) / online_num if online_num else 0
 		self.logger.info("UsersObservationHandler: %d of %d are online. %.1f%s use mobile app", online_num, total_num,
 				(mobile_fraction), "%")
+		if total_num < epoch.users_number:
+			self.logger.warning("UsersObservationHandler: %d of %d users were not observed within %.0f s",
+					epoch.users_number - total_num, epoch.users_number, time.time() - epoch.timing)
+
+
+class ObservationsCompactionHandler(db_ops.Handler):
+	def __init__(self, db_client, max_age=None):
+		super(ObservationsCompactionHandler, self).__init__(db_client)
+		self.period = dt.timedelta(hours=1)
+		# the first run is delayed: let the pipe start up first
+		self.time_to_go = dt.datetime.now() + dt.timedelta(minutes=5)
+		self.logger = logging.getLogger(__name__)
+		self.max_age = max_age
+
+	def handler_hook(self, **kwargs):
+		start_time = time.time()
+		try:
+			compacted = self.db_client.compact_observations(self.max_age)
+		except BaseException as e:
+			self.logger.exception("ObservationsCompactionHandler: compaction failed. Reason: %s", e.message)
+			return
+		if compacted:
+			self.logger.info("ObservationsCompactionHandler: %d observations compacted within %.2f seconds", compacted,
+					time.time() - start_time)
 
 
 class StatisticsProcessor(db_ops.Handler):
 	RELAX_PERIOD = dt.timedelta(minutes=1)
-	def __init__(self, db_client, api, pending_users_q):
+	# plots are cached per data version: a new observation epoch comes every UsersObservationHandler.MINUTES_FRACTION
+	CACHE_SIZE = 200
+	CACHE_TTL_SECONDS = 30 * 60
+	SWEEP_PERIOD_SECONDS = 10 * 60
+
+	def __init__(self, db_client, api, pending_users_q, render_pool):
+		"""
+		:param api: VkExecuteBatcher
+		:param render_pool: worker_pool.WorkerPool
+		"""
 		super(StatisticsProcessor, self).__init__(db_client, api)
-		self.period = dt.timedelta(seconds=1)
+		self.period = self.FALLBACK_PERIOD  # woken up by requests
 		self.logger = logging.getLogger(__name__)
 		self.pending_users_q = pending_users_q
+		self.render_pool = render_pool
+		# (target id, username, latest observation time) -> (plot filename, attachment of the uploaded photo)
+		self.render_cache = caching.LRUCache(self.CACHE_SIZE, self.CACHE_TTL_SECONDS, on_evict=self._remove_plot)
+		self.rendering = {}  # cache key -> client users waiting for the plot
+		self.rendering_mx = threading.Lock()
+		self.last_sweep_time = 0
 
 	def upload_image(self, filename):
 		import pprint as pp
@@ -451,9 +1026,9 @@ class StatisticsProcessor(db_ops.Handler):
 			self.logger.error("Cannot get photos' servername. Reason: %s", e.message)
 			return
 		# step 2: post image
-		image = {'photo': open(filename, 'rb')}
 		try:
-			req = requests.post(url=upload_server['upload_url'], files=image)
+			with open(filename, 'rb') as image_f:
+				req = requests.post(url=upload_server['upload_url'], files={'photo': image_f})
 			answer = req.json()
 		except BaseException as e:
 			self.logger.error("Cannot upload image. Reason: %s", e.message)
@@ -469,45 +1044,100 @@ class StatisticsProcessor(db_ops.Handler):
 		return image_d[0]
 
 
-	def handler_hook(self, **kwargs):
-		if self.pending_users_q.empty():
-			return
-		client_user, target_user = self.pending_users_q.get()
-		if dt.datetime.now() < dt.datetime.fromtimestamp(client_user.last_seen) + self.RELAX_PERIOD:
-			return
+	def _remove_plot(self, key, entry):
 		try:
-			self.api.messages.setActivity(user_id=target_user.id, type="typing", peer_id=client_user.id)
-		except BaseException as e:
-			self.logger.warning("Cannot set typing activity. Reason: %s", e.message)
+			os.remove(entry[0])
+		except OSError as e:
+			self.logger.warning("Cannot remove plot %s. Reason: %s", entry[0], e.strerror)
 
-		start_time = time.time()
-		stats = self.db_client.get_user_statistics(target_user)
-		if 0 == max(stats.shape):
-			reply = "No statistics on user %s".format(str(target_user))
-			self.api.messages.send(peer_id=client_user.id, message=reply)
-		stats_filename = stats_processing.make_attendance_plot(stats, target_user)
-		end_time = time.time()
-		elapsed = end_time - start_time
-		self.logger.info("Statistics plot was generated within %.2f seconds. File: %s", elapsed, stats_filename)
-
-		# upload photo to vk
-		start_time = time.time()
-		image_d = self.upload_image(stats_filename)
-		if not image_d:
+	def sweep(self):
+		now = time.time()
+		if now - self.last_sweep_time < self.SWEEP_PERIOD_SECONDS:
 			return
-		end_time = time.time()
-		elapsed = end_time - start_time
-		self.logger.info("Image was uploaded to a server within %.2f seconds", elapsed)
-
+		self.last_sweep_time = now
+		expired = self.render_cache.purge_expired()
+		# plots of live entries are younger than the ttl, older ones are left by failures or by former runs
+		removed = stats_processing.remove_stale_files(self.CACHE_TTL_SECONDS + self.SWEEP_PERIOD_SECONDS)
+		self.logger.info("StatisticsProcessor: %d cached plots (%.0f%s hits), %d expired, %d stale files removed",
+				len(self.render_cache), self.render_cache.hit_rate() * 100, "%", expired, removed)
+
+	def send_stats(self, client_user, target_user, attachment):
 		reply_text = "Statistics of {0}".format(target_user.username)
-		payload = "photo{0}_{1}".format(image_d['owner_id'], image_d['id'])
+		call = self.api.submit("messages.send", peer_id=client_user.id, message=reply_text, attachment=attachment)
+		call.add_done_callback(self._on_stats_sent)
+		client_user.update_seen_time()
+		client_user.want_time = True
 
+	def _on_stats_sent(self, call):
 		try:
-			self.api.messages.send(peer_id=client_user.id, message=reply_text, attachment=payload)
+			call.result(0)
 		except BaseException as e:
 			self.logger.error("Cannot send message with statistics. Reason: %s", e.message)
-		client_user.update_seen_time()
-		client_user.want_time = True
+
+	def handler_hook(self, **kwargs):
+		# plots are rendered by the pool, uploads and replies are done by its callbacks: nothing here waits for them
+		self.sweep()
+		while not self.pending_users_q.empty():
+			client_user, target_user = self.pending_users_q.get()
+			if dt.datetime.now() < dt.datetime.fromtimestamp(client_user.last_seen) + self.RELAX_PERIOD:
+				continue
+			key = (target_user.id, target_user.username, self.db_client.get_latest_observation_time())
+			entry = self.render_cache.get(key)
+			if entry is not None:
+				self.logger.info("StatisticsProcessor: plot of %s is cached", str(target_user))
+				self.send_stats(client_user, target_user, entry[1])
+				continue
+			with self.rendering_mx:
+				if key in self.rendering:
+					self.rendering[key].append(client_user)
+					continue
+			# nobody waits for the typing activity: it goes with the next batch
+			self.api.submit("messages.setActivity", user_id=target_user.id, type="typing", peer_id=client_user.id)
+
+			histogram = self.db_client.get_user_histogram(target_user)
+			if not histogram[:, 0].any():
+				reply = "No statistics on user {0}".format(str(target_user))
+				self.api.submit("messages.send", peer_id=client_user.id, message=reply)
+				continue
+			with self.rendering_mx:
+				self.rendering[key] = [client_user]
+			on_rendered = functools.partial(self.on_rendered, key, target_user, time.time())
+			if not self.render_pool.submit(stats_processing.make_attendance_plot, (histogram, target_user),
+					on_rendered):
+				with self.rendering_mx:
+					del self.rendering[key]
+				self.logger.warning("StatisticsProcessor: %d jobs are queued, the request is rejected",
+						self.render_pool.pending())
+				self.api.submit("messages.send", peer_id=client_user.id,
+						message="Too many requests for statistics, please try again later")
+
+	def on_rendered(self, key, target_user, start_time, stats_filename, error):
+		"""
+		A callback of the render pool, called on its thread
+		"""
+		attachment = None
+		if error is not None:
+			self.logger.error("Cannot make statistics plot. Reason: %s", error.message)
+		else:
+			elapsed = time.time() - start_time
+			self.logger.info("Statistics plot was generated within %.2f seconds. File: %s", elapsed, stats_filename)
+
+			# upload photo to vk
+			start_time = time.time()
+			image_d = self.upload_image(stats_filename)
+			if image_d:
+				elapsed = time.time() - start_time
+				self.logger.info("Image was uploaded to a server within %.2f seconds", elapsed)
+				attachment = "photo{0}_{1}".format(image_d['owner_id'], image_d['id'])
+				self.render_cache.put(key, (stats_filename, attachment))
+			else:
+				self._remove_plot(key, (stats_filename, None))
+		# clients which came during the upload are served as well
+		with self.rendering_mx:
+			client_users = self.rendering.pop(key, [])
+		if attachment is not None:
+			for client_user in client_users:
+				self.send_stats(client_user, target_user, attachment)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Author: Ivan Senin
+
+import Queue
+import logging
+import multiprocessing
+import threading
+
+
+def _worker_main(conn, initializer):
+	if initializer is not None:
+		try:
+			initializer()
+		except BaseException:
+			# jobs which need it fail with the reason
+			pass
+	while True:
+		try:
+			job = conn.recv()
+		except EOFError:
+			return
+		if job is None:
+			return
+		func, args = job
+		try:
+			answer = (True, func(*args))
+		except BaseException as e:
+			# exceptions are not always picklable, their text is
+			answer = (False, "{0}: {1}".format(type(e).__name__, e))
+		conn.send(answer)
+
+
+class WorkerPool(object):
+	"""
+	Bounded pool of worker processes for CPU-heavy jobs. A job `func(*args)` (a module level function and picklable
+	args) waits in a queue of at most `max_queued` jobs, `callback(result, error)` is called with its outcome on a
+	dispatcher thread of the pool. A job which runs longer than its timeout fails and its worker process is replaced.
+	Workers are forked up front and run `initializer()` in the child, so the parent never loads what they preload
+	"""
+	def __init__(self, processes=None, max_queued=100, timeout_seconds=60, initializer=None):
+		self.logger = logging.getLogger(__name__)
+		self.processes = processes or multiprocessing.cpu_count()
+		self.timeout_seconds = timeout_seconds
+		self.initializer = initializer
+		self.jobs = Queue.Queue(max_queued)
+		self.closed = False
+		self.dispatchers = []
+		for i in xrange(self.processes):
+			dispatcher = threading.Thread(target=self._dispatcher, args=(self._start_worker(),),
+					name="WorkerPool-{0}".format(i))
+			dispatcher.daemon = True
+			dispatcher.start()
+			self.dispatchers.append(dispatcher)
+
+	def submit(self, func, args, callback, timeout_seconds=None):
+		"""
+		:return: False if the queue is full or the pool is closed, the job is not taken then
+		"""
+		if self.closed:
+			return False
+		try:
+			self.jobs.put_nowait((func, args, callback, timeout_seconds or self.timeout_seconds))
+		except Queue.Full:
+			return False
+		return True
+
+	def pending(self):
+		return self.jobs.qsize()
+
+	def _start_worker(self):
+		conn, child_conn = multiprocessing.Pipe()
+		process = multiprocessing.Process(target=_worker_main, args=(child_conn, self.initializer))
+		process.daemon = True
+		process.start()
+		child_conn.close()
+		return process, conn
+
+	@staticmethod
+	def _stop_worker(process, conn):
+		try:
+			conn.send(None)
+		except (IOError, EOFError):
+			pass
+		process.join(1)
+		if process.is_alive():
+			process.terminate()
+			process.join()
+		conn.close()
+
+	def _run(self, worker, func, args, timeout_seconds):
+		"""
+		:return: (result, error, whether the worker is still usable)
+		"""
+		process, conn = worker
+		try:
+			conn.send((func, args))
+			if not conn.poll(timeout_seconds):
+				return None, UserWarning("{0} is not done within {1} seconds".format(func.__name__,
+						timeout_seconds)), False
+			is_done, value = conn.recv()
+		except (IOError, EOFError) as e:
+			return None, UserWarning("The worker process is lost: {0}".format(e)), False
+		if is_done:
+			return value, None, True
+		return None, UserWarning(value), True
+
+	def _dispatcher(self, worker):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				break
+			func, args, callback, timeout_seconds = job
+			if worker is None:
+				worker = self._start_worker()
+			result, error, is_usable = self._run(worker, func, args, timeout_seconds)
+			if not is_usable:
+				self.logger.warning("WorkerPool: %s, the worker is replaced", error.message)
+				self._stop_worker(*worker)
+				worker = None
+			try:
+				callback(result, error)
+			except BaseException as e:
+				self.logger.exception("WorkerPool: callback of %s failed: %s", func.__name__, e.message)
+		if worker is not None:
+			self._stop_worker(*worker)
+
+	def close(self):
+		"""
+		Queued jobs fail, running ones are finished
+		"""
+		self.closed = True
+		while True:
+			try:
+				job = self.jobs.get_nowait()
+			except Queue.Empty:
+				break
+			if job is not None:
+				job[2](None, UserWarning("The pool is closed"))
+		for _ in self.dispatchers:
+			self.jobs.put(None)
+		for dispatcher in self.dispatchers:
+			dispatcher.join(self.timeout_seconds)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Delivery of piped messages by both UnsyncMessagesHandler against stub APIs which complete sends on demand.
+# Usage: python -m unittest discover -s tests
+
+import datetime as dt
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import telepot
+import vk_requests
+
+from synchrobot import memory_storage, sync_tg_bot, sync_vk_app
+from synchrobot.rate_limits import PendingCall
+
+TG_CHAT_ID = 1
+VK_CHAT_ID = 2000000001
+
+
+class StubBatcher(object):
+	def __init__(self):
+		self.calls = []
+
+	def submit(self, method, **method_args):
+		call = PendingCall(method, method_args)
+		self.calls.append(call)
+		return call
+
+
+class StubBot(object):
+	def __init__(self):
+		self.calls = []
+		self.resumed_chats = []
+
+	def send(self, chat_id, text, park_on_error=False):
+		call = PendingCall("sendMessage", {"chat_id": chat_id, "text": text})
+		self.calls.append(call)
+		return call
+
+	def cancel(self, calls):
+		cancelled = [call for call in calls if not call.done()]
+		for call in cancelled:
+			call.set_result(error=UserWarning("The send is cancelled"))
+		return cancelled
+
+	def resume(self, chat_id):
+		self.resumed_chats.append(chat_id)
+
+
+def add_pipe(tg_storage, vk_storage, tg_chat_id, vk_chat_id):
+	code = "/code{0}".format(tg_chat_id)
+	tg_storage.set_pending_chat(tg_chat_id, vk_chat_id, code)
+	for row_dict in vk_storage.check_pending_chats(code):
+		row_dict["confirmed"] = True
+
+
+def delivered_ids(storage, chat_key="vk_chat_id"):
+	return [msg["internal_id"] for msg in storage.store.messages if msg[chat_key] is not None]
+
+
+def resume_suspended_chats(handler):
+	for chat_id in handler.chat_retry_times:
+		handler.chat_retry_times[chat_id] = dt.datetime.now()
+
+
+class VkUnsyncMessagesHandlerTest(unittest.TestCase):
+	def setUp(self):
+		store = memory_storage.MemoryStore()
+		self.tg_storage = memory_storage.MemoryStorage("tg", store)
+		self.vk_storage = memory_storage.MemoryStorage("vk", store)
+		add_pipe(self.tg_storage, self.vk_storage, TG_CHAT_ID, VK_CHAT_ID)
+		self.tg_storage.add_msgs([(i, TG_CHAT_ID, 1, u"name", u"username", "text", u"message #{0}".format(i), 0)
+				for i in xrange(2)])
+		self.api = StubBatcher()
+		self.handler = sync_vk_app.UnsyncMessagesHandler(self.vk_storage, self.api, sync_vk_app.Outbox(),
+				coalesce=False)
+
+	def test_later_message_is_not_acked_before_failed_one(self):
+		self.handler.handler_hook()
+		self.handler.handler_hook()
+		self.assertEqual([call.method_args["random_id"] for call in self.api.calls], [1])
+
+		self.api.calls[0].set_result(error=vk_requests.exceptions.VkAPIError({"error_code": 9,
+				"error_msg": "Flood control"}))
+		self.handler.handler_hook()
+		self.assertEqual(delivered_ids(self.vk_storage), [])
+		self.assertEqual(len(self.api.calls), 1)
+
+		resume_suspended_chats(self.handler)
+		self.handler.handler_hook()
+		self.assertEqual([call.method_args["random_id"] for call in self.api.calls], [1, 1])
+		self.api.calls[1].set_result(101)
+		self.handler.handler_hook()
+		self.assertEqual(delivered_ids(self.vk_storage), [1])
+		self.assertEqual([call.method_args["random_id"] for call in self.api.calls], [1, 1, 2])
+		self.api.calls[2].set_result(102)
+		self.handler.handler_hook()
+		self.assertEqual(delivered_ids(self.vk_storage), [1, 2])
+
+	def test_other_chats_are_not_held(self):
+		add_pipe(self.tg_storage, self.vk_storage, TG_CHAT_ID + 1, VK_CHAT_ID + 1)
+		self.tg_storage.add_msgs([(10, TG_CHAT_ID + 1, 1, u"name", u"username", "text", u"other chat", 0)])
+		self.handler.handler_hook()
+		self.assertEqual(sorted(call.method_args["peer_id"] for call in self.api.calls), [VK_CHAT_ID,
+				VK_CHAT_ID + 1])
+
+
+class TgUnsyncMessagesHandlerTest(unittest.TestCase):
+	def setUp(self):
+		store = memory_storage.MemoryStore()
+		self.tg_storage = memory_storage.MemoryStorage("tg", store)
+		vk_storage = memory_storage.MemoryStorage("vk", store)
+		add_pipe(self.tg_storage, vk_storage, TG_CHAT_ID, VK_CHAT_ID)
+		vk_storage.add_msgs([(i, VK_CHAT_ID, 1, u"name", u"username", "text", u"message #{0}".format(i), 0)
+				for i in xrange(2)])
+		self.api = StubBot()
+		self.handler = sync_tg_bot.UnsyncMessagesHandler(self.tg_storage, self.api, coalesce=False)
+
+	def test_later_messages_of_failed_chat_are_taken_back(self):
+		self.handler.handler_hook()
+		self.assertEqual(len(self.api.calls), 2)
+
+		self.api.calls[0].set_result(error=telepot.exception.TelegramError("Forbidden", 403, {}))
+		self.handler.handler_hook()
+		self.assertTrue(self.api.calls[1].done())
+		self.assertEqual(self.api.resumed_chats, [TG_CHAT_ID])
+		self.assertEqual(self.handler.in_flight, {})
+		self.assertEqual(delivered_ids(self.tg_storage, "tg_chat_id"), [])
+
+		resume_suspended_chats(self.handler)
+		self.handler.handler_hook()
+		self.assertEqual([call.method_args["text"][-1] for call in self.api.calls[2:]], ["0", "1"])
+		for call in self.api.calls[2:]:
+			call.set_result({"message_id": 1})
+		self.handler.handler_hook()
+		self.assertEqual(delivered_ids(self.tg_storage, "tg_chat_id"), [1, 2])
+
+
+if __name__ == "__main__":
+	unittest.main()